@@ -2,12 +2,16 @@
 import re
 from contextlib import contextmanager
 import errno
+import fcntl
 import itertools
 import os
 import stat
+import struct
 import sys
 import tempfile
+import time
 
+from curtin import inventory
 from curtin import util
 from curtin.block import lvm
 from curtin.block import multipath
@@ -18,6 +22,14 @@ from curtin import storage_config
 
 SECTOR_SIZE_BYTES = 512
 
+# largest single write used to zero ranges of a device
+ZERO_WRITE_BUFLEN = 4 * 1024 * 1024
+
+# block device range ioctls from linux/fs.h, taking a (start, length) pair
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
+
 
 def get_dev_name_entry(devname):
     """
@@ -660,17 +672,18 @@ def md_get_devices_list(devpath):
 
 def detect_multipath(target_mountpoint=None):
     if multipath.multipath_supported():
-        for device in (os.path.realpath(dev)
-                       for (dev, _mp, _vfs, _opts, _freq, _passno)
-                       in get_proc_mounts() if dev.startswith('/dev/')):
-            if not is_block_device(device):
-                # A tmpfs can be mounted with any old junk in the "device"
-                # field and unfortunately casper sometimes puts "/dev/shm"
-                # there, which is usually a directory. Ignore such cases.
-                # (See https://bugs.launchpad.net/bugs/1876626)
-                continue
-            if _device_is_multipathed(device):
-                return device
+        with multipath.active():
+            for device in (os.path.realpath(dev)
+                           for (dev, _mp, _vfs, _opts, _freq, _passno)
+                           in get_proc_mounts() if dev.startswith('/dev/')):
+                if not is_block_device(device):
+                    # A tmpfs can be mounted with any old junk in the
+                    # "device" field and unfortunately casper sometimes puts
+                    # "/dev/shm" there, which is usually a directory. Ignore
+                    # such cases. (See https://bugs.launchpad.net/bugs/1876626)
+                    continue
+                if _device_is_multipathed(device):
+                    return device
 
     return _legacy_detect_multipath(target_mountpoint)
 
@@ -917,8 +930,13 @@ def lookup_disk(serial):
     serial_udev = serial.replace(' ', '_')
     LOG.info('Processing serial %s via udev to %s', serial, serial_udev)
 
-    disks = list(filter(lambda x: serial_udev in x,
-                        os.listdir("/dev/disk/by-id/")))
+    snapshot = inventory.current()
+    if snapshot is not None:
+        byid = dict((os.path.basename(link), devname) for link, devname in
+                    snapshot.devlinks('/dev/disk/by-id/').items())
+    else:
+        byid = dict((link, None) for link in os.listdir("/dev/disk/by-id/"))
+    disks = list(filter(lambda x: serial_udev in x, byid))
     if not disks or len(disks) < 1:
         raise ValueError("no disk with serial '%s' found" % serial_udev)
 
@@ -927,7 +945,8 @@ def lookup_disk(serial):
     # determine the path to the block device in /dev/
     disks.sort(key=lambda x: len(x))
     LOG.debug('lookup_disks found: %s', disks)
-    path = os.path.realpath("/dev/disk/by-id/%s" % disks[0])
+    path = (byid[disks[0]] or
+            os.path.realpath("/dev/disk/by-id/%s" % disks[0]))
     # /dev/dm-X
     if multipath.is_mpath_device(path):
         info = udevadm_info(path)
@@ -990,9 +1009,9 @@ def sysfs_partition_data(blockdev=None, sysfs_path=None):
         sysfs_prefix = sys_block_path(parent)
         partnum = int(partnum)
 
-    block_size = int(util.load_file(os.path.join(
-        sysfs_prefix, 'queue/logical_block_size')))
-    unit = block_size
+    # sysfs reports partition start and size in 512 byte sectors regardless
+    # of the logical block size of the device
+    unit = SECTOR_SIZE_BYTES
 
     ptdata = []
     for part_sysfs in get_sysfs_partitions(sysfs_prefix):
@@ -1162,6 +1181,110 @@ def exclusive_open(path, exclusive=True):
         raise
 
 
+def block_range_ioctl(fd, request, offset, length):
+    """
+    Issue a BLKDISCARD, BLKSECDISCARD or BLKZEROOUT ioctl on the range of
+    length bytes at offset of the block device open as fd.
+    Returns False if the device does not support the request.
+    """
+    try:
+        fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            return False
+        raise
+    return True
+
+
+def zero_range(fd, offset, length):
+    """
+    Zero length bytes at offset of the block device open as fd.
+
+    BLKZEROOUT is used rather than BLKDISCARD as discarded blocks are not
+    guaranteed to read back as zeros; the kernel offloads it to WRITE
+    ZEROES or a zeroing discard where the device supports one.
+    Returns False if the device does not support it.
+    """
+    return block_range_ioctl(fd, BLKZEROOUT, offset, length)
+
+
+def discard_zeroes_data(devpath):
+    """
+    Return True if the kernel reports that discarded blocks of devpath
+    read back as zeros.
+    """
+    # queue attributes are only present on the parent of a partition
+    (parent, _partnum) = get_blockdev_for_partition(devpath, strict=False)
+    try:
+        value = util.load_file(
+            sys_block_path(parent, 'queue/discard_zeroes_data'))
+    except (IOError, OSError):
+        return False
+    return value.strip() == '1'
+
+
+def _wipe_offload(path, requests, exclusive=True):
+    """
+    Try each of the (name, request) block range ioctls in turn over all of
+    path, returning the name of the first one supported or None.
+    """
+    if not is_block_device(path):
+        return None
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        for name, request in requests:
+            if block_range_ioctl(fp.fileno(), request, 0, size):
+                return name
+            LOG.debug('%s does not support %s', path, name)
+    return None
+
+
+def _log_wipe(path, method, start):
+    elapsed = max(time.time() - start, 0.001)
+    size = util.file_size(path)
+    LOG.info('wiped %s (%d bytes) with %s in %.2fs (%.1f MiB/s)',
+             path, size, method, elapsed, size / 2.0 ** 20 / elapsed)
+
+
+def zero_volume(path, exclusive=True):
+    """
+    Zero the whole of the file or block device at path.
+
+    Block devices are zeroed by the device itself if possible: with
+    BLKDISCARD if discarded blocks read back as zeros, otherwise with
+    BLKZEROOUT.  Zeros are written if neither is supported.
+    """
+    start = time.time()
+    requests = []
+    if is_block_device(path) and discard_zeroes_data(path):
+        requests.append(('BLKDISCARD', BLKDISCARD))
+    requests.append(('BLKZEROOUT', BLKZEROOUT))
+    method = _wipe_offload(path, requests, exclusive=exclusive)
+    if method is None:
+        method = 'write'
+        wipe_file(path, exclusive=exclusive)
+    _log_wipe(path, method, start)
+    return method
+
+
+def discard_volume(path, exclusive=True):
+    """
+    Discard all blocks of the block device at path, securely if supported
+    (BLKSECDISCARD, then BLKDISCARD).  The volume is zeroed instead if
+    discard is not supported.
+    """
+    start = time.time()
+    method = _wipe_offload(path, [('BLKSECDISCARD', BLKSECDISCARD),
+                                  ('BLKDISCARD', BLKDISCARD)],
+                           exclusive=exclusive)
+    if method is None:
+        LOG.debug('%s does not support discard, zeroing instead', path)
+        return zero_volume(path, exclusive=exclusive)
+    _log_wipe(path, method, start)
+    return method
+
+
 def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
     """
     wipe the existing file at path.
@@ -1197,11 +1320,15 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
                 fp.write(pbuf)
 
 
-def quick_zero(path, partitions=True, exclusive=True, strict=False):
+def quick_zero(path, partitions=True, exclusive=True, strict=False,
+               dry_run=False):
     """
     zero 1M at front, 1M at end, and 1M at front
     if this is a block device and partitions is true, then
     zero 1M at front and end of each partition.
+
+    All ranges are zeroed through a single open of path, see
+    zero_file_at_offsets for dry_run and the return value.
     """
     buflen = 1024
     count = 1024
@@ -1211,27 +1338,37 @@ def quick_zero(path, partitions=True, exclusive=True, strict=False):
     if not (is_block or os.path.isfile(path)):
         raise ValueError("%s: not an existing file or block device", path)
 
-    pt_names = []
+    regions = [(0, None)]
     if partitions and is_block:
-        ptdata = sysfs_partition_data(path)
-        for kname, ptnum, start, size in ptdata:
-            pt_names.append((dev_path(kname), kname, ptnum))
-        pt_names.reverse()
-
-    for (pt, kname, ptnum) in pt_names:
-        LOG.debug('Wiping path: dev:%s kname:%s partnum:%s',
-                  pt, kname, ptnum)
-        quick_zero(pt, partitions=False, strict=strict)
+        for kname, ptnum, start, size in sysfs_partition_data(path):
+            LOG.debug('Wiping path: dev:%s kname:%s partnum:%s',
+                      dev_path(kname), kname, ptnum)
+            regions.append((start, size))
 
     LOG.debug("wiping 1M on %s at offsets %s", path, offsets)
-    return zero_file_at_offsets(path, offsets, buflen=buflen, count=count,
-                                exclusive=exclusive, strict=strict)
+    return _zero_file_regions(path, regions, offsets, zero_size,
+                              strict=strict, exclusive=exclusive,
+                              dry_run=dry_run)
 
 
 def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
-                         exclusive=True):
+                         exclusive=True, dry_run=False):
     """
     write zeros to file at specified offsets
+
+    buflen * count bytes are zeroed at each offset, negative offsets are
+    relative to the end of the file.  Returns the list of (offset, length)
+    ranges zeroed, or only planned if dry_run is True.
+    """
+    return _zero_file_regions(path, [(0, None)], offsets, buflen * count,
+                              strict=strict, exclusive=exclusive,
+                              dry_run=dry_run)
+
+
+def _zero_ranges(path, region_start, size, offsets, length, strict=False):
+    """
+    Return (position, length) ranges of path to zero at each of offsets
+    into the region of size bytes starting at region_start.
     """
     bmsg = "{path} (size={size}): "
     m_short = bmsg + "{tot} bytes from {offset} > size."
@@ -1239,45 +1376,92 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
     if not strict:
         m_short += " Shortened to {wsize} bytes."
         m_badoff += " Skipping."
+    msg_vals = {'path': path, 'tot': length, 'size': size}
 
-    buf = b'\0' * buflen
-    tot = buflen * count
-    msg_vals = {'path': path, 'tot': buflen * count}
+    ranges = []
+    for offset in offsets:
+        if offset < 0:
+            pos = size + offset
+        else:
+            pos = offset
+        msg_vals['offset'] = offset
+        msg_vals['pos'] = pos
+        if pos > size or pos < 0:
+            if strict:
+                raise ValueError(m_badoff.format(**msg_vals))
+            else:
+                LOG.debug(m_badoff.format(**msg_vals))
+                continue
+
+        msg_vals['wsize'] = size - pos
+        if pos + length > size:
+            if strict:
+                raise ValueError(m_short.format(**msg_vals))
+            else:
+                LOG.debug(m_short.format(**msg_vals))
+        wsize = min(length, size - pos)
+        if wsize:
+            ranges.append((region_start + pos, wsize))
+    return ranges
+
+
+def _merge_ranges(ranges):
+    """Sort (offset, length) ranges, merging any that overlap or touch."""
+    merged = []
+    for pos, length in sorted(ranges):
+        if merged and pos <= merged[-1][0] + merged[-1][1]:
+            last_pos, last_len = merged[-1]
+            merged[-1] = (last_pos, max(last_len, pos + length - last_pos))
+        else:
+            merged.append((pos, length))
+    return merged
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    # python2
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def _write_zero_ranges(fd, ranges):
+    """Zero (offset, length) ranges of fd then fsync it once."""
+    if not ranges:
+        return
+    zeros = memoryview(
+        b'\0' * min(ZERO_WRITE_BUFLEN, max(r[1] for r in ranges)))
+    for pos, length in ranges:
+        end = pos + length
+        while pos < end:
+            pos += _pwrite(fd, zeros[:min(len(zeros), end - pos)], pos)
+    os.fsync(fd)
+
+
+def _zero_file_regions(path, regions, offsets, length, strict=False,
+                       exclusive=True, dry_run=False):
+    """
+    Zero length bytes at offsets into each (start, size) region of path.
+    A size of None is the size of path.
+    """
+    def plan(size):
+        ranges = []
+        for start, rsize in regions:
+            ranges.extend(_zero_ranges(
+                path, start, size if rsize is None else rsize, offsets,
+                length, strict=strict))
+        return _merge_ranges(ranges)
+
+    if dry_run:
+        return plan(util.file_size(path))
 
     # allow caller to control if we require exclusive open
     with exclusive_open(path, exclusive=exclusive) as fp:
         # get the size by seeking to end.
         fp.seek(0, 2)
-        size = fp.tell()
-        msg_vals['size'] = size
-
-        for offset in offsets:
-            if offset < 0:
-                pos = size + offset
-            else:
-                pos = offset
-            msg_vals['offset'] = offset
-            msg_vals['pos'] = pos
-            if pos > size or pos < 0:
-                if strict:
-                    raise ValueError(m_badoff.format(**msg_vals))
-                else:
-                    LOG.debug(m_badoff.format(**msg_vals))
-                    continue
-
-            msg_vals['wsize'] = size - pos
-            if pos + tot > size:
-                if strict:
-                    raise ValueError(m_short.format(**msg_vals))
-                else:
-                    LOG.debug(m_short.format(**msg_vals))
-            fp.seek(pos)
-            for i in range(count):
-                pos = fp.tell()
-                if pos + buflen > size:
-                    fp.write(buf[0:size-pos])
-                else:
-                    fp.write(buf)
+        ranges = plan(fp.tell())
+        _write_zero_ranges(fp.fileno(), ranges)
+    return ranges
 
 
 def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
@@ -1286,7 +1470,9 @@ def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
     :param path: a path to a block device
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
-       zero: write zeros to the entire volume
+       zero: write zeros to the entire volume, offloaded to the device
+             where supported
+       discard: discard all blocks of the volume, zero it if unsupported
        random: write random data (/dev/urandom) to the entire volume
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
@@ -1306,7 +1492,9 @@ def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
                   rcs=[0, 5], capture=True)
         lvm.lvm_scan()
     elif mode == "zero":
-        wipe_file(path, exclusive=exclusive)
+        zero_volume(path, exclusive=exclusive)
+    elif mode == "discard":
+        discard_volume(path, exclusive=exclusive)
     elif mode == "random":
         with open("/dev/urandom", "rb") as reader:
             wipe_file(path, reader=reader.read, exclusive=exclusive)
@@ -2,9 +2,8 @@
 
 import errno
 import os
-import time
 
-from curtin import util
+from curtin import devwait, util
 from curtin.log import LOG
 from curtin.udev import udevadm_settle
 from . import dev_path, sys_block_path
@@ -426,9 +425,9 @@ def ensure_bcache_is_registered(bcache_device, expected, retry=None):
                 # check it all again
                 pass
 
-        LOG.debug("bcache dev %s not ready, waiting %ss",
+        LOG.debug("bcache dev %s not ready, waiting up to %ss",
                   bcache_device, wait)
-        time.sleep(wait)
+        devwait.wait_for_path(expected, timeout=wait)
 
     # we've exhausted our retries
     LOG.warning('Repetitive error registering the bcache dev %s',
@@ -6,11 +6,12 @@ top of a block device, making it possible to reuse the block device without
 having to reboot the system
 """
 
+from collections import OrderedDict
 import glob
 import os
 import time
 
-from curtin import (block, udev, util)
+from curtin import (block, inventory, parallel, udev, util)
 from curtin.swap import is_swap_device
 from curtin.block import bcache
 from curtin.block import lvm
@@ -129,6 +130,10 @@ def shutdown_lvm(device):
     vg_lv_name = "%s/%s" % (vg_name, lv_name)
     devname = "/dev/" + vg_lv_name
 
+    # look up the physical volumes before changing the volgroup, so one lvm
+    # snapshot answers the name and membership queries
+    pvols = lvm.get_pvols_in_volgroup(vg_name)
+
     # wipe contents of the logical volume first
     LOG.info('Wiping lvm logical volume: %s', devname)
     block.quick_zero(devname, partitions=False)
@@ -136,10 +141,10 @@ def shutdown_lvm(device):
     # remove the logical volume
     LOG.debug('using "lvremove" on %s', vg_lv_name)
     util.subp(['lvremove', '--force', '--force', vg_lv_name])
+    lvm.invalidate()
 
     # if that was the last lvol in the volgroup, get rid of volgroup
     if len(lvm.get_lvols_in_volgroup(vg_name)) == 0:
-        pvols = lvm.get_pvols_in_volgroup(vg_name)
         util.subp(['vgremove', '--force', '--force', vg_name], rcs=[0, 5])
 
         # wipe the underlying physical volumes
@@ -426,12 +431,69 @@ def get_holders(device):
     return holders
 
 
-def gen_holders_tree(device):
+def _sysfs_dev_type(kname, sysfs):
+    """
+    identify the device type of kname from a walk_sysfs snapshot, as the
+    'ident' functions of DEV_TYPES would
+    """
+    info = sysfs.get(kname, {})
+    dm_uuid = info.get('dm_uuid') or ''
+    is_dm = kname.startswith('dm')
+    # like identify_partition, which passes a sysfs path to
+    # is_mpath_partition, dm partition maps (partN-mpath-<wwid>) are disks
+    if info.get('partition'):
+        return 'partition'
+    if is_dm and dm_uuid.startswith('LVM'):
+        return 'lvm'
+    if is_dm and dm_uuid.startswith('CRYPT'):
+        return 'crypt'
+    if kname.startswith('md'):
+        return 'raid'
+    if kname.startswith('bcache'):
+        return 'bcache'
+    return DEFAULT_DEV_TYPE
+
+
+def _gen_sysfs_holders_tree(kname, sysfs):
+    """
+    generate a holders tree for kname from a walk_sysfs snapshot
+    """
+    info = sysfs.get(kname, {})
+    toks = ['/sys/class/block', kname]
+    if info.get('partition') and info.get('parent'):
+        toks.insert(1, info['parent'])
+    # as in gen_holders_tree, the holders of a device include its partitions
+    holders = info.get('holders', []) + sorted(
+        name for name, other in sysfs.items()
+        if other.get('partition') and other.get('parent') == kname)
+    return {
+        'device': os.sep.join(toks), 'dev_type': _sysfs_dev_type(kname, sysfs),
+        'name': kname,
+        'holders': [_gen_sysfs_holders_tree(h, sysfs) for h in holders],
+    }
+
+
+def gen_holders_forest(devices):
+    """
+    generate holders trees for each of 'devices' from one walk of sysfs,
+    identifying device types from the snapshot rather than running the
+    'ident' function of each device type for each device
+    """
+    sysfs = inventory.walk_sysfs()
+    return [gen_holders_tree(device, sysfs=sysfs) for device in devices]
+
+
+def gen_holders_tree(device, sysfs=None):
     """
     generate a tree representing the current storage hirearchy above 'device'
+
+    if sysfs is a walk_sysfs snapshot the tree is generated from it,
+    see gen_holders_forest.
     """
     device = block.sys_block_path(device)
     dev_name = block.path_to_kname(device)
+    if sysfs is not None:
+        return _gen_sysfs_holders_tree(dev_name, sysfs)
     # the holders for a device should consist of the devices in the holders/
     # dir in sysfs and any partitions on the device. this ensures that a
     # storage tree starting from a disk will include all devices holding the
@@ -544,6 +606,73 @@ def plan_shutdown_holder_trees(holders_trees):
                                            devtype_order(reg[x]['dev_type'])))]
 
 
+def plan_shutdown_graph(ordered_devs, holders_trees):
+    """
+    plan which holders may be shut down at the same time
+
+    ordered_devs is the shutdown plan from plan_shutdown_holder_trees for
+    holders_trees.  A device waits for the devices holding it, so
+    independent stacks are shut down side by side.  Logical volumes of one
+    volume group, and devices sharing a device directly below them such as
+    bcache devices with one cache device, have shutdown functions which
+    expect to run one after another, so these keep their plan order.
+
+    returns an OrderedDict of device sysfs path to the devices which must
+    be shut down before it, in plan order, for use with parallel.run_graph
+    """
+    if not isinstance(holders_trees, (list, tuple)):
+        holders_trees = [holders_trees]
+
+    # devices directly above and directly below each device
+    holders = {}
+    slaves = {}
+
+    def add_tree(tree):
+        for holder in tree['holders']:
+            holders.setdefault(tree['device'], set()).add(holder['device'])
+            slaves.setdefault(holder['device'], set()).add(tree['device'])
+            add_tree(holder)
+
+    for holders_tree in holders_trees:
+        add_tree(holders_tree)
+
+    # volume group of each logical volume, None if it cannot be read
+    volgroups = dict((dev_info['device'], _lvm_volgroup(dev_info['device']))
+                     for dev_info in ordered_devs
+                     if dev_info['dev_type'] == 'lvm')
+
+    def same_volgroup(device, other):
+        if device not in volgroups or other not in volgroups:
+            return False
+        vg_name = volgroups[device]
+        return vg_name is None or volgroups[other] in (vg_name, None)
+
+    graph = OrderedDict()
+    for dev_info in ordered_devs:
+        device = dev_info['device']
+        below = slaves.get(device, set())
+        deps = set(holders.get(device, set()))
+        deps.update(other for other in graph
+                    if below & slaves.get(other, set()) or
+                    same_volgroup(device, other))
+        graph[device] = sorted(deps)
+
+    return graph
+
+
+def _lvm_volgroup(device):
+    """
+    return the volume group of the logical volume at sysfs path device,
+    None if it cannot be determined
+    """
+    try:
+        lvm_name = util.load_file(os.path.join(device, 'dm', 'name')).strip()
+        return lvm.split_lvm_name(lvm_name)[0]
+    except (IOError, OSError, util.ProcessExecutionError, ValueError) as e:
+        LOG.debug('Could not find the volume group of %s: %s', device, e)
+        return None
+
+
 def format_holders_tree(holders_tree):
     """
     draw a nice dirgram of the holders tree
@@ -587,20 +716,23 @@ def assert_clear(base_paths):
         base_paths = [base_paths]
     base_paths = [block.sys_block_path(path, strict=False)
                   for path in base_paths]
-    for holders_tree in [gen_holders_tree(p)
-                         for p in base_paths if os.path.exists(p)]:
+    for holders_tree in gen_holders_forest(
+            [p for p in base_paths if os.path.exists(p)]):
         if any(holder_type not in valid and path not in base_paths
                for (holder_type, path) in get_holder_types(holders_tree)):
             raise OSError('Storage not clear, remaining:\n{}'
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def clear_holders(base_paths, try_preserve=False, max_workers=1):
     """
     Clear all storage layers depending on the devices specified in 'base_paths'
     A single device or list of devices can be specified.
     Device paths can be specified either as paths in /dev or /sys/block
     Will throw OSError if any holders could not be shut down
+
+    Up to max_workers holders which do not depend on each other are shut
+    down at the same time, see plan_shutdown_graph.
     """
     # handle single path
     if not isinstance(base_paths, (list, tuple)):
@@ -608,13 +740,21 @@ def clear_holders(base_paths, try_preserve=False):
     LOG.info('Generating device storage trees for path(s): %s', base_paths)
 
     # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
+    holder_trees = gen_holders_forest(base_paths)
     LOG.info('Current device storage tree:\n%s',
              '\n'.join(format_holders_tree(tree) for tree in holder_trees))
     ordered_devs = plan_shutdown_holder_trees(holder_trees)
     LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
-    # run shutdown functions
+    def shutdown(dev_info):
+        if os.path.exists(dev_info['device']):
+            LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
+                     dev_info['dev_type'], dev_info['device'])
+            DEV_TYPES[dev_info['dev_type']]['shutdown'](dev_info['device'])
+
+    # devices are skipped rather than left out of the graph, so whatever
+    # holds them still comes first
+    to_shutdown = OrderedDict()
     for dev_info in ordered_devs:
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
@@ -622,39 +762,38 @@ def clear_holders(base_paths, try_preserve=False):
             continue
 
         if try_preserve and shutdown_function in DATA_DESTROYING_HANDLERS:
-            LOG.info('shutdown function for holder type: %s is destructive. '
-                     'attempting to preserve data, so skipping' %
-                     dev_info['dev_type'])
+            LOG.info('shutdown function for holder type: %s is '
+                     'destructive. attempting to preserve data, so '
+                     'skipping' % dev_info['dev_type'])
             continue
 
-        if os.path.exists(dev_info['device']):
-            LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
-                     dev_info['dev_type'], dev_info['device'])
-            shutdown_function(dev_info['device'])
+        to_shutdown[dev_info['device']] = dev_info
+
+    def shutdown_planned(device):
+        if device in to_shutdown:
+            shutdown(to_shutdown[device])
 
+    # run shutdown functions, answering lvm and multipath queries from
+    # snapshots
+    with lvm.active(), multipath.active():
+        graph = plan_shutdown_graph(ordered_devs, holder_trees)
+        parallel.run_graph(graph, shutdown_planned, max_workers=max_workers)
 
-def start_clear_holders_deps():
+
+def _start_mdadm_arrays(max_workers=1):
     """
-    prepare system for clear holders to be able to scan old devices
+    give each assembled mdadm array a poke to run and log its details, up to
+    max_workers arrays at the same time
     """
-    # a mdadm scan has to be started in case there is a md device that needs to
-    # be detected. if the scan fails, it is either because there are no mdadm
-    # devices on the system, or because there is a mdadm device in a damaged
-    # state that could not be started. due to the nature of mdadm tools, it is
-    # difficult to know which is the case. if any errors did occur, then ignore
-    # them, since no action needs to be taken if there were no mdadm devices on
-    # the system, and in the case where there is some mdadm metadata on a disk,
-    # but there was not enough to start the array, the call to wipe_volume on
-    # all disks and partitions should be sufficient to remove the mdadm
-    # metadata
-    mdadm.mdadm_assemble(scan=True, ignore_errors=True)
-    # collect detail on any assembling arrays
+    mdstat = None
+    if os.path.exists('/proc/mdstat'):
+        mdstat = util.load_file('/proc/mdstat')
+        LOG.debug("/proc/mdstat:\n%s", mdstat)
+
+    arrays = OrderedDict()
     for md in [md for md in glob.glob('/dev/md*')
                if not os.path.isdir(md) and not identify_partition(md)]:
-        mdstat = None
-        if os.path.exists('/proc/mdstat'):
-            mdstat = util.load_file('/proc/mdstat')
-            LOG.debug("/proc/mdstat:\n%s", mdstat)
+        if mdstat is not None:
             found = [line for line in mdstat.splitlines()
                      if os.path.basename(md) in line]
             # in some cases we have a /dev/md0 device node
@@ -662,7 +801,9 @@ def start_clear_holders_deps():
             if len(found) == 0:
                 LOG.debug('Ignoring md device %s, not present in mdstat', md)
                 continue
+        arrays[md] = []
 
+    def start_array(md):
         # give it a second poke to encourage running
         try:
             LOG.debug('Activating mdadm array %s', md)
@@ -680,31 +821,89 @@ def start_clear_holders_deps():
         except util.ProcessExecutionError:
             LOG.debug('Non-fatal error when querying mdadm detail on %s', md)
 
+    parallel.run_graph(arrays, start_array, max_workers=max_workers)
+
+
+def start_clear_holders_deps(max_workers=1):
+    """
+    prepare system for clear holders to be able to scan old devices
+
+    steps which do not depend on each other run at the same time, up to
+    max_workers steps and mdadm arrays at once.  returns an OrderedDict of
+    step name to the seconds it took.
+    """
+    def assemble_mdadm():
+        # a mdadm scan has to be started in case there is a md device that
+        # needs to be detected. if the scan fails, it is either because there
+        # are no mdadm devices on the system, or because there is a mdadm
+        # device in a damaged state that could not be started. due to the
+        # nature of mdadm tools, it is difficult to know which is the case. if
+        # any errors did occur, then ignore them, since no action needs to be
+        # taken if there were no mdadm devices on the system, and in the case
+        # where there is some mdadm metadata on a disk, but there was not
+        # enough to start the array, the call to wipe_volume on all disks and
+        # partitions should be sufficient to remove the mdadm metadata
+        mdadm.mdadm_assemble(scan=True, ignore_errors=True)
+
     mp_support = multipath.multipath_supported()
-    if mp_support:
-        LOG.debug('Detected multipath support, reload maps')
-        multipath.reload()
-        multipath.force_devmapper_symlinks()
 
-    # scan and activate for logical volumes
-    lvm.lvm_scan(multipath=mp_support)
-    try:
-        lvm.activate_volgroups(multipath=mp_support)
-    except util.ProcessExecutionError:
-        # partial vg may not come up due to missing members, that's OK
-        pass
-    udev.udevadm_settle()
-
-    # the bcache module needs to be present to properly detect bcache devs
-    # on some systems (precise without hwe kernel) it may not be possible to
-    # lad the bcache module bcause it is not present in the kernel. if this
-    # happens then there is no need to halt installation, as the bcache devices
-    # will never appear and will never prevent the disk from being reformatted
-    util.load_kernel_module('bcache')
+    def start_multipath():
+        if mp_support:
+            LOG.debug('Detected multipath support, reload maps')
+            multipath.reload()
+            multipath.force_devmapper_symlinks()
+
+    def activate_lvm():
+        # scan and activate for logical volumes
+        lvm.lvm_scan(multipath=mp_support)
+        try:
+            lvm.activate_volgroups(multipath=mp_support)
+        except util.ProcessExecutionError:
+            # partial vg may not come up due to missing members, that's OK
+            pass
+
+    def load_bcache():
+        # the bcache module needs to be present to properly detect bcache
+        # devs on some systems (precise without hwe kernel) it may not be
+        # possible to lad the bcache module bcause it is not present in the
+        # kernel. if this happens then there is no need to halt installation,
+        # as the bcache devices will never appear and will never prevent the
+        # disk from being reformatted
+        util.load_kernel_module('bcache')
+
+    # step name -> (function, steps it needs to have completed); logical
+    # volumes may be on md arrays or multipath devices
+    steps = OrderedDict([
+        ('mdadm-assemble', (assemble_mdadm, [])),
+        ('mdadm-run', (lambda: _start_mdadm_arrays(max_workers),
+                       ['mdadm-assemble'])),
+        ('multipath', (start_multipath, ['mdadm-assemble'])),
+        ('lvm', (activate_lvm, ['mdadm-run', 'multipath'])),
+        ('bcache', (load_bcache, [])),
+        ('udev-settle', (udev.udevadm_settle, ['lvm', 'bcache'])),
+    ])
+    timings = OrderedDict()
+
+    def run_step(name):
+        start = time.time()
+        try:
+            steps[name][0]()
+        finally:
+            timings[name] = time.time() - start
+            LOG.debug('clear-holders deps: %s took %.3f seconds',
+                      name, timings[name])
+
+    parallel.run_graph(OrderedDict((name, deps)
+                                   for name, (_func, deps) in steps.items()),
+                       run_step, max_workers=max_workers)
+    LOG.info('clear-holders deps started in: %s',
+             ', '.join('%s %.3fs' % item for item in timings.items()))
 
     if not zfs.zfs_supported():
         LOG.warning('zfs filesystem is not supported in this environment')
 
+    return timings
+
 
 # anything that is not identified can assumed to be a 'disk' or similar
 DEFAULT_DEV_TYPE = 'disk'
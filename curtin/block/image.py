@@ -0,0 +1,550 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+# This module streams disk images (optionally compressed or inside a tar
+# archive) from a url or local file onto a block device or file.
+
+import bz2
+import errno
+import hashlib
+import mmap
+import os
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # python2, xz images are decompressed with xzcat instead
+    lzma = None
+
+from curtin import block, url_helper, util
+from curtin.log import LOG
+from curtin.reporter import events
+
+READ_BUFSIZE = 1024 * 1024
+WRITE_BUFSIZE = 4 * 1024 * 1024
+# O_DIRECT writes must be aligned to the logical block size of the device,
+# 4096 covers both 512 and 4k sector devices.
+DIRECT_IO_ALIGNMENT = 4096
+PROGRESS_INTERVAL = 10
+
+# source type: (is a tar archive, compression)
+IMAGE_FORMATS = {
+    'dd-raw': (False, None),
+    'dd-gz': (False, 'gz'),
+    'dd-bz2': (False, 'bz2'),
+    'dd-xz': (False, 'xz'),
+    'dd-tar': (True, None),
+    'dd-tgz': (True, 'gz'),
+    'dd-tbz': (True, 'bz2'),
+    'dd-txz': (True, 'xz'),
+}
+
+EXTERNAL_DECOMPRESSORS = {
+    'gz': ['zcat'],
+    'bz2': ['bzcat'],
+    'xz': ['xzcat'],
+}
+
+
+def _decompressobj(compression):
+    if compression == 'gz':
+        # 16 + MAX_WBITS selects the gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz' and lzma:
+        return lzma.LZMADecompressor()
+    return None
+
+
+class DecompressReader(object):
+    """File-like reader returning the decompressed content of fileobj.
+
+    Concatenated streams (as produced by pigz or pbzip2) are supported."""
+
+    def __init__(self, fileobj, compression, bufsize=READ_BUFSIZE):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.bufsize = bufsize
+        self._decomp = _decompressobj(compression)
+        if self._decomp is None:
+            raise ValueError("Unsupported compression: %s" % compression)
+        self._buf = b''
+        self._eof = False
+
+    def _fill(self, size):
+        chunks = [self._buf]
+        length = len(self._buf)
+        while length < size and not self._eof:
+            data = self.fileobj.read(self.bufsize)
+            if not data:
+                self._eof = True
+                break
+            while data:
+                out = self._decomp.decompress(data)
+                chunks.append(out)
+                length += len(out)
+                data = b''
+                if getattr(self._decomp, 'eof', False):
+                    # start of another concatenated stream
+                    data = self._decomp.unused_data
+                    self._decomp = _decompressobj(self.compression)
+        self._buf = b''.join(chunks)
+
+    def read(self, size):
+        self._fill(size)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        self._buf = b''
+
+
+class CommandReader(object):
+    """File-like reader returning the output of cmd fed with fileobj.
+
+    Used for compression formats not handled by the python standard
+    library, e.g. ['zstdcat'] or ['lz4cat']."""
+
+    def __init__(self, fileobj, cmd, bufsize=READ_BUFSIZE):
+        self.fileobj = fileobj
+        self.cmd = cmd
+        self.bufsize = bufsize
+        self._error = None
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            while True:
+                data = self.fileobj.read(self.bufsize)
+                if not data:
+                    break
+                self._proc.stdin.write(data)
+        except Exception as e:
+            # EPIPE if the command exits early, reported by close()
+            self._error = e
+        finally:
+            try:
+                self._proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def read(self, size):
+        return self._proc.stdout.read(size)
+
+    def close(self):
+        self._proc.stdout.close()
+        rc = self._proc.wait()
+        self._feeder.join()
+        if rc != 0:
+            raise RuntimeError("Decompressor %s exited with %s" %
+                               (self.cmd, rc))
+        if self._error:
+            raise self._error
+
+
+class HashReader(object):
+    """File-like reader which hashes everything read from fileobj."""
+
+    def __init__(self, fileobj, checksum):
+        self.fileobj = fileobj
+        self.algo, _, self.expected = checksum.partition(':')
+        if not self.expected or self.algo not in hashlib.algorithms_available:
+            raise ValueError("Invalid checksum '%s', expected "
+                             "'<algorithm>:<hexdigest>'" % checksum)
+        self.expected = self.expected.lower()
+        self._hash = hashlib.new(self.algo)
+
+    def read(self, size):
+        data = self.fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def verify(self):
+        """Hash any unread data and compare against the expected digest."""
+        while self.read(READ_BUFSIZE):
+            pass
+        digest = self._hash.hexdigest()
+        if digest != self.expected:
+            raise ValueError("Checksum mismatch: expected %s:%s, got %s" %
+                             (self.algo, self.expected, digest))
+
+    def close(self):
+        pass
+
+
+class TarMemberReader(object):
+    """File-like reader for the first regular file in a tar stream."""
+
+    def __init__(self, fileobj, mode='r|'):
+        self.fileobj = fileobj
+        self._tar = tarfile.open(fileobj=fileobj, mode=mode)
+        for member in self._tar:
+            if member.isfile():
+                self._member = self._tar.extractfile(member)
+                self.size = member.size
+                break
+        else:
+            raise ValueError("No regular file found in tar image")
+
+    def read(self, size):
+        return self._member.read(size)
+
+    def close(self):
+        self._tar.close()
+
+
+def open_source(uri, retries=3, retry_delay=3):
+    """Return a file-like reader for a local path, file:// or http[s] uri."""
+    if uri.startswith("file://"):
+        uri = uri[7:]
+    if url_helper.urlparse(uri).scheme == "":
+        return open(uri, "rb")
+    return url_helper.ResumingUrlReader(uri, retries=retries,
+                                        retry_delay=retry_delay)
+
+
+def open_image(source_type, uri, checksum=None, decompressor=None,
+               retries=3):
+    """Return a list of readers for the raw disk image of a dd-* source.
+
+    The last reader returns the image, each reader reads from the previous
+    one.  Readers must be closed in reverse order, see close_readers.
+
+    :param checksum: optional '<algorithm>:<hexdigest>' of the source file.
+    :param decompressor: optional command (list) used instead of the
+                         standard library to decompress the source.
+    """
+    if source_type not in IMAGE_FORMATS:
+        raise ValueError("Unsupported image type: %s" % source_type)
+    is_tar, compression = IMAGE_FORMATS[source_type]
+
+    readers = [open_source(uri, retries=retries)]
+    try:
+        if checksum:
+            readers.append(HashReader(readers[-1], checksum))
+        if decompressor:
+            readers.append(CommandReader(readers[-1], decompressor))
+        elif compression and _decompressobj(compression) is None:
+            readers.append(CommandReader(readers[-1],
+                                         EXTERNAL_DECOMPRESSORS[compression]))
+        elif compression:
+            readers.append(DecompressReader(readers[-1], compression))
+        if is_tar:
+            # like smtar, detect the compression of plain dd-tar images
+            mode = 'r|*' if source_type == 'dd-tar' else 'r|'
+            readers.append(TarMemberReader(readers[-1], mode=mode))
+    except Exception:
+        close_readers(readers, verify=False)
+        raise
+    return readers
+
+
+def stream_to_command(uri, cmd, retries=3, bufsize=READ_BUFSIZE):
+    """Feed the content of uri to the standard input of cmd.
+
+    Raises ProcessExecutionError if cmd exits non-zero."""
+    reader = open_source(uri, retries=retries)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        while True:
+            data = reader.read(bufsize)
+            if not data:
+                break
+            proc.stdin.write(data)
+    except (IOError, OSError) as e:
+        # cmd exited early (EPIPE), its exit code explains why
+        if e.errno != errno.EPIPE:
+            proc.kill()
+            raise
+    finally:
+        reader.close()
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        rc = proc.wait()
+    if rc != 0:
+        raise util.ProcessExecutionError(cmd=cmd, exit_code=rc)
+
+
+def image_size(readers):
+    """Return the size of the image read by readers as returned by
+    open_image, or None if it is not known before decompressing it."""
+    image = readers[-1]
+    if isinstance(image, TarMemberReader):
+        return image.size
+    if isinstance(image, (DecompressReader, CommandReader)):
+        return None
+    source = readers[0]
+    if isinstance(source, url_helper.ResumingUrlReader):
+        try:
+            return int(source.size)
+        except (TypeError, ValueError):
+            return None
+    return os.fstat(source.fileno()).st_size
+
+
+def close_readers(readers, verify=True):
+    """Close readers returned by open_image, outermost first.
+
+    If verify is True, checksums are verified once all the readers in
+    front of the HashReader are closed."""
+    error = None
+    for reader in reversed(readers):
+        try:
+            if verify and isinstance(reader, HashReader):
+                reader.verify()
+        except Exception as e:
+            error = error or e
+        finally:
+            try:
+                reader.close()
+            except Exception as e:
+                error = error or e
+    if error and verify:
+        raise error
+
+
+def _open_output(path, direct=True):
+    """Open path for writing, with O_DIRECT if requested and supported."""
+    flags = os.O_WRONLY
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.debug('%s does not support O_DIRECT, using buffered io',
+                      path)
+    return os.open(path, flags), False
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view):
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class ImageWriter(object):
+    """Write a stream of data to path in large aligned chunks.
+
+    If sparse is True, aligned chunks which are entirely zero are not
+    written.  Runs of such chunks are zeroed with BLKZEROOUT on block
+    devices (falling back to writing zeros if unsupported) and left as
+    holes past the end of regular files, so the result is always the same
+    as a full copy.
+
+    Writing past the end of a block device raises ValueError."""
+
+    def __init__(self, path, bufsize=WRITE_BUFSIZE, direct=True,
+                 sparse=False):
+        if bufsize % DIRECT_IO_ALIGNMENT:
+            raise ValueError("bufsize %d is not a multiple of %d" %
+                             (bufsize, DIRECT_IO_ALIGNMENT))
+        self.path = path
+        self.bufsize = bufsize
+        self.sparse = sparse
+        self.fd, self.direct = _open_output(path, direct=direct)
+        st = os.fstat(self.fd)
+        self.is_block = stat.S_ISBLK(st.st_mode)
+        self.capacity = None
+        self._file_size = st.st_size
+        if self.is_block:
+            self.capacity = os.lseek(self.fd, 0, os.SEEK_END)
+        # mmap memory is page aligned as O_DIRECT requires
+        self._buf = mmap.mmap(-1, bufsize)
+        self._zeros = b'\0' * bufsize
+        self._hole_start = None
+        self._offload = self.is_block
+        self.offset = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def check_size(self, size):
+        """Raise ValueError if size bytes do not fit on a block device."""
+        if self.capacity is not None and size > self.capacity:
+            raise ValueError("Image of %d bytes does not fit on %s (%d bytes)"
+                             % (size, self.path, self.capacity))
+
+    def _is_zero(self, length):
+        # comparing bytes objects is a memcmp, an order of magnitude faster
+        # than comparing memoryviews item by item (about 1ms against 13ms
+        # for 4MiB).  Only the short final chunk slices the zeros.
+        zeros = self._zeros
+        if length != len(zeros):
+            zeros = zeros[:length]
+        return self._buf[:length] == zeros
+
+    def _skip(self, length):
+        return (self.sparse and length % DIRECT_IO_ALIGNMENT == 0 and
+                self._is_zero(length))
+
+    def _write(self, offset, data):
+        if len(data) % DIRECT_IO_ALIGNMENT == 0 or not self.direct:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            _write_all(self.fd, data)
+        else:
+            # unaligned tail of the image, write it without O_DIRECT
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                _write_all(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.bytes_written += len(data)
+
+    def _write_zeros(self, offset, length):
+        # a fresh anonymous mapping is zero filled and page aligned
+        zeros = mmap.mmap(-1, self.bufsize)
+        try:
+            end = offset + length
+            while offset < end:
+                size = min(self.bufsize, end - offset)
+                self._write(offset, memoryview(zeros)[:size])
+                offset += size
+        finally:
+            zeros.close()
+
+    def _zero_hole(self):
+        """Make the skipped range before the current offset read as zeros."""
+        if self._hole_start is None:
+            return
+        start, length = self._hole_start, self.offset - self._hole_start
+        self._hole_start = None
+        if not self.is_block:
+            # regular files read back zeros past their original end
+            dirty = max(min(length, self._file_size - start), 0)
+            if dirty:
+                self._write_zeros(start, dirty)
+            self.bytes_skipped += length - dirty
+            return
+        if self._offload:
+            if block.zero_range(self.fd, start, length):
+                self.bytes_skipped += length
+                return
+            LOG.debug('%s does not support BLKZEROOUT, writing zeros',
+                      self.path)
+            self._offload = False
+        self._write_zeros(start, length)
+
+    def _flush(self, length):
+        self.check_size(self.offset + length)
+        if self._skip(length):
+            if self._hole_start is None:
+                self._hole_start = self.offset
+        else:
+            self._zero_hole()
+            self._write(self.offset, memoryview(self._buf)[:length])
+        self.offset += length
+
+    def write_from(self, reader, progress=None):
+        """Copy everything from reader.  progress(offset) is called after
+        each chunk."""
+        while True:
+            filled = 0
+            while filled < self.bufsize:
+                data = reader.read(self.bufsize - filled)
+                if not data:
+                    break
+                self._buf[filled:filled + len(data)] = data
+                filled += len(data)
+            if filled:
+                self._flush(filled)
+                if progress:
+                    progress(self.offset)
+            if filled < self.bufsize:
+                break
+        self._zero_hole()
+        if not self.is_block and os.fstat(self.fd).st_size < self.offset:
+            # the image ends with a hole
+            os.ftruncate(self.fd, self.offset)
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self._buf.close()
+
+
+def write_image(source, devpath, bufsize=WRITE_BUFSIZE, direct=True,
+                sparse=None, retries=3, report_prefix=''):
+    """Stream the image of a dd-* source to devpath.
+
+    :param source: dictionary with 'type' (dd-raw, dd-gz, dd-tgz, ...) and
+                   'uri' keys, optionally 'checksum', 'decompressor' and
+                   'sparse'.
+    :param devpath: block device (or file) to write the image to.
+    :param bufsize: size of each write.
+    :param direct: use O_DIRECT writes where supported.
+    :param sparse: skip all-zero chunks, see ImageWriter.  Defaults to the
+                   'sparse' setting of source, itself False by default.
+
+    Raises ValueError if the image is larger than the block device, which
+    is checked before writing when the image size is known in advance.
+
+    Returns a dictionary with bytes_written, bytes_skipped and elapsed.
+    """
+    if sparse is None:
+        sparse = source.get('sparse', False)
+    desc = "writing image %s to %s" % (source['uri'], devpath)
+    with events.ReportEventStack(
+            name=report_prefix + '/write-image', reporting_enabled=True,
+            level="INFO", description=desc) as reportstack:
+        readers = open_image(source['type'], source['uri'],
+                             checksum=source.get('checksum'),
+                             decompressor=source.get('decompressor'),
+                             retries=retries)
+        start = time.time()
+        last = [start]
+
+        def progress(offset):
+            now = time.time()
+            if now - last[0] >= PROGRESS_INTERVAL:
+                last[0] = now
+                LOG.info('%s: %d MiB (%.1f MiB/s)', desc, offset // 2 ** 20,
+                         offset / 2.0 ** 20 / (now - start))
+
+        writer = None
+        try:
+            writer = ImageWriter(devpath, bufsize=bufsize, direct=direct,
+                                 sparse=sparse)
+            size = image_size(readers)
+            if size is not None:
+                writer.check_size(size)
+            writer.write_from(readers[-1], progress=progress)
+        except Exception:
+            close_readers(readers, verify=False)
+            raise
+        finally:
+            if writer:
+                writer.close()
+        close_readers(readers)
+
+        elapsed = max(time.time() - start, 0.001)
+        total = writer.offset
+        reportstack.message = (
+            "wrote %d bytes (%d skipped) to %s in %.2fs (%.1f MiB/s)" %
+            (total, writer.bytes_skipped, devpath, elapsed,
+             total / 2.0 ** 20 / elapsed))
+        LOG.info(reportstack.message)
+        return {'bytes_written': writer.bytes_written,
+                'bytes_skipped': writer.bytes_skipped,
+                'elapsed': elapsed}
+
+# vi: ts=4 expandtab syntax=python
@@ -4,14 +4,21 @@
 This module provides some helper functions for manipulating lvm devices
 """
 
+from contextlib import contextmanager
 from curtin import distro
 from curtin import util
 from curtin.log import LOG
+import json
 import os
+import threading
 
 # separator to use for lvm/dm tools
 _SEP = '='
 
+# fields of the pvs and lvs reports kept in an LvmSnapshot
+PV_FIELDS = ('pv_name', 'vg_name')
+LV_FIELDS = ('lv_name', 'vg_name', 'lv_size')
+
 
 def _filter_lvm_info(lvtool, match_field, query_field, match_key, args=None):
     """
@@ -27,10 +34,122 @@ def _filter_lvm_info(lvtool, match_field, query_field, match_key, args=None):
             if mf == match_key]
 
 
+def _lvm_report(tool, fields):
+    """
+    return the rows of a pvs/vgs/lvs report as a list of dictionaries
+    """
+    cmd = [tool, '--units=B', '-o', ','.join(fields)]
+    if _report_state['json']:
+        try:
+            (out, _) = util.subp(cmd + ['--reportformat', 'json'],
+                                 capture=True)
+            # {"report": [{"lv": [{"lv_name": ..., ...}, ...]}]}
+            report = json.loads(out)['report']
+            return [row for section in report
+                    for row in section.get(tool[:2], [])]
+        except (util.ProcessExecutionError, ValueError, KeyError) as e:
+            # lvm before 2.02.158 has no json reports
+            LOG.debug('lvm: json report unavailable, using columns: %s', e)
+            _report_state['json'] = False
+    (out, _) = util.subp(cmd + ['--noheadings', '--separator', _SEP],
+                         capture=True)
+    return [dict(zip(fields, line.strip().split(_SEP)))
+            for line in out.strip().splitlines()]
+
+
+def dm_name(vg_name, lv_name):
+    """
+    return the device mapper name of a logical volume, as dmsetup shows it
+    """
+    return '-'.join(name.replace('-', '--') for name in (vg_name, lv_name))
+
+
+class LvmSnapshot(object):
+    """Physical and logical volumes reported by one pvs and one lvs run."""
+
+    def __init__(self, pvs, lvs):
+        self.pvs = pvs
+        self.lvs = lvs
+        self.by_dm_name = dict((dm_name(lv['vg_name'], lv['lv_name']),
+                                (lv['vg_name'], lv['lv_name']))
+                               for lv in lvs)
+
+    @classmethod
+    def from_system(cls):
+        snapshot = cls(_lvm_report('pvs', PV_FIELDS),
+                       _lvm_report('lvs', LV_FIELDS))
+        LOG.debug('lvm: snapshot of %d physical and %d logical volumes',
+                  len(snapshot.pvs), len(snapshot.lvs))
+        return snapshot
+
+    def pvols_in_volgroup(self, vg_name):
+        return [pv['pv_name'] for pv in self.pvs if pv['vg_name'] == vg_name]
+
+    def lvols_in_volgroup(self, vg_name):
+        return [lv['lv_name'] for lv in self.lvs if lv['vg_name'] == vg_name]
+
+    def lv_size_bytes(self, lv_name):
+        for lv in self.lvs:
+            if lv['lv_name'] == lv_name:
+                return util.human2bytes(lv['lv_size'])
+
+    def split_name(self, full):
+        """Return [vg_name, lv_name] of a device mapper name, or None if
+        it is not a logical volume of the snapshot."""
+        names = self.by_dm_name.get(full)
+        return list(names) if names else None
+
+
+_report_state = {'json': True}
+_lock = threading.RLock()
+_state = {'depth': 0, 'snapshot': None}
+
+
+@contextmanager
+def active():
+    """
+    answer volume group membership, size and name queries from a snapshot
+    inside this block.  Callers changing lvm state must call invalidate()
+    (lvm_scan and activate_volgroups do).
+    """
+    with _lock:
+        _state['depth'] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _state['depth'] -= 1
+            if not _state['depth']:
+                _state['snapshot'] = None
+
+
+def invalidate():
+    """
+    drop the current snapshot, the next query takes a new one
+    """
+    with _lock:
+        _state['snapshot'] = None
+
+
+def current():
+    """
+    return the LvmSnapshot, or None outside of active()
+    """
+    with _lock:
+        if not _state['depth']:
+            return None
+        if _state['snapshot'] is None:
+            _state['snapshot'] = LvmSnapshot.from_system()
+        return _state['snapshot']
+
+
 def get_pvols_in_volgroup(vg_name):
     """
     get physical volumes used by volgroup
     """
+    snapshot = current()
+    if snapshot is not None:
+        return snapshot.pvols_in_volgroup(vg_name)
     return _filter_lvm_info('pvdisplay', 'vg_name', 'pv_name', vg_name)
 
 
@@ -38,11 +157,17 @@ def get_lvols_in_volgroup(vg_name):
     """
     get logical volumes in volgroup
     """
+    snapshot = current()
+    if snapshot is not None:
+        return snapshot.lvols_in_volgroup(vg_name)
     return _filter_lvm_info('lvdisplay', 'vg_name', 'lv_name', vg_name)
 
 
 def get_lv_size_bytes(lv_name):
     """ get the size in bytes of a logical volume specified by lv_name."""
+    snapshot = current()
+    if snapshot is not None:
+        return snapshot.lv_size_bytes(lv_name)
     result = _filter_lvm_info('lvdisplay', 'lv_name', 'lv_size', lv_name,
                               args=['--units=B'])
     if result:
@@ -53,6 +178,11 @@ def split_lvm_name(full):
     """
     split full lvm name into tuple of (volgroup, lv_name)
     """
+    snapshot = current()
+    if snapshot is not None:
+        names = snapshot.split_name(full)
+        if names:
+            return names
     # 'dmsetup splitname' is the authoratative source for lvm name parsing
     (out, _) = util.subp(['dmsetup', 'splitname', full, '-c', '--noheadings',
                           '--separator', _SEP, '-o', 'vg_name,lv_name'],
@@ -88,6 +218,7 @@ def activate_volgroups(multipath=False):
     # vgchange handles syncing with udev by default
     # see man 8 vgchange and flag --noudevsync
     out, _ = util.subp(cmd, capture=True)
+    invalidate()
     if out:
         LOG.info(out)
 
@@ -135,5 +266,6 @@ def lvm_scan(activate=True, multipath=False):
         if multipath:
             cmd.extend(['--config', mponly])
         util.subp(cmd, capture=True)
+    invalidate()
 
 # vi: ts=4 expandtab syntax=python
@@ -5,9 +5,12 @@
 # the 'mdadm' command in a subprocess.  The remaining functions handle
 # manipulation of the mdadm output.
 
+import json
 import os
 import re
+import select
 import shlex
+import threading
 import time
 
 from curtin.block import (
@@ -38,6 +41,18 @@ SPARE_RAID_LEVELS = [
 
 VALID_RAID_LEVELS = NOSPARE_RAID_LEVELS + SPARE_RAID_LEVELS
 
+# how a new array resyncs during install, see doc/topics/storage.rst
+RESYNC_POLICIES = ['background', 'wait', 'defer', 'assume-clean']
+
+# arrays whose resync settings were changed during install, and the values
+# to restore before reboot; kept in the install state directory
+SYNC_CONTROL_FILE = 'md-sync-control.json'
+SYNC_PROGRESS_INTERVAL = 30
+
+# guards the read-modify-write of sync control state files, which arrays
+# handled in separate threads share
+_sync_control_lock = threading.Lock()
+
 #  https://www.kernel.org/doc/Documentation/md.txt
 '''
      clear
@@ -146,10 +161,11 @@ def mdadm_assemble(md_devname=None, devices=[], spares=[], scan=False,
 
 
 def mdadm_create(md_devname, raidlevel, devices, spares=None, md_name="",
-                 metadata=None):
+                 metadata=None, assume_clean=False):
     LOG.debug('mdadm_create: ' +
               'md_name=%s raidlevel=%s ' % (md_devname, raidlevel) +
-              ' devices=%s spares=%s name=%s' % (devices, spares, md_name))
+              ' devices=%s spares=%s name=%s' % (devices, spares, md_name) +
+              ' assume_clean=%s' % assume_clean)
 
     assert_valid_devpath(md_devname)
     if not metadata:
@@ -177,6 +193,8 @@ def mdadm_create(md_devname, raidlevel, devices, spares=None, md_name="",
            "--raid-devices=%s" % len(devices)]
     if md_name:
         cmd.append("--name=%s" % md_name)
+    if assume_clean:
+        cmd.append("--assume-clean")
 
     for device in devices:
         holders = get_holders(device)
@@ -733,7 +751,24 @@ def md_check_raidlevel(raidlevel):
     return True
 
 
-def md_block_until_in_sync(md_devname):
+def md_sync_completed(value):
+    """ Parse the content of md/sync_completed.
+
+    Returns None if no sync is running, else a tuple of the sectors done
+    and the total, which are None while the sync is delayed or pending.
+    """
+    value = value.strip()
+    if value in ('', 'none'):
+        return None
+    done, _, total = value.partition('/')
+    try:
+        return (int(done), int(total))
+    except ValueError:
+        return (None, None)
+
+
+def md_block_until_in_sync(md_devname, timeout=None,
+                           interval=SYNC_PROGRESS_INTERVAL):
     '''
     sync_completed
     This shows the number of sectors that have been completed of
@@ -744,9 +779,141 @@ def md_block_until_in_sync(md_devname):
     A 'select' on this attribute will return when resync completes,
     when it reaches the current sync_max (below) and possibly at
     other times.
+
+    Block until md_devname has no sync running, logging its progress every
+    interval seconds.  Returns True once the array is in sync and False if
+    it is not after timeout seconds, or if its sync is frozen.
     '''
-    # FIXME: use selectors to block on: /sys/class/block/mdX/md/sync_completed
-    pass
+    assert_valid_devpath(md_devname)
+    sync_completed = md_sysfs_attr_path(md_devname, 'sync_completed')
+    if not os.path.exists(sync_completed):
+        # arrays without redundancy have nothing to sync
+        return True
+
+    start = time.time()
+    deadline = None if timeout is None else start + timeout
+    reported = None
+    with open(sync_completed) as fp:
+        poller = select.poll()
+        poller.register(fp.fileno(), select.POLLPRI | select.POLLERR)
+        while True:
+            # sysfs signals a change once per read, so read before polling
+            fp.seek(0)
+            progress = md_sync_completed(fp.read())
+            action = md_sysfs_attr(md_devname, 'sync_action')
+            if progress is None and action in ('idle', ''):
+                LOG.info('mdadm: %s in sync after %.1f seconds',
+                         md_devname, time.time() - start)
+                return True
+            if action == 'frozen':
+                LOG.warning('mdadm: %s sync is frozen, not waiting',
+                            md_devname)
+                return False
+
+            now = time.time()
+            if reported is None or now - reported >= interval:
+                done, total = progress or (None, None)
+                if total:
+                    LOG.info('mdadm: %s %s %.1f%% (%d/%d sectors)',
+                             md_devname, action, 100.0 * done / total,
+                             done, total)
+                else:
+                    LOG.info('mdadm: %s %s pending', md_devname, action)
+                reported = now
+
+            if deadline is not None and now >= deadline:
+                LOG.warning('mdadm: %s not in sync after %s seconds',
+                            md_devname, timeout)
+                return False
+            wait = interval
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            poller.poll(max(wait, 0) * 1000)
+
+
+def md_sync_speed(md_devname, attrname):
+    """ Return the sync_speed_min or sync_speed_max value to restore.
+
+    The attribute reads as '<KiB/s> (local)' when set for the array, and as
+    '<KiB/s> (system)' when it follows the system wide limit; writing
+    'system' returns to the latter.
+    """
+    value = md_sysfs_attr(md_devname, attrname)
+    if value.endswith('(local)'):
+        return value.split()[0]
+    return 'system'
+
+
+def _write_md_attr(md_devname, attrname, value):
+    path = md_sysfs_attr_path(md_devname, attrname)
+    try:
+        util.write_file(path, content=str(value))
+    except (IOError, OSError) as e:
+        LOG.warning('mdadm: failed to write %s to %s: %s', value, path, e)
+        return False
+    return True
+
+
+def _load_sync_control(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    return json.loads(util.load_file(state_file))
+
+
+def set_sync_control(md_devname, state_file, speed_min=None, speed_max=None,
+                     freeze=False):
+    """ Throttle or freeze the sync of md_devname for the install.
+
+    speed_min and speed_max are KiB/s written to sync_speed_min and
+    sync_speed_max, freeze writes 'frozen' to sync_action.  The values to
+    restore are recorded in state_file for restore_sync_control; an array
+    changed twice keeps the values recorded first.
+    """
+    assert_valid_devpath(md_devname)
+    with _sync_control_lock:
+        controls = _load_sync_control(state_file)
+        saved = controls.setdefault(md_devname, {})
+        for attrname, value in (('sync_speed_min', speed_min),
+                                ('sync_speed_max', speed_max)):
+            if value is None:
+                continue
+            if attrname not in saved:
+                saved[attrname] = md_sync_speed(md_devname, attrname)
+            LOG.info('mdadm: set %s=%s on array %s', attrname, value,
+                     md_devname)
+            _write_md_attr(md_devname, attrname, value)
+        if freeze:
+            saved['frozen'] = True
+            set_sync_action(md_devname, action='frozen')
+        util.write_file(state_file, json.dumps(controls, indent=1,
+                                               sort_keys=True))
+
+
+def restore_sync_control(state_file):
+    """ Undo set_sync_control for all arrays recorded in state_file.
+
+    Frozen arrays are set back to 'idle', which resumes any sync they
+    still need.  Arrays which are gone are skipped.
+    """
+    with _sync_control_lock:
+        controls = _load_sync_control(state_file)
+        for md_devname, saved in sorted(controls.items()):
+            if not os.path.exists(md_sysfs_attr_path(md_devname, '')):
+                LOG.debug('mdadm: %s is gone, not restoring sync settings',
+                          md_devname)
+                continue
+            for attrname in ('sync_speed_min', 'sync_speed_max'):
+                if attrname in saved:
+                    LOG.info('mdadm: restore %s=%s on array %s', attrname,
+                             saved[attrname], md_devname)
+                    _write_md_attr(md_devname, attrname, saved[attrname])
+            if saved.get('frozen'):
+                # not set_sync_action, the array leaves 'idle' again as soon
+                # as a pending sync restarts
+                LOG.info('mdadm: resume sync on array %s', md_devname)
+                _write_md_attr(md_devname, 'sync_action', 'idle')
+        if controls:
+            os.unlink(state_file)
 
 
 def md_check_array_state(md_devname):
@@ -68,6 +68,13 @@ family_flag_mappings = {
               "reiserfs": ("--label", "{label}"),
               "swap": ("--label", "{label}"),
               "xfs": ("-L", "{label}")},
+    "journal_device": {"ext": ("-J", "device={journal_device}"),
+                       "xfs": ("-l", "logdev={journal_device}")},
+    "lazy_itable_init": {"ext": ("-E", "lazy_itable_init={lazy_itable_init}")},
+    # flag with no parameter
+    "nodiscard": {"btrfs": "--nodiscard",
+                  "ext": ("-E", "nodiscard"),
+                  "xfs": "-K"},
     # flag with no parameter, N.B: this isn't used/exposed
     "quiet": {"ext": "-q",
               "ntfs": "-q",
@@ -121,7 +128,10 @@ def get_flag_mapping(flag_name, fs_family, param=None, strict=False):
             return ret
 
     if param is None:
-        ret.append(flag_sym)
+        if isinstance(flag_sym, tuple):
+            ret.extend(flag_sym)
+        else:
+            ret.append(flag_sym)
     else:
         params = [k.format(**{flag_name: param}) for k in flag_sym]
         if list(params) == list(flag_sym):
@@ -132,8 +142,37 @@ def get_flag_mapping(flag_name, fs_family, param=None, strict=False):
     return ret
 
 
+def merge_extended_options(cmd):
+    """Return cmd with all '-E <opts>' pairs joined into the first one.
+
+    mke2fs only honors the last -E it is given."""
+    ret = []
+    extended = None
+    args = iter(cmd)
+    for arg in args:
+        if arg != "-E":
+            ret.append(arg)
+            continue
+        opts = next(args, None)
+        if opts is None:
+            ret.append(arg)
+        elif extended is None:
+            extended = len(ret) + 1
+            ret.extend([arg, opts])
+        else:
+            ret[extended] += "," + opts
+    return ret
+
+
+def make_journal_device(path, blocksize):
+    """Format path as an external ext journal with the given block size."""
+    util.subp(["mke2fs", "-F", "-q", "-O", "journal_dev", "-b",
+               str(blocksize), path], capture=True)
+
+
 def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
-         extra_options=None):
+         extra_options=None, lazy_itable_init=None, nodiscard=False,
+         journal_device=None):
     """Make filesystem on block device with given path using given fstype and
        appropriate flags for filesystem family.
 
@@ -148,6 +187,15 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
        Force can be specified to force the mkfs command to continue even if it
        finds old data or filesystems on the partition.
 
+       lazy_itable_init (True or False) sets whether ext filesystems
+       initialize their inode tables in the background after the first
+       mount, instead of at mkfs time.  nodiscard skips discarding the
+       device before making the filesystem.
+
+       journal_device is the path of a block device to hold the journal of
+       ext filesystems, which is formatted as an external journal, or the
+       log of xfs filesystems.
+
        If extra_options are supplied they are appended to mkfs command.
        """
 
@@ -204,9 +252,32 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
             cmd.extend(get_flag_mapping("fatsize", fs_family, param=fat_size,
                                         strict=strict))
 
+    if lazy_itable_init is not None:
+        cmd.extend(get_flag_mapping("lazy_itable_init", fs_family,
+                                    param=str(int(bool(lazy_itable_init))),
+                                    strict=strict))
+    if nodiscard:
+        cmd.extend(get_flag_mapping("nodiscard", fs_family, strict=strict))
+
+    if journal_device is not None:
+        journal_flags = get_flag_mapping("journal_device", fs_family,
+                                         param=journal_device, strict=strict)
+        if journal_flags and fs_family == "ext":
+            # the journal and the filesystem must use the same block size
+            blocksize = max(logical_bsize, 4096)
+            if logical_bsize != blocksize:
+                cmd.extend(get_flag_mapping("sectorsize", fs_family,
+                                            param=str(blocksize),
+                                            strict=strict))
+            make_journal_device(journal_device, blocksize)
+        cmd.extend(journal_flags)
+
     if extra_options:
         cmd.extend(extra_options)
 
+    if fs_family == "ext":
+        cmd = merge_extended_options(cmd)
+
     cmd.append(path)
     util.subp(cmd, capture=True)
 
@@ -223,15 +294,19 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
     return uuid
 
 
-def mkfs_from_config(path, info, strict=False):
+def mkfs_from_config(path, info, strict=False, journal_path=None):
     """Make filesystem on block device with given path according to storage
-       config given"""
+       config given.  journal_path is the path of the volume referenced by
+       the config's journal_device."""
     fstype = info.get('fstype')
     if fstype is None:
         raise ValueError("fstype must be specified")
     # NOTE: Since old metadata on partitions that have not been wiped can cause
     #       some mkfs commands to refuse to work, it's best to use force=True
     mkfs(path, fstype, strict=strict, force=True, uuid=info.get('uuid'),
-         label=info.get('label'), extra_options=info.get('extra_options'))
+         label=info.get('label'), extra_options=info.get('extra_options'),
+         lazy_itable_init=info.get('lazy_itable_init'),
+         nodiscard=info.get('nodiscard', False),
+         journal_device=journal_path)
 
 # vi: ts=4 expandtab syntax=python
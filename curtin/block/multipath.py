@@ -1,6 +1,9 @@
+from contextlib import contextmanager
 import os
+import threading
 
 from curtin.log import LOG
+from curtin import inventory
 from curtin import util
 from curtin import udev
 
@@ -35,7 +38,7 @@ def show_maps():
     return _extract_mpath_data(cmd, 'maps')
 
 
-def dmname_to_blkdev_mapping():
+def _dmsetup_ls():
     """ Use dmsetup ls output to build a dict of DM_NAME, /dev/dm-x values."""
     data, _err = util.subp(['dmsetup', 'ls', '-o', 'blkdevname'], capture=True)
     mapping = {}
@@ -50,13 +53,124 @@ def dmname_to_blkdev_mapping():
     return mapping
 
 
+class MultipathTopology(object):
+    """Multipath paths, maps and device mapper names from one multipathd
+    show paths, one show maps and one dmsetup ls run."""
+
+    def __init__(self, paths, maps, dm_names):
+        self.paths = paths
+        self.maps = maps
+        self.dm_names = dm_names
+        # /dev/sdX -> multipath name, multipath name -> [/dev/sdX, ...]
+        self.path_mpath = {}
+        self.mpath_paths = {}
+        for path in paths:
+            devpath = '/dev/' + path['device']
+            self.path_mpath[devpath] = path['multipath']
+            self.mpath_paths.setdefault(path['multipath'], []).append(devpath)
+        # /dev/dm-X and /dev/mapper/<name> of each map -> map id, native
+        # nvme multipath maps are not device mapper devices
+        self.map_ids = {}
+        for mpmap in maps:
+            if not mpmap['sysfs'].startswith('dm-'):
+                continue
+            map_id = mpmap.get('name') or mpmap['multipath']
+            self.map_ids['/dev/' + mpmap['sysfs']] = map_id
+            self.map_ids['/dev/mapper/' + map_id] = map_id
+
+    @classmethod
+    def from_system(cls):
+        topology = cls(show_paths(), show_maps(), _dmsetup_ls())
+        LOG.debug('multipath: snapshot of %d maps and %d paths',
+                  len(topology.maps), len(topology.paths))
+        return topology
+
+    def _lookup(self, table, devpath):
+        if devpath in table:
+            return table[devpath]
+        return table.get(os.path.realpath(devpath))
+
+    def is_map(self, devpath):
+        return self._lookup(self.map_ids, devpath) is not None
+
+    def is_member(self, devpath):
+        mpath_id = self._lookup(self.path_mpath, devpath)
+        return bool(mpath_id) and 'orphan' not in mpath_id
+
+    def mpath_id(self, devpath):
+        return self._lookup(self.map_ids, devpath)
+
+    def mpath_id_by_path(self, devpath):
+        return self._lookup(self.path_mpath, devpath)
+
+    def members(self, mpath_id):
+        return list(self.mpath_paths.get(mpath_id, []))
+
+
+_lock = threading.RLock()
+_state = {'depth': 0, 'topology': None}
+
+
+@contextmanager
+def active():
+    """ Answer multipath membership, map and partition queries from a
+    MultipathTopology snapshot inside this block.  reload(), remove_map(),
+    remove_partition() and udev.udevadm_settle() retake it, other callers
+    changing multipath or device mapper state must call invalidate()."""
+    with _lock:
+        _state['depth'] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _state['depth'] -= 1
+            if not _state['depth']:
+                _state['topology'] = None
+
+
+def invalidate():
+    """ Drop the current snapshot, the next query takes a new one."""
+    with _lock:
+        _state['topology'] = None
+
+
+def current():
+    """ Return the MultipathTopology, or None outside of active() or if
+    multipathd could not be queried."""
+    with _lock:
+        if not _state['depth']:
+            return None
+        if _state['topology'] is None:
+            try:
+                _state['topology'] = MultipathTopology.from_system()
+            except (util.ProcessExecutionError, OSError) as e:
+                LOG.debug('multipath: no topology snapshot: %s', e)
+                _state['topology'] = False
+        return _state['topology'] or None
+
+
+def dmname_to_blkdev_mapping():
+    """ Use dmsetup ls output to build a dict of DM_NAME, /dev/dm-x values."""
+    topology = current()
+    if topology is not None:
+        return dict(topology.dm_names)
+    snapshot = inventory.current()
+    if snapshot is not None:
+        return snapshot.dm_name_mapping()
+    return _dmsetup_ls()
+
+
 def is_mpath_device(devpath, info=None):
     """ Check if devpath is a multipath device, returns boolean. """
     result = False
-    if not info:
-        info = udev.udevadm_info(devpath)
-    if info.get('DM_UUID', '').startswith('mpath-'):
-        result = True
+    topology = current()
+    if not info and topology is not None:
+        result = topology.is_map(devpath)
+    else:
+        if not info:
+            info = udev.udevadm_info(devpath)
+        if info.get('DM_UUID', '').startswith('mpath-'):
+            result = True
 
     LOG.debug('%s is multipath device? %s', devpath, result)
     return result
@@ -65,11 +179,18 @@ def is_mpath_device(devpath, info=None):
 def is_mpath_member(devpath, info=None):
     """ Check if a device is a multipath member (a path), returns boolean. """
     result = False
-    try:
-        util.subp(['multipath', '-c', devpath], capture=True)
-        result = True
-    except util.ProcessExecutionError:
-        pass
+    topology = current()
+    snapshot = inventory.current()
+    if topology is not None:
+        result = topology.is_member(devpath)
+    elif snapshot is not None and snapshot.kname(devpath):
+        result = snapshot.mpath_holder(devpath) is not None
+    else:
+        try:
+            util.subp(['multipath', '-c', devpath], capture=True)
+            result = True
+        except util.ProcessExecutionError:
+            pass
 
     LOG.debug('%s is multipath device member? %s', devpath, result)
     return result
@@ -100,30 +221,39 @@ def mpath_partition_to_mpath_id(devpath):
 def remove_partition(devpath, retries=10):
     """ Remove a multipath partition mapping. """
     LOG.debug('multipath: removing multipath partition: %s', devpath)
-    for _ in range(0, retries):
-        util.subp(['dmsetup', 'remove', '--force', '--retry', devpath])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
-            return
+    try:
+        for _ in range(0, retries):
+            util.subp(['dmsetup', 'remove', '--force', '--retry', devpath])
+            udev.udevadm_settle()
+            if not os.path.exists(devpath):
+                return
 
-    util.wait_for_removal(devpath)
+        util.wait_for_removal(devpath)
+    finally:
+        invalidate()
 
 
 def remove_map(map_id, retries=10):
     """ Remove a multipath device mapping. """
     LOG.debug('multipath: removing multipath map: %s', map_id)
     devpath = '/dev/mapper/%s' % map_id
-    for _ in range(0, retries):
-        util.subp(['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
-            return
+    try:
+        for _ in range(0, retries):
+            util.subp(['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
+            udev.udevadm_settle()
+            if not os.path.exists(devpath):
+                return
 
-    util.wait_for_removal(devpath)
+        util.wait_for_removal(devpath)
+    finally:
+        invalidate()
 
 
 def find_mpath_members(multipath_id, paths=None):
     """ Return a list of device path for each member of aspecified mpath_id."""
+    topology = current()
+    if not paths and topology is not None:
+        return topology.members(multipath_id)
     if not paths:
         paths = show_paths()
         for retry in range(0, 5):
@@ -141,6 +271,9 @@ def find_mpath_members(multipath_id, paths=None):
 
 def find_mpath_id(devpath, maps=None):
     """ Return the mpath_id associated with a specified device path. """
+    topology = current()
+    if not maps and topology is not None:
+        return topology.mpath_id(devpath)
     if not maps:
         maps = show_maps()
 
@@ -156,13 +289,20 @@ def find_mpath_id(devpath, maps=None):
 
 def find_mpath_id_by_path(devpath, paths=None):
     """ Return the mpath_id associated with a specified device path. """
-    if not paths:
-        paths = show_paths()
-
     if devpath.startswith('/dev/dm-'):
         raise ValueError('find_mpath_id_by_path does not handle '
                          'device-mapper devices: %s' % devpath)
 
+    topology = current()
+    if not paths and topology is not None:
+        return topology.mpath_id_by_path(devpath)
+    snapshot = inventory.current()
+    if not paths and snapshot is not None and snapshot.kname(devpath):
+        return snapshot.mpath_holder(devpath)
+
+    if not paths:
+        paths = show_paths()
+
     for path in paths:
         if devpath == '/dev/' + path['device']:
             return path['multipath']
@@ -236,7 +376,10 @@ def force_devmapper_symlinks():
 
 def reload():
     """ Request multipath to force reload devmaps. """
-    util.subp(['multipath', '-r'])
+    try:
+        util.subp(['multipath', '-r'])
+    finally:
+        invalidate()
 
 
 def multipath_supported():
@@ -23,7 +23,8 @@ definitions = {
              'pattern': r'^([1-9]\d*(.\d+)?|\d+.\d+)(K|M|G|T)?B?'},
     'wipe': {
         'type': 'string',
-        'enum': ['random', 'superblock', 'superblock-recursive', 'zero'],
+        'enum': ['discard', 'random', 'superblock', 'superblock-recursive',
+                 'zero'],
     },
     'uuid': {
         'type': 'string',
@@ -191,6 +192,9 @@ FORMAT = {
         'label': {'type': 'string'},
         'volume': {'$ref': '#/definitions/ref_id'},
         'extra_options': {'type': 'array', 'items': {'type': 'string'}},
+        'lazy_itable_init': {'type': 'boolean'},
+        'nodiscard': {'type': 'boolean'},
+        'journal_device': {'$ref': '#/definitions/ref_id'},
     }
 }
 LVM_PARTITION = {
@@ -315,6 +319,11 @@ RAID = {
         'metadata': {'type': ['string', 'number']},
         'preserve': {'$ref': '#/definitions/preserve'},
         'ptable': {'$ref': '#/definitions/ptable'},
+        'resync': {'type': 'string',
+                   'enum': ['background', 'wait', 'defer', 'assume-clean']},
+        'resync_speed_min': {'type': 'integer', 'minimum': 1},
+        'resync_speed_max': {'type': 'integer', 'minimum': 1},
+        'resync_timeout': {'type': 'number', 'minimum': 0},
         'spare_devices': {'$ref': '#/definitions/devices'},
         'type': {'const': 'raid'},
         'raidlevel': {
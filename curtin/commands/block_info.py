@@ -35,7 +35,7 @@ def block_info_main(args):
         return res
 
     trees = [add_size_to_holders_tree(t) for t in
-             [block.clear_holders.gen_holders_tree(d) for d in args.devices]]
+             block.clear_holders.gen_holders_forest(args.devices)]
 
     print(util.json_dumps(trees) if args.json else
           '\n'.join(block.clear_holders.format_holders_tree(t) for t in
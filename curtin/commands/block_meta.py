@@ -1,14 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from collections import OrderedDict, namedtuple
-from curtin import (block, config, paths, util)
+from contextlib import contextmanager
+from curtin import (block, config, devwait, inventory, parallel, paths,
+                    util)
 from curtin.block import schemas
-from curtin.block import (bcache, clear_holders, dasd, iscsi, lvm, mdadm, mkfs,
-                          multipath, zfs)
+from curtin.block import (bcache, clear_holders, dasd, image, iscsi, lvm,
+                          mdadm, mkfs, multipath, zfs)
 from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 from curtin.storage_config import (extract_storage_ordered_dict,
+                                   find_item_disks,
+                                   get_dependency_graph,
                                    ptable_uuid_to_flag_entry)
 
 
@@ -22,7 +26,7 @@ import platform
 import string
 import sys
 import tempfile
-import time
+import threading
 
 FstabData = namedtuple(
     "FstabData", ('spec', 'path', 'fstype', 'options', 'freq', 'passno',
@@ -36,6 +40,8 @@ CUSTOM = 'custom'
 PTABLE_UNSUPPORTED = schemas._ptable_unsupported
 PTABLES_SUPPORTED = schemas._ptables
 PTABLES_VALID = schemas._ptables_valid
+# seconds to wait for a partition device node after partprobe
+DEVSYNC_TIMEOUT = 10
 
 SGDISK_FLAGS = {
     "boot": 'ef00',
@@ -99,7 +105,8 @@ def block_meta(args):
         args.devices = devices
 
     LOG.debug('clearing devices=%s', devices)
-    meta_clear(devices, state.get('report_stack_prefix', ''))
+    meta_clear(devices, state.get('report_stack_prefix', ''),
+               max_workers=get_max_workers(cfg))
 
     # dd-images requires use of meta_simple
     if len(dd_images) > 0 and args.force_mode is False:
@@ -124,26 +131,13 @@ def logtime(msg, func, *args, **kwargs):
         return func(*args, **kwargs)
 
 
-def write_image_to_disk(source, dev):
+def write_image_to_disk(source, dev, report_prefix=''):
     """
     Write disk image to block device
     """
     LOG.info('writing image to disk %s, %s', source, dev)
-    extractor = {
-        'dd-tgz': '|tar -xOzf -',
-        'dd-txz': '|tar -xOJf -',
-        'dd-tbz': '|tar -xOjf -',
-        'dd-tar': '|smtar -xOf -',
-        'dd-bz2': '|bzcat',
-        'dd-gz': '|zcat',
-        'dd-xz': '|xzcat',
-        'dd-raw': ''
-    }
     (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=['sh', '-c',
-                    ('wget "$1" --progress=dot:mega -O - ' +
-                     extractor[source['type']] + '| dd bs=4M of="$2"'),
-                    '--', source['uri'], devnode])
+    image.write_image(source, devnode, report_prefix=report_prefix)
     util.subp(['partprobe', devnode])
     udevadm_settle()
     # Images from MAAS have well-known/required paths present
@@ -203,14 +197,10 @@ def get_partition_format_type(cfg, machine=None, uefi_bootable=None):
 def devsync(devpath):
     util.subp(['partprobe', devpath], rcs=[0, 1])
     udevadm_settle()
-    for x in range(0, 10):
-        if os.path.exists(devpath):
-            LOG.debug('devsync happy - path %s now exists', devpath)
-            return
-        else:
-            LOG.debug('Waiting on device path: %s', devpath)
-            time.sleep(1)
-    raise OSError('Failed to find device at path: %s', devpath)
+    LOG.debug('Waiting on device path: %s', devpath)
+    if not devwait.wait_for_path(devpath, timeout=DEVSYNC_TIMEOUT):
+        raise OSError('Failed to find device at path: %s' % devpath)
+    LOG.debug('devsync happy - path %s now exists', devpath)
 
 
 def determine_partition_number(partition_id, storage_config):
@@ -949,6 +939,7 @@ def partition_handler(info, storage_config):
             if os.path.exists(part_path) and not os.path.islink(part_path):
                 util.del_file(part_path)
             util.subp(['kpartx', '-v', '-a', '-s', '-p', '-part', disk])
+            multipath.invalidate()
         else:
             part_path = block.dev_path(block.partition_kname(disk_kname,
                                                              partnumber))
@@ -969,6 +960,32 @@ def partition_handler(info, storage_config):
         make_dname(info.get('id'), storage_config)
 
 
+# format items handled concurrently (block-meta max_workers) make their
+# filesystems one at a time on each disk, see mkfs_disk_locks
+_mkfs_locks = {}
+_mkfs_locks_lock = threading.Lock()
+
+
+@contextmanager
+def mkfs_disk_locks(disk_ids):
+    """Hold the mkfs lock of every disk in disk_ids.
+
+    Concurrent mkfs on one disk make it seek between the filesystems, so
+    they take longer together than one after the other.  Locks are taken
+    in sorted order so that volumes spanning several disks cannot
+    deadlock."""
+    with _mkfs_locks_lock:
+        locks = [_mkfs_locks.setdefault(disk_id, threading.Lock())
+                 for disk_id in sorted(set(disk_ids))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
 def format_handler(info, storage_config):
     volume = info.get('volume')
     if not volume:
@@ -983,9 +1000,21 @@ def format_handler(info, storage_config):
         # Volume marked to be preserved, not formatting
         return
 
+    volumes = [volume]
+    journal_path = None
+    if info.get('journal_device'):
+        volumes.append(info['journal_device'])
+        journal_path = get_path_to_storage_volume(info['journal_device'],
+                                                  storage_config)
+
+    disks = []
+    for vol in volumes:
+        disks.extend(find_item_disks(vol, storage_config))
+
     # Make filesystem using block library
     LOG.debug("mkfs %s info: %s", volume_path, info)
-    mkfs.mkfs_from_config(volume_path, info)
+    with mkfs_disk_locks(disks):
+        mkfs.mkfs_from_config(volume_path, info, journal_path=journal_path)
 
     device_type = storage_config.get(volume).get('type')
     LOG.debug('Formated device type: %s', device_type)
@@ -1046,6 +1075,13 @@ def mount_data(info, storage_config):
                 if "_netdev" not in options:
                     if iscsi.volpath_is_iscsi(volume_path):
                         options.append("_netdev")
+        format_info = storage_config[info['device']]
+        # an xfs external log has to be passed to every mount
+        if (format_info.get('fstype') == 'xfs' and
+                format_info.get('journal_device') and
+                not any(o.startswith('logdev=') for o in options)):
+            options.append('logdev=%s' % get_path_to_storage_volume(
+                format_info['journal_device'], storage_config))
 
     if fstype in ("fat", "fat12", "fat16", "fat32", "fat64"):
         fstype = "vfat"
@@ -1260,6 +1296,7 @@ def lvm_volgroup_handler(info, storage_config):
         # Use zero to clear target devices of any metadata
         util.subp(['vgcreate', '--force', '--zero=y', '--yes',
                    name] + device_paths, capture=True)
+        lvm.invalidate()
 
     # refresh lvmetad
     lvm.lvm_scan()
@@ -1323,6 +1360,7 @@ def lvm_partition_handler(info, storage_config):
             cmd.extend(["--extents", "100%FREE"])
 
         util.subp(cmd)
+        lvm.invalidate()
 
     # refresh lvmetad
     lvm.lvm_scan()
@@ -1515,10 +1553,17 @@ def raid_handler(info, storage_config):
         LOG.debug('raid %s already present, skipping create', md_devname)
         create_raid = False
 
+    resync = info.get('resync', 'background')
+    if resync not in mdadm.RESYNC_POLICIES:
+        raise ValueError("invalid resync policy '%s'" % resync)
+
     if create_raid:
         mdadm.mdadm_create(md_devname, raidlevel,
                            device_paths, spare_device_paths,
-                           info.get('mdname', ''))
+                           info.get('mdname', ''),
+                           assume_clean=(resync == 'assume-clean'))
+
+    raid_sync_control(info, md_devname, resync, state)
 
     wipe_mode = info.get('wipe')
     if wipe_mode:
@@ -1554,6 +1599,28 @@ def raid_handler(info, storage_config):
         disk_handler(info, storage_config)
 
 
+def raid_sync_control(info, md_devname, resync, state):
+    # Throttle or pause the sync of the array for the rest of the install,
+    # the install restores the settings recorded here before reboot.
+    speed_min = info.get('resync_speed_min')
+    speed_max = info.get('resync_speed_max')
+    freeze = resync == 'defer'
+    if freeze or speed_min is not None or speed_max is not None:
+        if state['fstab']:
+            state_file = os.path.join(os.path.dirname(state['fstab']),
+                                      mdadm.SYNC_CONTROL_FILE)
+            mdadm.set_sync_control(md_devname, state_file,
+                                   speed_min=speed_min, speed_max=speed_max,
+                                   freeze=freeze)
+        else:
+            LOG.warning("no state directory to record the sync settings of "
+                        "%s in, not changing them", md_devname)
+
+    if resync == 'wait':
+        mdadm.md_block_until_in_sync(md_devname,
+                                     timeout=info.get('resync_timeout'))
+
+
 def verify_bcache_cachedev(cachedev):
     """ verify that the specified cache_device is a bcache cache device."""
     result = bcache.is_caching(cachedev)
@@ -1854,11 +1921,13 @@ def zfsroot_update_storage_config(storage_config):
     return ret
 
 
-def meta_clear(devices, report_prefix=''):
+def meta_clear(devices, report_prefix='', max_workers=1):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: max_workers: number of devices to activate or shut down
+                         concurrently
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
@@ -1866,12 +1935,30 @@ def meta_clear(devices, report_prefix=''):
             name=report_prefix + '/clear-holders',
             reporting_enabled=True, level='INFO',
             description="removing previous storage devices"):
-        clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        clear_holders.start_clear_holders_deps(max_workers=max_workers)
+        clear_holders.clear_holders(devices, max_workers=max_workers)
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(devices)
 
 
+def get_max_workers(cfg):
+    """Return the number of storage items block-meta may handle at once.
+
+    The default of 1 handles each item serially in config order.
+    """
+    max_workers = cfg.get('block-meta', {}).get('max_workers', 1)
+    try:
+        max_workers = int(max_workers)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "block-meta max_workers must be an integer, got '%s'" %
+            max_workers)
+    if max_workers < 1:
+        raise ValueError(
+            "block-meta max_workers must be >= 1, got '%s'" % max_workers)
+    return max_workers
+
+
 def meta_custom(args):
     """Does custom partitioning based on the layout provided in the config
     file. Section with the name storage contains information on which
@@ -1904,7 +1991,8 @@ def meta_custom(args):
     # set up reportstack
     stack_prefix = state.get('report_stack_prefix', '')
 
-    for item_id, command in storage_config_dict.items():
+    def handle_item(item_id):
+        command = storage_config_dict[item_id]
         handler = command_handlers.get(command['type'])
         if not handler:
             raise ValueError("unknown command type '%s'" % command['type'])
@@ -1919,6 +2007,23 @@ def meta_custom(args):
                           (item_id, type(error).__name__, error))
                 raise
 
+    max_workers = get_max_workers(cfg)
+    # answer device lookups from a udev snapshot, retaken after each settle,
+    # and lvm and multipath queries from snapshots retaken after each change
+    with inventory.active(), lvm.active(), multipath.active():
+        if max_workers > 1:
+            for command in storage_config_dict.values():
+                if command['type'] not in command_handlers:
+                    raise ValueError(
+                        "unknown command type '%s'" % command['type'])
+            graph = get_dependency_graph(storage_config_dict)
+            LOG.info('blockmeta: handling storage config with %s workers',
+                     max_workers)
+            parallel.run_graph(graph, handle_item, max_workers=max_workers)
+        else:
+            for item_id in storage_config_dict:
+                handle_item(item_id)
+
     if args.umount:
         util.do_umount(state['target'], recursive=True)
     return 0
@@ -2013,7 +2118,9 @@ def meta_simple(args):
     if len(dd_images):
         # we have at least one dd-able image
         # we will only take the first one
-        rootdev = write_image_to_disk(dd_images[0], devname)
+        rootdev = write_image_to_disk(
+            dd_images[0], devname,
+            report_prefix=state.get('report_stack_prefix', ''))
         util.subp(['mount', rootdev, state['target']])
         return 0
 
@@ -22,6 +22,7 @@ import sys
 import tempfile
 
 
+from .. import tracing
 from .. import util
 from .. import version
 from ..config import load_config, merge_config
@@ -71,6 +72,9 @@ def create_log_tarfile(tarfile, config):
     alllogs = instcfg.get('post_files', [])
     if logfile:
         alllogs.append(logfile)
+    subp_ledger = instcfg.get('subp_ledger', tracing.ledger_path())
+    if subp_ledger:
+        alllogs.append(subp_ledger)
     # Prune duplicates and files which do not exist
     stderr = sys.stderr
     valid_logs = []
@@ -1,5 +1,6 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from collections import OrderedDict
 import copy
 import glob
 import os
@@ -43,6 +44,8 @@ CMD_ARGUMENTS = (
      )
 )
 
+ZKEY_REPOSITORY = '/etc/zkey/repository'
+
 KERNEL_MAPPING = {
     'precise': {
         '3.2.0': '',
@@ -346,7 +349,19 @@ def setup_kernel_img_conf(target):
     util.write_file(kernel_img_conf_path, content=content)
 
 
-def install_kernel(cfg, target):
+def get_flash_kernel_deps():
+    """Return the flash-kernel dependencies to install before the kernel.
+
+    Machines using flash-kernel may need additional dependencies installed
+    before running. Run those checks in the ephemeral environment so the
+    target only has required packages installed.  See LP:1640519"""
+    fk_packages = get_flash_kernel_pkgs()
+    return fk_packages.split() if fk_packages else []
+
+
+def get_kernel_packages(cfg, target):
+    """Return the lists of kernel packages install_kernel installs, in
+    order, after the flash-kernel dependencies."""
     kernel_cfg = cfg.get('kernel', {'package': None,
                                     'fallback-package': "linux-generic",
                                     'mapping': {}})
@@ -360,16 +375,10 @@ def install_kernel(cfg, target):
     mapping = copy.deepcopy(KERNEL_MAPPING)
     config.merge_config(mapping, kernel_cfg.get('mapping', {}))
 
-    # Machines using flash-kernel may need additional dependencies installed
-    # before running. Run those checks in the ephemeral environment so the
-    # target only has required packages installed.  See LP:1640519
-    fk_packages = get_flash_kernel_pkgs()
-    if fk_packages:
-        distro.install_packages(fk_packages.split(), target=target)
-
+    pkglists = []
     if kernel_package:
-        distro.install_packages([kernel_package], target=target)
-        return
+        pkglists.append([kernel_package])
+        return pkglists
 
     # uname[2] is kernel name (ie: 3.16.0-7-generic)
     # version gets X.Y.Z, flavor gets anything after second '-'.
@@ -385,8 +394,8 @@ def install_kernel(cfg, target):
         LOG.warn("Couldn't detect kernel package to install for %s."
                  % kernel)
         if kernel_fallback is not None:
-            distro.install_packages([kernel_fallback], target=target)
-        return
+            pkglists.append([kernel_fallback])
+        return pkglists
 
     package = "linux-{flavor}{map_suffix}".format(
         flavor=flavor, map_suffix=map_suffix)
@@ -396,16 +405,30 @@ def install_kernel(cfg, target):
             LOG.debug("Kernel package '%s' already installed", package)
         else:
             LOG.debug("installing kernel package '%s'", package)
-            distro.install_packages([package], target=target)
+            pkglists.append([package])
     else:
         if kernel_fallback is not None:
             LOG.info("Kernel package '%s' not available.  "
                      "Installing fallback package '%s'.",
                      package, kernel_fallback)
-            distro.install_packages([kernel_fallback], target=target)
+            pkglists.append([kernel_fallback])
         else:
             LOG.warn("Kernel package '%s' not available and no fallback."
                      " System may not boot.", package)
+    return pkglists
+
+
+def install_kernel(cfg, target, plan=None):
+    if plan is None or not plan.installed('flash-kernel'):
+        fk_packages = get_flash_kernel_deps()
+        if fk_packages:
+            distro.install_packages(fk_packages, target=target)
+
+    if plan is not None and plan.installed('kernel'):
+        return
+
+    for pkglist in get_kernel_packages(cfg, target):
+        distro.install_packages(pkglist, target=target)
 
 
 def uefi_remove_old_loaders(grubcfg, target):
@@ -911,7 +934,10 @@ def add_swap(cfg, target, fstab):
                         maxsize=maxsize, force=force)
 
 
-def detect_and_handle_multipath(cfg, target, osfamily=DISTROS.debian):
+def get_multipath_packages(cfg, target, osfamily=DISTROS.debian):
+    """Return a tuple of the multipath device found in target and the
+    multipath packages missing from target.  The package list is None if
+    multipath is not to be configured."""
     DEFAULT_MULTIPATH_PACKAGES = {
         DISTROS.debian: ['multipath-tools-boot'],
         DISTROS.redhat: ['device-mapper-multipath'],
@@ -924,23 +950,34 @@ def detect_and_handle_multipath(cfg, target, osfamily=DISTROS.debian):
     mpmode = mpcfg.get('mode', 'auto')
     mppkgs = mpcfg.get('packages',
                        DEFAULT_MULTIPATH_PACKAGES.get(osfamily))
-    mpbindings = mpcfg.get('overwrite_bindings', True)
 
     if isinstance(mppkgs, str):
         mppkgs = [mppkgs]
 
     if mpmode == 'disabled':
-        return
+        return None, None
 
     mp_device = block.detect_multipath(target)
     LOG.info('Multipath detection found: %s', mp_device)
     if mpmode == 'auto' and not mp_device:
-        return
+        return mp_device, None
 
     LOG.info("Detected multipath device. Installing support via %s", mppkgs)
-    needed = [pkg for pkg in mppkgs if pkg
-              not in distro.get_installed_packages(target)]
-    if needed:
+    installed = distro.get_installed_packages(target)
+    return mp_device, [pkg for pkg in mppkgs if pkg not in installed]
+
+
+def detect_and_handle_multipath(cfg, target, osfamily=DISTROS.debian,
+                                plan=None):
+    mpbindings = cfg.get('multipath', {}).get('overwrite_bindings', True)
+    if plan is not None and 'multipath' in plan.results:
+        mp_device, needed = plan.results['multipath']
+    else:
+        mp_device, needed = get_multipath_packages(cfg, target, osfamily)
+    if needed is None:
+        return
+
+    if needed and not (plan is not None and plan.installed('multipath')):
         distro.install_packages(needed, target=target, osfamily=osfamily)
 
     replace_spaces = True
@@ -1128,7 +1165,7 @@ def detect_required_packages(cfg, osfamily=DISTROS.debian):
     return needed_packages
 
 
-def install_missing_packages(cfg, target, osfamily=DISTROS.debian):
+def get_missing_packages(cfg, target, osfamily=DISTROS.debian):
     ''' describe which operation types will require specific packages
 
     'custom_config_key': {
@@ -1193,8 +1230,16 @@ def install_missing_packages(cfg, target, osfamily=DISTROS.debian):
                       needed_packages.union(drops))
             needed_packages = needed_packages.difference(drops)
 
-    if needed_packages:
-        to_add = list(sorted(needed_packages))
+    return list(sorted(needed_packages))
+
+
+def install_missing_packages(cfg, target, osfamily=DISTROS.debian,
+                             plan=None):
+    if plan is not None and plan.installed('missing'):
+        return
+
+    to_add = get_missing_packages(cfg, target, osfamily=osfamily)
+    if to_add:
         state = util.load_command_environment()
         with events.ReportEventStack(
                 name=state.get('report_stack_prefix'),
@@ -1558,6 +1603,86 @@ def redhat_update_initramfs(target, cfg):
         in_chroot.subp(dracut_cmd, capture=True)
 
 
+class PackagePlan(object):
+    """Packages needed by several builtin curthooks steps, installed in a
+    single transaction.
+
+    Each step adds the packages it would install under its own name.
+    Steps added with first=True are installed in an earlier transaction of
+    their own, for packages which must be in place before the others are
+    installed.  If a transaction succeeds, installed(step) is True for its
+    steps and they skip their own install; if it fails the remaining steps
+    install their packages as before.  Steps keep whatever they probed
+    while planning in results so they do not probe the target again.
+    """
+
+    def __init__(self):
+        self.steps = OrderedDict()
+        self.first = []
+        self.results = {}
+        self.done = set()
+
+    def add(self, step, packages, first=False):
+        self.steps[step] = list(packages)
+        if first:
+            self.first.append(step)
+
+    def packages(self, steps=None):
+        if steps is None:
+            steps = self.steps
+        packages = []
+        for step in steps:
+            packages.extend([pkg for pkg in self.steps[step]
+                             if pkg not in packages])
+        return packages
+
+    def installed(self, step):
+        return step in self.done
+
+    def install(self, target, osfamily=DISTROS.debian):
+        LOG.debug('Package plan: %s', dict(self.steps))
+        first = [step for step in self.steps if step in self.first]
+        rest = [step for step in self.steps if step not in self.first]
+        for steps in (first, rest):
+            packages = self.packages(steps)
+            if packages:
+                try:
+                    distro.install_packages(packages, target=target,
+                                            osfamily=osfamily)
+                except util.ProcessExecutionError as e:
+                    LOG.warning('Failed to install %s in one transaction, '
+                                'installing them per step: %s', packages, e)
+                    return
+            self.done.update(steps)
+
+
+def zkey_used(state):
+    """Return True if block_meta used zkey and the repository exists."""
+    used = os.path.join(os.path.split(state['fstab'])[0], "zkey_used")
+    return all(map(os.path.exists, [ZKEY_REPOSITORY, used]))
+
+
+def plan_packages(cfg, target, state, osfamily=DISTROS.debian):
+    """Return a PackagePlan of the packages the builtin curthooks install:
+    missing packages, the kernel, multipath support and zkey.  The
+    flash-kernel dependencies of the kernel are installed first."""
+    plan = PackagePlan()
+    plan.add('missing', get_missing_packages(cfg, target, osfamily=osfamily))
+    if osfamily == DISTROS.debian:
+        plan.add('flash-kernel', get_flash_kernel_deps(),
+                 first=True)
+        plan.add('kernel', [pkg for pkglist in get_kernel_packages(cfg, target)
+                            for pkg in pkglist])
+    plan.results['multipath'] = get_multipath_packages(cfg, target,
+                                                       osfamily=osfamily)
+    _mp_device, mp_packages = plan.results['multipath']
+    if mp_packages is not None:
+        plan.add('multipath', mp_packages)
+    if osfamily == DISTROS.debian and zkey_used(state):
+        plan.add('zkey', ['s390-tools-zkey'])
+    return plan
+
+
 def builtin_curthooks(cfg, target, state):
     LOG.info('Running curtin builtin curthooks')
     stack_prefix = state.get('report_stack_prefix', '')
@@ -1590,7 +1715,14 @@ def builtin_curthooks(cfg, target, state):
             name=stack_prefix + '/installing-missing-packages',
             reporting_enabled=True, level="INFO",
             description="installing missing packages"):
-        install_missing_packages(cfg, target, osfamily=osfamily)
+        if osfamily == DISTROS.debian:
+            # the kernel is installed with the other packages, these
+            # must be in place first
+            setup_zipl(cfg, target)
+            setup_kernel_img_conf(target)
+        plan = plan_packages(cfg, target, state, osfamily=osfamily)
+        plan.install(target, osfamily=osfamily)
+        install_missing_packages(cfg, target, osfamily=osfamily, plan=plan)
 
     with events.ReportEventStack(
             name=stack_prefix + '/configuring-iscsi-service',
@@ -1609,9 +1741,7 @@ def builtin_curthooks(cfg, target, state):
                 name=stack_prefix + '/installing-kernel',
                 reporting_enabled=True, level="INFO",
                 description="installing kernel"):
-            setup_zipl(cfg, target)
-            setup_kernel_img_conf(target)
-            install_kernel(cfg, target)
+            install_kernel(cfg, target, plan=plan)
             run_zipl(cfg, target)
             restore_dist_interfaces(cfg, target)
             chzdev_persist_active_online(cfg, target)
@@ -1655,7 +1785,9 @@ def builtin_curthooks(cfg, target, state):
             name=stack_prefix + '/configuring-multipath',
             reporting_enabled=True, level="INFO",
             description="configuring multipath"):
-        detect_and_handle_multipath(cfg, target, osfamily=osfamily)
+        with block.multipath.active():
+            detect_and_handle_multipath(cfg, target, osfamily=osfamily,
+                                        plan=plan)
 
     with events.ReportEventStack(
             name=stack_prefix + '/system-upgrade',
@@ -1682,12 +1814,11 @@ def builtin_curthooks(cfg, target, state):
         if os.path.exists(zpool_cache):
             copy_zpool_cache(zpool_cache, target)
 
-        zkey_repository = '/etc/zkey/repository'
-        zkey_used = os.path.join(os.path.split(state['fstab'])[0], "zkey_used")
-        if all(map(os.path.exists, [zkey_repository, zkey_used])):
-            distro.install_packages(['s390-tools-zkey'], target=target,
-                                    osfamily=osfamily)
-            copy_zkey_repository(zkey_repository, target)
+        if zkey_used(state):
+            if not plan.installed('zkey'):
+                distro.install_packages(['s390-tools-zkey'], target=target,
+                                        osfamily=osfamily)
+            copy_zkey_repository(ZKEY_REPOSITORY, target)
 
         # If a crypttab file was created by block_meta than it needs to be
         # copied onto the target system, and update_initramfs() needs to be
@@ -1768,7 +1899,14 @@ def curthooks(args):
         if util.run_hook_if_exists(target, 'curtin-hooks'):
             sys.exit(0)
 
-    builtin_curthooks(cfg, target, state)
+    # keep the target bind mounts in place for all of the builtin hooks
+    with events.ReportEventStack(
+            name=stack_prefix + '/chroot-session', reporting_enabled=True,
+            level="INFO",
+            description="sharing target bind mounts") as reportstack:
+        with util.ChrootSession(target) as session:
+            builtin_curthooks(cfg, target, state)
+        reportstack.message = session.summary()
     sys.exit(0)
 
 
@@ -1,12 +1,16 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from collections import OrderedDict
 import os
 import shutil
 import sys
 import tempfile
+import threading
 
 import curtin.config
 from curtin.log import LOG
+from curtin import parallel
+from curtin.block import image
 from curtin import util
 from curtin.futil import write_files
 from curtin.reporter import events
@@ -14,6 +18,9 @@ from curtin import url_helper
 
 from . import populate_one_subcmd
 
+# Number of layers of a remote fsimage-layered source downloaded at once
+LAYER_DOWNLOAD_WORKERS = 4
+
 CMD_ARGUMENTS = (
     ((('-t', '--target'),
       {'help': ('target directory to extract to (root) '
@@ -49,15 +56,27 @@ def extract_root_tgz_url(url, target):
                   ['-Sxpf', path, '--numeric-owner'])
         return
 
-    # Uses smtar to avoid specifying the compression type
-    util.subp(args=['sh', '-cf',
-                    ('wget "$1" --progress=dot:mega -O - |'
-                     'smtar -C "$2" ' + ' '.join(tar_xattr_opts()) +
-                     ' ' + '-Sxpf - --numeric-owner'),
-                    '--', url, target])
+    # stream the download in-process to smtar's stdin, smtar still detects
+    # the compression type
+    image.stream_to_command(url, ['smtar', '-C', target] + tar_xattr_opts() +
+                            ['-Sxpf', '-', '--numeric-owner'])
+
+
+def download_options(source):
+    """Return url_helper.download keyword arguments configured in source.
 
+    A source may set 'read_size' (bytes per read), 'segments' (number of
+    concurrent range requests) and 'checksum' ('<algorithm>:<hexdigest>').
+    """
+    opts = {}
+    for key, kwarg in (('read_size', 'buflen'), ('segments', 'segments'),
+                       ('checksum', 'checksum')):
+        if source.get(key):
+            opts[kwarg] = source[key]
+    return opts
 
-def extract_root_fsimage_url(url, target):
+
+def extract_root_fsimage_url(url, target, **download_opts):
     path = _path_from_file_url(url)
     if path != url or os.path.isfile(path):
         return _extract_root_fsimage(path, target)
@@ -65,7 +84,7 @@ def extract_root_fsimage_url(url, target):
     wfp = tempfile.NamedTemporaryFile(suffix=".img", delete=False)
     wfp.close()
     try:
-        url_helper.download(url, wfp.name, retries=3)
+        url_helper.download(url, wfp.name, retries=3, **download_opts)
         return _extract_root_fsimage(wfp.name, target)
     finally:
         os.unlink(wfp.name)
@@ -86,11 +105,12 @@ def _extract_root_fsimage(path, target):
         os.rmdir(mp)
 
 
-def extract_root_layered_fsimage_url(uri, target):
+def extract_root_layered_fsimage_url(uri, target, **download_opts):
     ''' Build images list to consider from a layered structure
 
     uri: URI of the layer file
     target: Target file system to provision
+    download_opts: keyword arguments passed to url_helper.download
 
     return: None
     '''
@@ -104,13 +124,15 @@ def extract_root_layered_fsimage_url(uri, target):
         # Download every remote images if remote url
         if url_helper.urlparse(path).scheme != "":
             tmp_dir = tempfile.mkdtemp()
-            image_stack = _download_layered_images(image_stack, tmp_dir)
+            image_urls = image_stack
+            image_stack = [os.path.join(tmp_dir, os.path.basename(img_url))
+                           for img_url in image_urls]
+            return _extract_root_layered_fsimage(
+                image_stack, target, image_urls=image_urls, **download_opts)
 
         # Check that all images exists on disk and are not empty
         for img in image_stack:
-            if not os.path.isfile(img) or os.path.getsize(img) <= 0:
-                raise ValueError("Failed to use fsimage: '%s' doesn't exist " +
-                                 "or is invalid", img)
+            _check_fsimage(img)
 
         return _extract_root_layered_fsimage(image_stack, target)
     finally:
@@ -118,34 +140,70 @@ def extract_root_layered_fsimage_url(uri, target):
             shutil.rmtree(tmp_dir)
 
 
-def _download_layered_images(image_stack, tmp_dir):
-    local_image_stack = []
-    try:
-        for img_url in image_stack:
-            dest_path = os.path.join(tmp_dir,
-                                     os.path.basename(img_url))
-            url_helper.download(img_url, dest_path, retries=3)
-            local_image_stack.append(dest_path)
-    except url_helper.UrlError as e:
-        LOG.error("Failed to download '%s'" % img_url)
-        raise e
-    return local_image_stack
+def _check_fsimage(img):
+    if not os.path.isfile(img) or os.path.getsize(img) <= 0:
+        raise ValueError("Failed to use fsimage: '%s' doesn't exist " +
+                         "or is invalid", img)
+
 
+def _extract_root_layered_fsimage(image_stack, target, image_urls=None,
+                                  max_workers=LAYER_DOWNLOAD_WORKERS,
+                                  **download_opts):
+    ''' Mount each image of image_stack, overlay them and copy to target.
 
-def _extract_root_layered_fsimage(image_stack, target):
+    image_stack: paths of the images, lowest layer first
+    target: Target file system to provision
+    image_urls: if set, image_stack[i] is first downloaded from
+                image_urls[i].  Up to max_workers layers are downloaded
+                concurrently and each layer is mounted as soon as it and
+                every lower layer are present.  If any download fails the
+                others are cancelled.
+
+    return: None
+    '''
     mp_base = tempfile.mkdtemp()
     mps = []
-    try:
-        # Create a mount point for each image file and mount the image
+    cancel = threading.Event()
+
+    # Each layer is mounted after its download (if any) and the mount of
+    # the layer below it.
+    graph = OrderedDict()
+    for i in range(len(image_stack)):
+        mount_deps = []
+        if image_urls:
+            graph[('download', i)] = []
+            mount_deps.append(('download', i))
+        if i > 0:
+            mount_deps.append(('mount', i - 1))
+        graph[('mount', i)] = mount_deps
+
+    def _handle_layer(node):
+        action, i = node
+        img = image_stack[i]
+        if action == 'download':
+            try:
+                url_helper.download(image_urls[i], img, retries=3,
+                                    cancel=cancel, **download_opts)
+            except url_helper.UrlError as e:
+                if not cancel.is_set():
+                    LOG.error("Failed to download '%s'", image_urls[i])
+                raise e
+            return
+
+        _check_fsimage(img)
+        mp = os.path.join(mp_base, os.path.basename(img) + ".dir")
+        os.mkdir(mp)
         try:
-            for img in image_stack:
-                mp = os.path.join(mp_base, os.path.basename(img) + ".dir")
-                os.mkdir(mp)
-                util.subp(['mount', '-o', 'loop,ro', img, mp], capture=True)
-                mps.insert(0, mp)
+            util.subp(['mount', '-o', 'loop,ro', img, mp], capture=True)
         except util.ProcessExecutionError as e:
             LOG.error("Failed to mount '%s' for extraction: %s", img, e)
             raise e
+        mps.insert(0, mp)
+
+    try:
+        # Create a mount point for each image file and mount the image
+        parallel.run_graph(graph, _handle_layer,
+                           max_workers=max_workers, cancel=cancel)
 
         # Prepare
         if len(mps) == 1:
@@ -248,9 +306,15 @@ def extract(args):
             if source['uri'].startswith("cp://"):
                 copy_to_target(source['uri'], target)
             elif source['type'] == "fsimage":
-                extract_root_fsimage_url(source['uri'], target=target)
+                extract_root_fsimage_url(source['uri'], target=target,
+                                         **download_options(source))
             elif source['type'] == "fsimage-layered":
-                extract_root_layered_fsimage_url(source['uri'], target=target)
+                opts = download_options(source)
+                if opts.pop('checksum', None):
+                    LOG.warning("Ignoring checksum for fsimage-layered "
+                                "source %s", source['uri'])
+                extract_root_layered_fsimage_url(source['uri'], target=target,
+                                                 **opts)
             else:
                 extract_root_tgz_url(source['uri'], target=target)
 
@@ -1,21 +1,25 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import argparse
+import collections
 from copy import deepcopy
 import json
 import os
 import re
+import select
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
-from curtin.block import iscsi, zfs
+from curtin.block import iscsi, mdadm, zfs
 from curtin import config
 from curtin import distro
 from curtin import util
 from curtin import paths
+from curtin import tracing
 from curtin import version
 from curtin.log import LOG, logged_time
 from curtin.reporter.legacy import load_reporter
@@ -28,6 +32,13 @@ ERROR_TARFILE = '/var/log/curtin/curtin-error-logs.tar'
 SAVE_INSTALL_LOG = '/root/curtin-install.log'
 SAVE_INSTALL_CONFIG = '/root/curtin-install-cfg.yaml'
 
+# Stage command output is read in chunks of STAGE_READ_SIZE, the install log
+# is flushed at most every STAGE_LOG_FLUSH_INTERVAL seconds and only the last
+# STAGE_OUTPUT_TAIL_SIZE bytes are kept for ProcessExecutionError.
+STAGE_READ_SIZE = 64 * 1024
+STAGE_LOG_FLUSH_INTERVAL = 1.0
+STAGE_OUTPUT_TAIL_SIZE = 64 * 1024
+
 INSTALL_START_MSG = ("curtin: Installation started. (%s)" %
                      version.version_string())
 INSTALL_PASS_MSG = "curtin: Installation finished."
@@ -163,6 +174,25 @@ class WorkingDir(object):
                  'CONFIG': self.config_file})
 
 
+class OutputTail(object):
+    """Bounded buffer keeping the last 'size' bytes appended to it."""
+
+    def __init__(self, size=STAGE_OUTPUT_TAIL_SIZE):
+        self.size = size
+        self._chunks = collections.deque()
+        self._length = 0
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        while (len(self._chunks) > 1 and
+               self._length - len(self._chunks[0]) >= self.size):
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return b"".join(self._chunks)[-self.size:]
+
+
 class Stage(object):
 
     def __init__(self, name, commands, env, reportstack=None, logfile=None):
@@ -202,12 +232,39 @@ class Stage(object):
         sys.stdout.flush()
 
     def write(self, data):
-        """Write data to stdout and to the install_log."""
+        """Write data to stdout and to the install_log.
+
+        The install_log is not flushed here, see flush_install_log."""
         self.write_stdout(data)
         if self.install_log is not None:
             self.install_log.write(data)
+
+    def flush_install_log(self):
+        if self.install_log is not None:
             self.install_log.flush()
 
+    def _stream_output(self, sp):
+        """Copy output of sp to stdout and install_log until EOF.
+
+        Returns an OutputTail holding the end of the output."""
+        output = OutputTail()
+        fd = sp.stdout.fileno()
+        last_flush = time.time()
+        while True:
+            ready, _, _ = select.select([fd], [], [],
+                                        STAGE_LOG_FLUSH_INTERVAL)
+            if ready:
+                data = os.read(fd, STAGE_READ_SIZE)
+                if not data:
+                    break
+                self.write(data)
+                output.append(data)
+            if time.time() - last_flush >= STAGE_LOG_FLUSH_INTERVAL:
+                self.flush_install_log()
+                last_flush = time.time()
+        self.flush_install_log()
+        return output
+
     def run(self):
         for cmdname in sorted(self.commands.keys()):
             cmd = self.commands[cmdname]
@@ -232,19 +289,14 @@ class Stage(object):
                         LOG.warn("%s command failed", cmdname)
                         raise util.ProcessExecutionError(cmd=cmd, reason=e)
 
-                    output = b""
-                    while True:
-                        data = sp.stdout.read(1)
-                        if not data and sp.poll() is not None:
-                            break
-                        self.write(data)
-                        output += data
-
-                    rc = sp.returncode
+                    output = self._stream_output(sp)
+                    sp.stdout.close()
+                    rc = sp.wait()
                     if rc != 0:
                         LOG.warn("%s command failed", cmdname)
                         raise util.ProcessExecutionError(
-                            stdout=output, stderr="",
+                            stdout=util.decode_binary(output.getvalue()),
+                            stderr="",
                             exit_code=rc, cmd=cmd)
 
 
@@ -433,6 +485,10 @@ def cmd_install(args):
 
     # Load reporter
     clear_install_log(logfile)
+    subp_ledger = instcfg.get('subp_ledger')
+    if subp_ledger:
+        util.ensure_dir(os.path.dirname(subp_ledger))
+        tracing.enable(subp_ledger)
     legacy_reporter = load_reporter(cfg)
     legacy_reporter.files = post_files
 
@@ -482,6 +538,12 @@ def cmd_install(args):
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
 
+        if workingd:
+            # undo raid resync throttling and pausing before reboot
+            mdadm.restore_sync_control(
+                os.path.join(os.path.dirname(workingd.fstab),
+                             mdadm.SYNC_CONTROL_FILE))
+
         if instcfg.get('unmount', "") == "disabled":
             LOG.info('Skipping unmount: config disabled target unmounting')
         elif workingd:
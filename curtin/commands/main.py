@@ -18,8 +18,8 @@ SUB_COMMAND_MODULES = [
     'block-discover', 'block-info', 'block-meta', 'block-wipe',
     'clear-holders', 'curthooks', 'collect-logs', 'extract', 'features',
     'hook', 'install', 'mkfs', 'in-target', 'net-meta', 'pack',
-    'schema-validate', 'swap', 'system-install', 'system-upgrade',
-    'unmount', 'version',
+    'schema-validate', 'subp-summary', 'swap', 'system-install',
+    'system-upgrade', 'unmount', 'version',
 ]
 
 
@@ -0,0 +1,64 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+"""Summarize a subprocess ledger by tool and by phase."""
+
+import json
+import sys
+
+from .. import tracing
+from . import populate_one_subcmd
+
+
+def _by_total(totals):
+    return sorted(totals.items(), key=lambda item: (-item[1]['total'],
+                                                    item[0]))
+
+
+def format_summary(summary, top=None):
+    """Return the summary as text: the tools by total time, then each phase
+    with its tools."""
+    lines = ['%-30s %6s %10s %9s %6s' % ('tool', 'count', 'total', 'max',
+                                         'failed')]
+    for tool, cur in _by_total(summary['tools'])[:top]:
+        lines.append('%-30s %6d %10.3f %9.3f %6d' % (
+            tool, cur['count'], cur['total'], cur['max'], cur['failed']))
+    lines.append('')
+    lines.append('%-60s %6s %10s' % ('phase', 'count', 'total'))
+    for phase, cur in sorted(summary['phases'].items()):
+        lines.append('%-60s %6d %10.3f' % (phase, cur['count'],
+                                           cur['total']))
+        for tool, tcur in _by_total(cur['tools'])[:top]:
+            lines.append('    %-56s %6d %10.3f' % (tool, tcur['count'],
+                                                   tcur['total']))
+    return '\n'.join(lines) + '\n'
+
+
+def subp_summary_main(args):
+    ledger = args.ledger or tracing.ledger_path()
+    if not ledger:
+        sys.stderr.write('No ledger given and %s is not set.\n' %
+                         tracing.LEDGER_ENV)
+        sys.exit(1)
+    summary = tracing.summarize(tracing.load(ledger))
+    if args.json:
+        sys.stdout.write(json.dumps(summary, indent=1, sort_keys=True) +
+                         '\n')
+    else:
+        sys.stdout.write(format_summary(summary, top=args.top))
+    sys.exit(0)
+
+
+CMD_ARGUMENTS = (
+    ('ledger', {'help': 'ledger to summarize, default is $%s' %
+                tracing.LEDGER_ENV, 'nargs': '?', 'default': None}),
+    (('-j', '--json'), {'help': 'write the summary as json',
+                        'action': 'store_true', 'default': False}),
+    (('-t', '--top'), {'help': 'list only the N slowest tools',
+                       'metavar': 'N', 'type': int, 'default': None}),
+)
+
+
+def POPULATE_SUBCMD(parser):
+    populate_one_subcmd(parser, CMD_ARGUMENTS, subp_summary_main)
+    parser.description = __doc__
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,182 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Wait for device nodes and sysfs paths to appear or go away.
+
+Paths under /dev are watched with inotify on their parent directory so a
+wait returns as soon as udev creates or removes the node.  Pseudo
+filesystems such as /sys do not emit inotify events; there, and wherever
+inotify is unavailable, the path is polled at an interval growing from
+POLL_MIN to POLL_MAX seconds.  The duration of every wait is logged and
+kept for wait_times().
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import threading
+import time
+
+from curtin.log import LOG
+
+# inotify_init1 flags and event masks from <sys/inotify.h>
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = (IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# filesystems which do not generate inotify events
+POLLED_PREFIXES = ('/sys/', '/proc/')
+POLL_MIN = 0.05
+POLL_MAX = 1.0
+# recheck a watched path this often in case an event was missed
+WATCH_RECHECK = 1.0
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+_waits_lock = threading.Lock()
+_waits = []
+
+
+class Inotify(object):
+    """Minimal inotify wrapper reporting that *something* changed in the
+    watched directories; callers recheck the state they wait for."""
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watched = set()
+
+    def watch(self, directory):
+        if directory in self.watched:
+            return
+        wd = _libc.inotify_add_watch(self.fd, directory.encode('utf-8'),
+                                     WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+        self.watched.add(directory)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events, return True if any."""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except (IOError, OSError) as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _watch_dir(path):
+    """Return the closest existing directory above path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != '/' and not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def _open_watcher(path):
+    if _libc is None or path.startswith(POLLED_PREFIXES):
+        return None
+    try:
+        return Inotify()
+    except OSError as e:
+        LOG.debug('devwait: inotify unavailable, polling %s: %s', path, e)
+        return None
+
+
+def _record(path, exists, elapsed, found):
+    with _waits_lock:
+        _waits.append({'path': path, 'exists': exists,
+                       'elapsed': elapsed, 'found': found})
+
+
+def wait_times():
+    """Return a list of dictionaries describing each wait so far."""
+    with _waits_lock:
+        return [dict(wait) for wait in _waits]
+
+
+def wait_for_path(path, exists=True, timeout=10.0):
+    """Wait until path exists (or, with exists=False, until it is gone).
+
+    Returns True as soon as the path is in the requested state, or False
+    if it is not after timeout seconds.
+    """
+    if not path:
+        raise ValueError('wait_for_path: missing path parameter')
+
+    start = time.time()
+    deadline = start + timeout
+    interval = POLL_MIN
+    watcher = _open_watcher(path)
+    try:
+        while True:
+            if watcher is not None:
+                # watch before checking so no change is missed in between
+                try:
+                    watcher.watch(_watch_dir(path))
+                except OSError as e:
+                    LOG.debug('devwait: cannot watch %s, polling: %s',
+                              path, e)
+                    watcher.close()
+                    watcher = None
+            found = os.path.exists(path) == exists
+            remaining = deadline - time.time()
+            if found or remaining <= 0:
+                break
+            if watcher is not None:
+                watcher.wait(min(remaining, WATCH_RECHECK))
+            else:
+                time.sleep(min(remaining, interval))
+                interval = min(interval * 2, POLL_MAX)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+    elapsed = time.time() - start
+    _record(path, exists, elapsed, found)
+    LOG.debug('devwait: %s %s after %.3fs', path,
+              ('not ' if not found else '') +
+              ('present' if exists else 'removed'), elapsed)
+    return found
+
+# vi: ts=4 expandtab syntax=python
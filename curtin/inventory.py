@@ -0,0 +1,235 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Snapshot of the block devices known to udev and sysfs.
+
+Inside an ``active()`` block, udev property lookups, by-id searches and
+device-mapper name lookups are answered from a single parse of
+``udevadm info --export-db`` and one walk of /sys/class/block instead of
+forking udevadm, multipath or dmsetup for every device.  The snapshot is
+taken on first use and dropped by ``invalidate()``, which udevadm_settle
+calls, so the next lookup after a settle sees the current devices.
+"""
+
+from contextlib import contextmanager
+import os
+import threading
+
+from curtin import util
+from curtin.log import LOG
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+
+# udev properties indexed for serial and wwn lookups
+SERIAL_KEYS = ('ID_SERIAL', 'ID_SERIAL_SHORT', 'ID_SCSI_SERIAL')
+WWN_KEYS = ('ID_WWN', 'ID_WWN_WITH_EXTENSION')
+
+
+def parse_export_db(output, subsystem='block'):
+    """Parse 'udevadm info --export-db' output.
+
+    Returns a list of property dictionaries, one per device of subsystem
+    (all devices if subsystem is None).  DEVLINKS is a list, as returned by
+    udev.udevadm_info.
+    """
+    devices = []
+    for record in output.split('\n\n'):
+        props = {}
+        for line in record.splitlines():
+            if not line.startswith('E: '):
+                continue
+            key, _, value = line[3:].partition('=')
+            if not value:
+                continue
+            if key == 'DEVLINKS':
+                props[key] = value.split()
+            elif ' ' in value and key != 'ID_SERIAL':
+                # as udevadm_info splits other values with spaces
+                props[key] = value.split()
+            else:
+                props[key] = value
+        if not props:
+            continue
+        if subsystem is None or props.get('SUBSYSTEM') == subsystem:
+            devices.append(props)
+    return devices
+
+
+def _read_int(path):
+    try:
+        return int(util.load_file(path).strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _read_str(path):
+    try:
+        return util.load_file(path).strip()
+    except (IOError, OSError):
+        return None
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except (IOError, OSError):
+        return []
+
+
+def walk_sysfs(sysfs_root=SYS_CLASS_BLOCK):
+    """Return a dictionary of kname to size (bytes), partition number,
+    parent kname (partitions only), holders, slaves and device-mapper uuid
+    (device-mapper devices only)."""
+    devices = {}
+    for kname in _listdir(sysfs_root):
+        path = os.path.join(sysfs_root, kname)
+        partition = _read_int(os.path.join(path, 'partition'))
+        parent = None
+        if partition:
+            parent = os.path.basename(
+                os.path.dirname(os.path.realpath(path)))
+        size = _read_int(os.path.join(path, 'size'))
+        devices[kname] = {
+            'size': None if size is None else size * 512,
+            'partition': partition,
+            'parent': parent,
+            'holders': _listdir(os.path.join(path, 'holders')),
+            'slaves': _listdir(os.path.join(path, 'slaves')),
+            'dm_uuid': _read_str(os.path.join(path, 'dm', 'uuid')),
+        }
+    return devices
+
+
+class DeviceInventory(object):
+    """Indexes of udev properties and sysfs data for all block devices."""
+
+    def __init__(self, devices, sysfs=None):
+        self.sysfs = sysfs or {}
+        self.devices = {}
+        self.by_path = {}
+        self.by_serial = {}
+        self.by_wwn = {}
+        self.by_dm_name = {}
+        for props in devices:
+            devname = props.get('DEVNAME')
+            if not devname:
+                continue
+            kname = os.path.basename(devname)
+            self.devices[kname] = props
+            self.by_path[devname] = kname
+            for devlink in props.get('DEVLINKS', []):
+                self.by_path[devlink] = kname
+            if props.get('DEVPATH'):
+                self.by_path['/sys' + props['DEVPATH']] = kname
+            self.by_path[os.path.join(SYS_CLASS_BLOCK, kname)] = kname
+            for keys, index in ((SERIAL_KEYS, self.by_serial),
+                                (WWN_KEYS, self.by_wwn)):
+                for key in keys:
+                    if props.get(key):
+                        index.setdefault(props[key], []).append(kname)
+            if props.get('DM_NAME'):
+                self.by_dm_name[props['DM_NAME']] = kname
+
+    @classmethod
+    def from_system(cls):
+        out, _ = util.subp(['udevadm', 'info', '--export-db'], capture=True)
+        inventory = cls(parse_export_db(out), walk_sysfs())
+        LOG.debug('inventory: snapshot of %d block devices',
+                  len(inventory.devices))
+        return inventory
+
+    def kname(self, path):
+        """Return the kname of a /dev path, devlink, sysfs path or kname."""
+        kname = self.by_path.get(os.path.normpath(path))
+        if kname is None and path in self.devices:
+            kname = path
+        return kname
+
+    def info(self, path):
+        """Return a copy of the udev properties of path, None if unknown."""
+        props = self.devices.get(self.kname(path))
+        if props is None:
+            return None
+        info = dict(props)
+        if 'DEVLINKS' in info:
+            info['DEVLINKS'] = list(info['DEVLINKS'])
+        return info
+
+    def devnames(self, serial=None, wwn=None):
+        """Return /dev paths of devices with the serial or wwn given."""
+        knames = []
+        if serial:
+            knames.extend(self.by_serial.get(serial, []))
+        if wwn:
+            knames.extend(self.by_wwn.get(wwn, []))
+        return [self.devices[kname]['DEVNAME'] for kname in knames]
+
+    def devlinks(self, prefix):
+        """Return a dictionary of devlinks starting with prefix to the
+        /dev path of their device."""
+        return dict((link, self.devices[kname]['DEVNAME'])
+                    for link, kname in self.by_path.items()
+                    if link.startswith(prefix))
+
+    def dm_name_mapping(self):
+        """Return a dictionary of DM_NAME to /dev/dm-X paths."""
+        return dict((name, self.devices[kname]['DEVNAME'])
+                    for name, kname in self.by_dm_name.items())
+
+    def mpath_holder(self, path):
+        """Return the DM_NAME of the multipath map holding path, if any."""
+        for holder in self.holders(self.kname(path)):
+            props = self.devices.get(holder, {})
+            if props.get('DM_UUID', '').startswith('mpath-'):
+                return props.get('DM_NAME')
+        return None
+
+    def holders(self, kname):
+        return list(self.sysfs.get(kname, {}).get('holders', []))
+
+    def slaves(self, kname):
+        return list(self.sysfs.get(kname, {}).get('slaves', []))
+
+
+_lock = threading.RLock()
+_state = {'depth': 0, 'inventory': None}
+
+
+@contextmanager
+def active():
+    """Answer device lookups from a snapshot inside this block."""
+    with _lock:
+        _state['depth'] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _state['depth'] -= 1
+            if not _state['depth']:
+                _state['inventory'] = None
+
+
+def invalidate():
+    """Drop the current snapshot, the next lookup takes a new one."""
+    with _lock:
+        _state['inventory'] = None
+
+
+def current():
+    """Return the DeviceInventory snapshot, or None outside of active()."""
+    with _lock:
+        if not _state['depth']:
+            return None
+        if _state['inventory'] is None:
+            _state['inventory'] = DeviceInventory.from_system()
+        return _state['inventory']
+
+
+def udevadm_info(path):
+    """Return the udev properties of path from the snapshot, or None if
+    there is no active snapshot or it does not know path."""
+    inventory = current()
+    if inventory is None:
+        return None
+    return inventory.info(path)
+
+# vi: ts=4 expandtab syntax=python
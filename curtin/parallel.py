@@ -0,0 +1,90 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Helpers for running independent pieces of work on a bounded set of
+threads.  Only the standard threading module is used so that this works
+with both python2.7 and python3."""
+
+from collections import OrderedDict
+import threading
+
+from curtin.log import LOG
+
+
+def run_graph(graph, func, max_workers=1, cancel=None):
+    """Call func(node) for each node in graph, honoring dependencies.
+
+    :param graph: an OrderedDict mapping a node to an iterable of nodes
+                  which must have completed before it may be started.
+    :param func: callable invoked with a single node as argument.
+    :param max_workers: maximum number of nodes to run concurrently.
+    :param cancel: optional threading.Event which is set on the first
+                   failure so that long running nodes can stop early.
+
+    Nodes whose dependencies are satisfied are started in the order they
+    appear in graph.  With max_workers=1 the graph is executed serially
+    in insertion order.  After the first failure no further nodes are
+    started; nodes already running are allowed to finish and the first
+    exception raised is re-raised to the caller.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be >= 1, got %s' % max_workers)
+
+    pending = OrderedDict()
+    for node, deps in graph.items():
+        deps = set(deps)
+        unknown = deps.difference(graph)
+        if unknown:
+            raise ValueError('Node %s depends on unknown nodes: %s' %
+                             (node, sorted(unknown)))
+        pending[node] = deps
+
+    cond = threading.Condition()
+    running = set()
+    done = set()
+    errors = []
+
+    def _run(node):
+        try:
+            func(node)
+        # a worker thread must not die silently, e.g. on SystemExit,
+        # the error is re-raised in the caller's thread
+        except BaseException as error:
+            with cond:
+                errors.append(error)
+            if cancel is not None:
+                cancel.set()
+        else:
+            with cond:
+                done.add(node)
+        finally:
+            with cond:
+                running.discard(node)
+                cond.notify()
+
+    with cond:
+        while pending or running:
+            if not errors:
+                for node, deps in list(pending.items()):
+                    if len(running) >= max_workers:
+                        break
+                    if deps.issubset(done):
+                        del pending[node]
+                        running.add(node)
+                        thread = threading.Thread(target=_run, args=(node,))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            cond.wait()
+
+    if errors:
+        if pending:
+            LOG.debug('Cancelled %s pending items after failure: %s',
+                      len(pending), list(pending.keys()))
+        raise errors[0]
+
+    if pending:
+        raise ValueError('Dependency cycle detected among: %s' %
+                         list(pending.keys()))
+
+# vi: ts=4 expandtab syntax=python
@@ -7,7 +7,8 @@ The reporting framework is intended to allow all parts of cloud-init to
 report events in a structured manner.
 """
 import base64
-import os.path
+import os
+import threading
 import time
 
 from . import instantiated_handler_registry
@@ -18,6 +19,9 @@ RESULT_EVENT_TYPE = 'result'
 
 DEFAULT_EVENT_ORIGIN = 'curtin'
 
+# names of the ReportEventStacks entered in each thread
+_entered = threading.local()
+
 
 class _nameset(set):
     def __getattr__(self, name):
@@ -79,11 +83,14 @@ class FinishReportingEvent(ReportingEvent):
         return '{0}: {1}: {2}: {3}'.format(
             self.event_type, self.name, self.result, self.description)
 
-    def as_dict(self):
-        """The event represented as json friendly."""
+    def as_dict(self, files=True):
+        """The event represented as json friendly.
+
+        With files=False the content of post_files is left out, for
+        handlers which stream it (see curtin.reporter.upload)."""
         data = super(FinishReportingEvent, self).as_dict()
         data['result'] = self.result
-        if self.post_files:
+        if files and self.post_files:
             data['files'] = _collect_file_info(self.post_files)
         return data
 
@@ -197,6 +204,7 @@ class ReportEventStack(object):
 
     def __enter__(self):
         self.result = status.SUCCESS
+        _entered_stacks().append(self.fullname)
         if self.reporting_enabled:
             report_start_event(self.fullname, self.description,
                                level=self.level)
@@ -239,6 +247,9 @@ class ReportEventStack(object):
         return self._childrens_finish_info()
 
     def __exit__(self, exc_type, exc_value, traceback):
+        stacks = _entered_stacks()
+        if self.fullname in stacks:
+            del stacks[len(stacks) - 1 - stacks[::-1].index(self.fullname)]
         (result, msg) = self._finish_info(exc_value)
         if self.parent:
             self.parent.children[self.name] = (result, msg)
@@ -247,6 +258,21 @@ class ReportEventStack(object):
                                 post_files=self.post_files, level=self.level)
 
 
+def _entered_stacks():
+    if not hasattr(_entered, 'stacks'):
+        _entered.stacks = []
+    return _entered.stacks
+
+
+def current_stack_name():
+    """Return the full name of the innermost ReportEventStack entered in
+    this thread, else the stack this process was started under."""
+    stacks = _entered_stacks()
+    if stacks:
+        return stacks[-1]
+    return os.environ.get('CURTIN_REPORTSTACK') or None
+
+
 def _collect_file_info(files):
     if not files:
         return None
@@ -1,8 +1,17 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import abc
+import atexit
+import collections
+import json
+import os
+import threading
+import time
 
 from .registry import DictRegistry
+from . import profile
+from . import upload
+from .. import tracing
 from .. import url_helper
 from .. import log as logging
 
@@ -53,9 +62,28 @@ class PrintHandler(ReportingHandler):
 
 
 class WebHookHandler(ReportingHandler):
+    """Post events as json to an endpoint.
+
+    In the default 'sync' mode every event is posted before publish_event
+    returns.  In 'async' mode events are queued (at most queue_size) and
+    posted by a worker thread, up to batch_size events in one json list.
+    If the endpoint rejects a list, events are posted one at a time from
+    then on.  The queue is flushed, waiting at most flush_timeout seconds,
+    when the top-level stack of the process finishes and at exit.
+
+    post_files of finish events larger than post_files_max_size bytes are
+    cut to their tail and post_files_compress gzips them.  With
+    post_files_stream they are read from disk while the event is posted
+    instead of before.
+    """
+    # http status codes meaning the endpoint does not accept a list
+    BATCH_REJECTED = (400, 404, 405, 413, 415, 422)
+
     def __init__(self, endpoint, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None, timeout=None,
-                 retries=None, level="DEBUG"):
+                 retries=None, level="DEBUG", mode="sync", queue_size=1000,
+                 batch_size=1, flush_timeout=30, post_files_max_size=None,
+                 post_files_compress=False, post_files_stream=False):
         super(WebHookHandler, self).__init__()
 
         self.oauth_helper = url_helper.OauthUrlHelper(
@@ -70,15 +98,211 @@ class WebHookHandler(ReportingHandler):
             LOG.warn("invalid level '%s', using WARN", level)
             self.level = logging.WARN
         self.headers = {'Content-Type': 'application/json'}
+        if mode not in ('sync', 'async'):
+            LOG.warn("invalid webhook mode '%s', using sync", mode)
+            mode = 'sync'
+        self.mode = mode
+        self.queue_size = max(1, int(queue_size))
+        self.batch_size = max(1, int(batch_size))
+        self.flush_timeout = flush_timeout
+        self.post_files_max_size = post_files_max_size
+        self.post_files_compress = post_files_compress
+        self.post_files_stream = post_files_stream
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._worker = None
+        self.dropped = 0
 
     def publish_event(self, event):
+        if self.mode == 'async':
+            self._enqueue(event)
+            if self._is_toplevel_finish(event):
+                self.flush()
+            return
         try:
             return self.oauth_helper.geturl(
-                url=self.endpoint, data=event.as_dict(),
+                url=self.endpoint, data=self._event_data(event),
                 headers=self.headers, retries=self.retries)
         except Exception as e:
             LOG.warn("failed posting event: %s [%s]" % (event.as_string(), e))
 
+    def _event_data(self, event):
+        """Return the event dictionary, or if it has post_files its json,
+        or with post_files_stream a function streaming its json."""
+        post_files = getattr(event, 'post_files', None)
+        if not post_files:
+            return event.as_dict()
+        body = upload.json_event(event.as_dict(files=False), post_files,
+                                 max_size=self.post_files_max_size,
+                                 compress=self.post_files_compress)
+        if self.post_files_stream:
+            return body
+        return b''.join(body())
+
+    @staticmethod
+    def _is_toplevel_finish(event):
+        if event.event_type != 'finish':
+            return False
+        toplevel = os.environ.get('CURTIN_REPORTSTACK')
+        if toplevel:
+            return event.name == toplevel
+        return '/' not in event.name
+
+    def _start_worker(self):
+        # called with self._cond held
+        if self._worker is not None and self._worker.is_alive():
+            return
+        if self._worker is None:
+            atexit.register(self.flush)
+        self._worker = threading.Thread(target=self._run,
+                                        name='webhook-reporter')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _enqueue(self, event):
+        # the event may change once published, queue what it is now
+        item = (self._event_data(event), event.as_string())
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                self._start_worker()
+                self._cond.wait(self.flush_timeout)
+                if len(self._queue) >= self.queue_size:
+                    self.dropped += 1
+                    LOG.warn("webhook queue full, dropping event: %s",
+                             item[1])
+                    return
+            self._queue.append(item)
+            self._start_worker()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch = [self._queue.popleft() for _ in
+                         range(min(self.batch_size, len(self._queue)))]
+                self._inflight = len(batch)
+                self._cond.notify_all()
+            try:
+                self._post(batch)
+            finally:
+                with self._cond:
+                    self._inflight = 0
+                    self._cond.notify_all()
+
+    def _post(self, batch):
+        # events with post_files are posted on their own
+        if len(batch) > 1 and all(isinstance(d, dict) for d, _ in batch):
+            try:
+                self.oauth_helper.geturl(
+                    url=self.endpoint,
+                    data=json.dumps([data for data, _ in batch]).encode(),
+                    headers=self.headers, retries=self.retries)
+                return
+            except url_helper.UrlError as e:
+                if e.code not in self.BATCH_REJECTED:
+                    LOG.warn("failed posting %d events [%s]", len(batch), e)
+                    return
+                LOG.debug("endpoint rejected a batch of events (%s), "
+                          "posting events one at a time", e.code)
+                self.batch_size = 1
+            except Exception as e:
+                LOG.warn("failed posting %d events [%s]", len(batch), e)
+                return
+        for data, desc in batch:
+            try:
+                self.oauth_helper.geturl(
+                    url=self.endpoint, data=data,
+                    headers=self.headers, retries=self.retries)
+            except Exception as e:
+                LOG.warn("failed posting event: %s [%s]" % (desc, e))
+
+    def flush(self, timeout=None):
+        """Wait until queued events are posted or timeout seconds (default
+        flush_timeout) have passed.  Return True if nothing is pending."""
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._queue or self._inflight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    LOG.warn("webhook flush timed out with %d events "
+                             "pending", len(self._queue) + self._inflight)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+class ProfileHandler(ReportingHandler):
+    """Record the wall, cpu and subprocess time of every report stack.
+
+    Frames are appended to <path>.frames.jsonl, which all curtin commands of
+    an install share.  When the outermost stack finishes the collapsed stack
+    file <path>.folded and the Chrome trace <path>.trace.json are written,
+    see curtin.reporter.profile.  cpu time is that of the whole process and
+    its reaped children, so frames run in parallel threads overlap.
+    """
+
+    def __init__(self, path="/var/log/curtin/profile", level="DEBUG"):
+        super(ProfileHandler, self).__init__()
+        self.path = path
+        self.level = level
+        self._started = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _counters(timestamp):
+        times = os.times()
+        return {'wall': timestamp, 'cpu': sum(times[:4]),
+                'subp': tracing.subp_seconds()}
+
+    def _append(self, frame, truncate=False):
+        frames = self.path + profile.FRAMES_SUFFIX
+        try:
+            if not os.path.isdir(os.path.dirname(frames) or '.'):
+                os.makedirs(os.path.dirname(frames))
+            with open(frames, 'w' if truncate else 'a') as fp:
+                if frame:
+                    fp.write(json.dumps(frame, sort_keys=True) + '\n')
+        except (IOError, OSError) as e:
+            LOG.warn("failed writing profile %s: %s", frames, e)
+
+    def publish_event(self, event):
+        if event.event_type not in ('start', 'finish'):
+            return
+        outermost = '/' not in event.name
+        key = (threading.current_thread().ident, event.name)
+        if event.event_type == 'start':
+            if outermost:
+                self._append(None, truncate=True)
+            with self._lock:
+                self._started.setdefault(key, []).append(
+                    self._counters(event.timestamp))
+            return
+
+        with self._lock:
+            started = self._started.get(key)
+            if not started:
+                return
+            start = started.pop()
+            if not started:
+                del self._started[key]
+        end = self._counters(event.timestamp)
+        self._append({
+            'name': event.name, 'pid': os.getpid(), 'tid': key[0],
+            'start': start['wall'], 'result': getattr(event, 'result', None),
+            'wall': end['wall'] - start['wall'],
+            'cpu': end['cpu'] - start['cpu'],
+            'subp': end['subp'] - start['subp']})
+        if outermost:
+            try:
+                profile.write_outputs(self.path)
+            except (IOError, OSError) as e:
+                LOG.warn("failed writing profile %s: %s", self.path, e)
+
 
 class JournaldHandler(ReportingHandler):
 
@@ -121,6 +345,7 @@ available_handlers = DictRegistry()
 available_handlers.register_item('log', LogHandler)
 available_handlers.register_item('print', PrintHandler)
 available_handlers.register_item('webhook', WebHookHandler)
+available_handlers.register_item('profile', ProfileHandler)
 # only add journald handler on systemd systems
 try:
     available_handlers.register_item('journald', JournaldHandler)
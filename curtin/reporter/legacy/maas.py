@@ -1,10 +1,10 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from curtin import url_helper
+from curtin.reporter import upload
 
 from . import (BaseReporter, LoadReporterException)
 
-import mimetypes
 import os.path
 import random
 import string
@@ -24,6 +24,9 @@ class MAASReporter(BaseReporter):
             skew_data_file="/run/oauth_skew.json")
         self.files = []
         self.retries = config.get('retries', [1, 1, 2, 4, 8, 16, 32])
+        self.post_files_max_size = config.get('post_files_max_size')
+        self.post_files_compress = config.get('post_files_compress', False)
+        self.post_files_stream = config.get('post_files_stream', False)
 
     def report_success(self):
         """Report installation success."""
@@ -40,26 +43,23 @@ class MAASReporter(BaseReporter):
         """Create a MIME multipart payload from L{data} and L{files}.
 
         @param data: A mapping of names (ASCII strings) to data (byte string).
-        @param files: A mapping of names (ASCII strings) to file objects ready
-            to be read.
-        @return: A 2-tuple of C{(body, headers)}, where C{body} is a a byte
-            string and C{headers} is a dict of headers to add to the enclosing
-            request in which this payload will travel.
+        @param files: A mapping of names (ASCII strings) to paths of files.
+        @return: A 2-tuple of C{(body, headers)}, where C{body} is a byte
+            string, or with post_files_stream a function returning the
+            payload as an iterable of byte strings, and C{headers} is a dict
+            of headers to add to the enclosing request in which this payload
+            will travel.
         """
         boundary = self._random_string(30)
-
-        lines = []
-        for name in data:
-            lines.extend(self._encode_field(name, data[name], boundary))
-        for name in files:
-            lines.extend(self._encode_file(name, files[name], boundary))
-        lines.extend(('--%s--' % boundary, ''))
-        body = '\r\n'.join(lines)
-
+        body = upload.multipart(data, files, boundary,
+                                max_size=self.post_files_max_size,
+                                compress=self.post_files_compress)
         headers = {
             'content-type': 'multipart/form-data; boundary=' + boundary,
-            'content-length': "%d" % len(body),
         }
+        if not self.post_files_stream:
+            body = b''.join(body())
+            headers['content-length'] = "%d" % len(body)
         return body, headers
 
     def report(self, status, message=None, files=None):
@@ -74,15 +74,13 @@ class MAASReporter(BaseReporter):
             files = []
         install_files = {}
         for fpath in files:
-            install_files[os.path.basename(fpath)] = open(fpath, "r")
+            if os.path.isfile(fpath):
+                install_files[os.path.basename(fpath)] = fpath
 
         data, headers = self.encode_multipart_data(params, install_files)
 
         msg = ""
 
-        if not isinstance(data, bytes):
-            data = data.encode()
-
         try:
             payload = self.urlhelper.geturl(
                 self.url, data=data, headers=headers,
@@ -98,30 +96,10 @@ class MAASReporter(BaseReporter):
 
         sys.stderr.write("%s\n" % msg)
 
-    def _encode_field(self, field_name, data, boundary):
-        return (
-            '--' + boundary,
-            'Content-Disposition: form-data; name="%s"' % field_name,
-            '', str(data),
-            )
-
-    def _encode_file(self, name, fileObj, boundary):
-        return (
-            '--' + boundary,
-            'Content-Disposition: form-data; name="%s"; filename="%s"'
-            % (name, name),
-            'Content-Type: %s' % self._get_content_type(name),
-            '',
-            fileObj.read(),
-            )
-
     def _random_string(self, length):
         return ''.join(random.choice(string.ascii_letters)
                        for ii in range(length + 1))
 
-    def _get_content_type(self, filename):
-        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-
 
 def load_factory(options):
     try:
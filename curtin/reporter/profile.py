@@ -0,0 +1,97 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Render the frames recorded by the 'profile' reporting handler.
+
+Each finished ReportEventStack is one frame: its full name, process and
+thread, start time and the wall, cpu and subprocess seconds it took.  Frames
+of all curtin commands of an install are appended to one json-lines file;
+their names place them in a single tree (cmd-install/stage-partitioning/
+cmd-block-meta/...).  From the frames this module writes:
+
+ - a collapsed stack file, one 'root;child;leaf <microseconds>' line per
+   frame name, for flamegraph.pl, speedscope or inferno.  The time a frame
+   spent running subprocesses outside its children is a '[subprocess]' leaf.
+ - a Chrome trace-event json file for chrome://tracing or Perfetto.
+"""
+
+import json
+
+FRAMES_SUFFIX = '.frames.jsonl'
+FOLDED_SUFFIX = '.folded'
+TRACE_SUFFIX = '.trace.json'
+SUBPROCESS_FRAME = '[subprocess]'
+
+
+def load_frames(path):
+    frames = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                frames.append(json.loads(line))
+            except ValueError:
+                pass
+    return frames
+
+
+def _parent(name):
+    return name.rpartition('/')[0]
+
+
+def collapsed_stacks(frames):
+    """Return collapsed stack lines of the self time of each frame name."""
+    totals = {}
+    for frame in frames:
+        cur = totals.setdefault(frame['name'], {'wall': 0.0, 'subp': 0.0,
+                                                'child_wall': 0.0,
+                                                'child_subp': 0.0})
+        cur['wall'] += frame['wall']
+        cur['subp'] += frame['subp']
+    for name, cur in totals.items():
+        parent = totals.get(_parent(name))
+        if parent is not None:
+            parent['child_wall'] += cur['wall']
+            parent['child_subp'] += cur['subp']
+
+    lines = []
+    for name in sorted(totals):
+        cur = totals[name]
+        stack = ';'.join(part.replace(';', ':') for part in name.split('/'))
+        # children run in parallel may add up to more than the parent
+        self_wall = max(cur['wall'] - cur['child_wall'], 0.0)
+        self_subp = min(max(cur['subp'] - cur['child_subp'], 0.0), self_wall)
+        for frame, seconds in ((stack, self_wall - self_subp),
+                               (stack + ';' + SUBPROCESS_FRAME, self_subp)):
+            usecs = int(round(seconds * 1e6))
+            if usecs > 0:
+                lines.append('%s %d' % (frame, usecs))
+    return lines
+
+
+def chrome_trace(frames):
+    """Return a Chrome trace-event dictionary of complete events."""
+    events = []
+    for frame in sorted(frames, key=lambda f: f['start']):
+        events.append({
+            'name': frame['name'].rpartition('/')[2],
+            'cat': 'curtin',
+            'ph': 'X',
+            'ts': int(frame['start'] * 1e6),
+            'dur': int(frame['wall'] * 1e6),
+            'pid': frame['pid'],
+            'tid': frame['tid'],
+            'args': {'name': frame['name'], 'cpu': frame['cpu'],
+                     'subprocess': frame['subp'],
+                     'result': frame.get('result')},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_outputs(path):
+    """Write path.folded and path.trace.json from path.frames.jsonl."""
+    frames = load_frames(path + FRAMES_SUFFIX)
+    with open(path + FOLDED_SUFFIX, 'w') as fp:
+        fp.write(''.join(line + '\n' for line in collapsed_stacks(frames)))
+    with open(path + TRACE_SUFFIX, 'w') as fp:
+        json.dump(chrome_trace(frames), fp)
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,184 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Stream post_files to a reporting endpoint.
+
+Files are read from disk in CHUNK_SIZE pieces while the request body is
+sent, so uploading large logs does not hold them in memory.  A file larger
+than max_size is sent as its last max_size bytes, preceded by a line saying
+so.  With compress, each file is gzip compressed before it is encoded.
+
+The body generators are wrapped in a function returning a new generator,
+which url_helper.geturl calls for each attempt.  The function's length is
+the size of the body when it is known in advance, that is without
+compression; geturl sends it as Content-Length and otherwise uses chunked
+transfer encoding.  The window of each file is fixed when the body is
+created, so a log growing while it is sent does not change the length.
+"""
+
+import base64
+import json
+import mimetypes
+import os
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+TRUNCATED_MARKER = ('[curtin: %s truncated, showing the last %d of %d '
+                    'bytes]\n')
+
+
+def file_window(path, max_size=None):
+    """Return (offset, size) of the part of path to send."""
+    size = os.path.getsize(path)
+    if max_size is not None and size > max_size:
+        return size - max_size, size
+    return 0, size
+
+
+def _marker(path, offset, size):
+    return (TRUNCATED_MARKER % (path, size - offset, size)).encode()
+
+
+def file_length(path, max_size=None, window=None):
+    """Return the number of bytes read_file yields without compression."""
+    offset, size = window or file_window(path, max_size)
+    return (len(_marker(path, offset, size)) if offset else 0) + size - offset
+
+
+def read_file(path, max_size=None, compress=False, chunk_size=CHUNK_SIZE,
+              window=None):
+    """Yield the content of path in chunks of bytes.  window is the
+    (offset, size) of path to read, by default from file_window."""
+    offset, size = window or file_window(path, max_size)
+    compressor = None
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def emit(buf):
+        if compressor is None:
+            return buf
+        return compressor.compress(buf)
+
+    if offset:
+        yield emit(_marker(path, offset, size))
+    remaining = size - offset
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        while remaining > 0:
+            buf = fp.read(min(chunk_size, remaining))
+            if not buf:
+                break
+            remaining -= len(buf)
+            out = emit(buf)
+            if out:
+                yield out
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def b64encode_chunks(chunks):
+    """Base64 encode an iterable of bytes, yielding encoded bytes."""
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        usable = len(pending) - len(pending) % 3
+        if usable:
+            yield base64.b64encode(pending[:usable])
+            pending = pending[usable:]
+    if pending:
+        yield base64.b64encode(pending)
+
+
+def file_info(path, max_size=None, compress=False, window=None):
+    """Return the json event description of path, without its content."""
+    info = {'path': path,
+            'encoding': 'gzip+base64' if compress else 'base64'}
+    if os.path.isfile(path):
+        offset, size = window or file_window(path, max_size)
+        info['size'] = size
+        info['truncated'] = bool(offset)
+    return info
+
+
+def _body(pieces, read, length):
+    """Return a function generating the body made of pieces, which are
+    bytes or the (path, window) of a file whose content is read(path,
+    window).  Its length is the size of the body, or None if length(path,
+    window) is None for a file."""
+
+    def generate():
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                yield piece
+                continue
+            for chunk in read(*piece):
+                yield chunk
+
+    sizes = [len(piece) if isinstance(piece, bytes) else length(*piece)
+             for piece in pieces]
+    generate.length = None if None in sizes else sum(sizes)
+    return generate
+
+
+def json_event(data, files, max_size=None, compress=False):
+    """Return a function generating the json of event dictionary data with
+    the content of files streamed into its 'files' list, as
+    FinishReportingEvent.as_dict would include them."""
+    head = json.dumps(data)
+    pieces = [(head[:-1] + (', ' if data else '') + '"files": [').encode()]
+    for index, path in enumerate(files):
+        window = file_window(path, max_size) if os.path.isfile(path) else None
+        info = json.dumps(file_info(path, max_size, compress, window=window))
+        pieces.append(((', ' if index else '') + info[:-1] +
+                       ', "content": ').encode())
+        if window is None:
+            pieces.append(b'null}')
+            continue
+        pieces.extend([b'"', (path, window), b'"}'])
+    pieces.append(b']}')
+
+    def read(path, window):
+        return b64encode_chunks(read_file(path, compress=compress,
+                                          window=window))
+
+    def length(path, window):
+        if compress:
+            return None
+        return 4 * ((file_length(path, window=window) + 2) // 3)
+
+    return _body(pieces, read, length)
+
+
+def multipart(fields, files, boundary, max_size=None, compress=False):
+    """Return a function generating a multipart/form-data body of the
+    fields dictionary and the files, a dictionary of names to paths."""
+
+    def part(headers):
+        return ('--%s\r\n%s\r\n\r\n' % (boundary, '\r\n'.join(headers))
+                ).encode()
+
+    pieces = []
+    for name, value in fields.items():
+        pieces.append(part(['Content-Disposition: form-data; name="%s"' %
+                            name]))
+        pieces.append(str(value).encode() + b'\r\n')
+    for name, path in files.items():
+        filename = name
+        ctype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if compress:
+            filename += '.gz'
+            ctype = 'application/gzip'
+        pieces.append(part(['Content-Disposition: form-data; name="%s"; '
+                            'filename="%s"' % (filename, filename),
+                            'Content-Type: %s' % ctype]))
+        pieces.extend([(path, file_window(path, max_size)), b'\r\n'])
+    pieces.append(('--%s--\r\n' % boundary).encode())
+
+    def read(path, window):
+        return read_file(path, compress=compress, window=window)
+
+    def length(path, window):
+        return None if compress else file_length(path, window=window)
+
+    return _body(pieces, read, length)
+
+# vi: ts=4 expandtab syntax=python
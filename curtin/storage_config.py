@@ -1,6 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 from collections import namedtuple, OrderedDict
 import copy
+import logging
 import operator
 import os
 import re
@@ -102,13 +103,44 @@ def load_and_validate(config_path):
     return validate_config(config.get('storage'), sourcefile=config_path)
 
 
+# jsonschema validators by schema name, jsonschema.validate would check the
+# schema itself on every call
+_validators = {}
+
+
+def _validate(instance, schema):
+    """jsonschema.validate with the validator of schema built once."""
+    import jsonschema
+    validator = _validators.get(schema['name'])
+    if validator is None:
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = _validators.setdefault(schema['name'], cls(schema))
+    error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
 def validate_config(config, sourcefile=None):
     """Validate storage config object."""
     if not sourcefile:
         sourcefile = ''
     try:
         import jsonschema
-        jsonschema.validate(config, STORAGE_CONFIG_SCHEMA)
+        # a single item of a known type can only match the schema of that
+        # type, check it directly rather than against the whole config
+        stype = None
+        if isinstance(config, dict) and 'config' not in config:
+            stype = STORAGE_CONFIG_TYPES.get(config.get('type'))
+        if stype:
+            try:
+                _validate(config, stype.schema)
+            except jsonschema.exceptions.ValidationError as f:
+                msg = "%s in %s\n%s" % (f.message, sourcefile,
+                                        util.json_dumps(config))
+                raise ValueError(msg)
+            return
+        _validate(config, STORAGE_CONFIG_SCHEMA)
     except ImportError:
         LOG.error('Cannot validate storage config, missing jsonschema')
         raise
@@ -122,10 +154,10 @@ def validate_config(config, sourcefile=None):
             raise ValueError(msg)
 
         instance_type = e.instance['type']
-        stype = get_storage_types().get(instance_type)
+        stype = STORAGE_CONFIG_TYPES.get(instance_type)
         if stype:
             try:
-                jsonschema.validate(e.instance, stype.schema)
+                _validate(e.instance, stype.schema)
             except jsonschema.exceptions.ValidationError as f:
                 msg = "%s in %s\n%s" % (f.message, sourcefile,
                                         util.json_dumps(e.instance))
@@ -159,7 +191,7 @@ def _stype_to_deps(stype):
         'dasd': set(),
         'disk': set(),
         'dm_crypt': {'volume'},
-        'format': {'volume'},
+        'format': {'volume', 'journal_device'},
         'lvm_partition': {'volgroup'},
         'lvm_volgroup': {'devices'},
         'mount': {'device'},
@@ -293,6 +325,28 @@ def find_item_dependencies(item_id, config, validate=True):
     return deps
 
 
+def find_item_disks(item_id, sconfig):
+    """ Return the sorted ids of the disk items item_id is built on."""
+    disks = set()
+    seen = set()
+    todo = [item_id]
+    while todo:
+        cur = todo.pop()
+        if cur in seen or cur not in sconfig:
+            continue
+        seen.add(cur)
+        item_type = sconfig[cur].get('type')
+        if item_type == 'disk':
+            disks.add(cur)
+            continue
+        for dep_key in _stype_to_deps(item_type):
+            dep_value = sconfig[cur].get(dep_key, [])
+            if not isinstance(dep_value, list):
+                dep_value = [dep_value]
+            todo.extend(dep_value)
+    return sorted(disks)
+
+
 def get_config_tree(item, storage_config):
     '''Construct an OrderedDict which inserts all of the
        storage config dependencies required to construct
@@ -328,18 +382,23 @@ def merge_config_trees_to_list(config_trees):
     # reg[sda5] = {level=1, config={'device': sda}}
     # reg[bcache1_raid] =
     #    {level=5, config={'backing': ['md0'], 'cache': ['sda5']}}
-    max_level = 0
     for tree in config_trees:
         top_item_id = list(tree.keys())[0]  # first insertion has the most deps
         level = len(tree.keys())
-        if level > max_level:
-            max_level = level
         item_cfg = tree[top_item_id]
         if top_item_id in reg:
             LOG.warning('Dropping Duplicate id: %s' % top_item_id)
             continue
         reg[top_item_id] = {'level': level, 'config': item_cfg}
 
+    return _merge_levels(reg)
+
+
+def _merge_levels(reg):
+    """ Return the configs in reg sorted by level, then type and then each
+        type's order key.  reg maps item ids to dictionaries with 'level'
+        and 'config' keys.
+    """
     def sort_level(configs):
         sreg = {}
         for cfg in configs:
@@ -357,20 +416,94 @@ def merge_config_trees_to_list(config_trees):
 
         return result
 
-    # [entry for tag in tags]
-    merged = []
-    for lvl in range(0, max_level + 1):
-        level_configs = []
-        for item_id, entry in reg.items():
-            if entry['level'] == lvl:
-                level_configs.append(entry['config'])
+    levels = {}
+    for item_id, entry in reg.items():
+        levels.setdefault(entry['level'], []).append(entry['config'])
 
-        sconfigs = sort_level(level_configs)
-        merged.extend(sconfigs)
+    merged = []
+    for lvl in sorted(levels):
+        merged.extend(sort_level(levels[lvl]))
 
     return merged
 
 
+def _dependency_index(sconfig, validate=True):
+    """ Build the dependency indexes of sconfig in a single pass.
+
+        Returns a tuple of two dictionaries: refs maps each item id to a
+        list of (dep_key, dep_id) it references and users maps a
+        (dep_key, value) pair to the ids of items whose dep_key is value.
+    """
+    all_dep_keys = set()
+    for stype in STORAGE_CONFIG_TYPES:
+        all_dep_keys.update(_stype_to_deps(stype))
+
+    refs = OrderedDict()
+    users = {}
+    for item_id, item_cfg in sconfig.items():
+        item_refs = []
+        for dep_key in _stype_to_deps(item_cfg.get('type')):
+            if dep_key not in item_cfg:
+                continue
+            dep_value = item_cfg[dep_key]
+            if not isinstance(dep_value, list):
+                dep_value = [dep_value]
+            for dep in dep_value:
+                if validate:
+                    _validate_dep_type(item_id, dep_key, dep, sconfig)
+                item_refs.append((dep_key, dep))
+        refs[item_id] = item_refs
+
+        for dep_key in all_dep_keys:
+            value = item_cfg.get(dep_key)
+            if value is not None and not isinstance(value, (list, dict)):
+                users.setdefault((dep_key, value), []).append(item_id)
+
+    return refs, users
+
+
+def get_dependency_levels(sconfig, validate=True):
+    """ Return an OrderedDict mapping each item id in sconfig to the number
+        of distinct items in its config tree, as built by get_config_tree.
+
+        The trees are computed once per item from the indexes returned by
+        _dependency_index and shared with every item built upon them,
+        instead of searching the whole config for each dependency.
+    """
+    refs, users = _dependency_index(sconfig, validate=validate)
+    trees = {}
+    resolving = set()
+
+    def _tree(item_id):
+        if item_id in trees:
+            return trees[item_id]
+        if item_id in resolving:
+            raise ValueError('Dependency cycle detected at: %s' % item_id)
+        resolving.add(item_id)
+        tree = set([item_id])
+        for dep_key, dep in refs.get(item_id, []):
+            tree.add(dep)
+            tree.update(users.get((dep_key, dep), []))
+            if dep in sconfig:
+                tree.update(_tree(dep))
+        resolving.discard(item_id)
+        trees[item_id] = frozenset(tree)
+        return trees[item_id]
+
+    return OrderedDict((item_id, len(_tree(item_id))) for item_id in sconfig)
+
+
+def order_storage_config(sconfig, validate=True):
+    """ Return the items of sconfig as a list ordered from the least to the
+        most dependent item.  The result is the same as merging the config
+        trees of every item with merge_config_trees_to_list.
+    """
+    reg = OrderedDict()
+    for item_id, level in get_dependency_levels(sconfig, validate).items():
+        reg[item_id] = {'level': level, 'config': sconfig[item_id]}
+    return _merge_levels(reg)
+
+
 def config_tree_to_list(config_tree):
     """ ConfigTrees are OrderedDicts which insert dependent storage configs
         from leaf to root.  Reversing this insertion order creates a list
@@ -395,6 +528,102 @@ def extract_storage_ordered_dict(config):
     return OrderedDict((d["id"], d) for d in scfg)
 
 
+def get_dependency_graph(sconfig):
+    """ Return an OrderedDict mapping each item id in sconfig to the set of
+        item ids which must be handled before it.
+
+        Besides the references declared by _stype_to_deps, an item also
+        depends on the previous item in sconfig which referenced the same
+        device (e.g. partitions on one disk, lvs in one volgroup) and on the
+        dasd with a matching device_id.  An item using a partition depends
+        on the last partition of that partition's device, so the partition
+        table is complete before anything opens one of its partitions.
+        Items which write shared target state (mount, zpool, zfs) are kept
+        in their declared order.
+    """
+    serial_types = ('mount', 'zpool', 'zfs')
+    last_partition = {}
+    for item_id, item_cfg in sconfig.items():
+        if item_cfg.get('type') == 'partition':
+            last_partition[item_cfg.get('device')] = item_id
+    graph = OrderedDict()
+    last_user = {}
+    dasds = {}
+    last_serial = None
+    for item_id, item_cfg in sconfig.items():
+        deps = set()
+        item_type = item_cfg.get('type')
+        for dep_key in _stype_to_deps(item_type):
+            dep_value = item_cfg.get(dep_key, [])
+            if not isinstance(dep_value, list):
+                dep_value = [dep_value]
+            for dep in dep_value:
+                if dep not in sconfig:
+                    continue
+                deps.add(dep)
+                dep_cfg = sconfig[dep]
+                if dep_cfg.get('type') == 'partition':
+                    deps.add(last_partition[dep_cfg.get('device')])
+                if dep in last_user:
+                    deps.add(last_user[dep])
+                last_user[dep] = item_id
+        if item_type == 'dasd':
+            dasds[item_cfg.get('device_id')] = item_id
+        elif item_type == 'disk' and item_cfg.get('device_id') in dasds:
+            deps.add(dasds[item_cfg['device_id']])
+        if item_type in serial_types:
+            if last_serial:
+                deps.add(last_serial)
+            last_serial = item_id
+        deps.discard(item_id)
+        graph[item_id] = deps
+
+    return graph
+
+
+class ProbeDataIndex(object):
+    """ Lookup tables over probert probe_data.
+
+        extract_storage_config builds one index and shares it with all of
+        its parsers, so resolving a device link, the members of a
+        multipath or a partition's parent does not scan all of the
+        blockdev or multipath data each time.
+    """
+
+    def __init__(self, probe_data):
+        blockdev_data = probe_data.get('blockdev') or {}
+        # DEVLINKS entry -> blockdev key, the first device listing it wins
+        self.devlinks = {}
+        # (ID_SERIAL, DEVTYPE) -> sorted kernel names
+        self.serial_members = {}
+        # partition blockdev key -> parent devname
+        self.partition_parent = {}
+        for devname, bdata in blockdev_data.items():
+            for link in bdata.get('DEVLINKS', '').split():
+                self.devlinks.setdefault(link, devname)
+            key = (bdata.get('ID_SERIAL', ''), bdata.get('DEVTYPE'))
+            self.serial_members.setdefault(key, []).append(
+                os.path.basename(bdata.get('DEVNAME', devname)))
+            devpath = bdata.get('DEVPATH')
+            if bdata.get('DEVTYPE') == 'partition' and devpath:
+                self.partition_parent[devname] = (
+                    '/dev/' + os.path.basename(os.path.dirname(devpath)))
+        for members in self.serial_members.values():
+            members.sort()
+
+        # multipath name -> sorted path devices, path device -> multipath
+        self.mpath_paths = {}
+        self.path_mpath = {}
+        mpath_data = probe_data.get('multipath') or {}
+        for path in mpath_data.get('paths', []):
+            self.mpath_paths.setdefault(path.get('multipath'), []).append(
+                path.get('device'))
+            self.path_mpath.setdefault(path.get('device'),
+                                       path.get('multipath'))
+        for paths in self.mpath_paths.values():
+            paths.sort()
+
+
 class ProbertParser(object):
     """ Base class for parsing probert storage configuration.
 
@@ -409,11 +638,12 @@ class ProbertParser(object):
     probe_data_key = None
     class_data = None
 
-    def __init__(self, probe_data):
+    def __init__(self, probe_data, index=None):
         if not probe_data or not isinstance(probe_data, dict):
             raise ValueError('Invalid probe_data: %s' % probe_data)
 
         self.probe_data = probe_data
+        self._index = index
         if self.probe_data_key is not None:
             if self.probe_data_key in probe_data:
                 data = self.probe_data.get(self.probe_data_key)
@@ -431,6 +661,14 @@ class ProbertParser(object):
         if not self.blockdev_data:
             LOG.warning('probe_data missing valid "blockdev" data')
 
+    @property
+    def index(self):
+        """ The ProbeDataIndex shared with other parsers, built on first
+            use if none was given. """
+        if self._index is None:
+            self._index = ProbeDataIndex(self.probe_data)
+        return self._index
+
     def parse(self):
         raise NotImplementedError()
 
@@ -446,12 +684,23 @@ class ProbertParser(object):
         if devname in self.blockdev_data:
             return devname
 
-        for bd_key, bdata in self.blockdev_data.items():
-            devlinks = bdata.get('DEVLINKS', '').split()
-            if devname in devlinks:
-                return bd_key
+        return self.index.devlinks.get(devname)
 
-        return None
+    def partition_parent_devname(self, blockdev):
+        """ Return the devname of a partition's parent.
+        md0p1 -> /dev/md0
+        vda1 -> /dev/vda
+        nvme0n1p3 -> /dev/nvme0n1
+        """
+        if blockdev['DEVTYPE'] != "partition":
+            raise ValueError('Invalid blockdev, DEVTYPE is not partition')
+
+        parent = self.index.partition_parent.get(blockdev.get('DEVNAME'))
+        if parent:
+            return parent
+        pdevpath = blockdev.get('DEVPATH')
+        if pdevpath:
+            return '/dev/' + os.path.basename(os.path.dirname(pdevpath))
 
     def is_mpath(self, blockdev):
         if blockdev.get('DM_MULTIPATH_DEVICE_PATH') == "1":
@@ -468,19 +717,14 @@ class ProbertParser(object):
         if blockdev['DEVTYPE'] == 'partition':
             bd_name = self.partition_parent_devname(blockdev)
         bd_name = os.path.basename(bd_name)
-        for path in mpath_data.get('paths', []):
-            if bd_name == path.get('device'):
-                rv = path.get('multipath')
-                return rv
+        return self.index.path_mpath.get(bd_name)
 
     def find_mpath_member(self, blockdev):
         if blockdev.get('DM_MULTIPATH_DEVICE_PATH') == "1":
             # find all other DM_MULTIPATH_DEVICE_PATH devs with same serial
             serial = blockdev.get('ID_SERIAL')
-            members = sorted([os.path.basename(dev['DEVNAME'])
-                              for dev in self.blockdev_data.values()
-                              if dev.get("ID_SERIAL", "") == serial and
-                              dev['DEVTYPE'] == blockdev['DEVTYPE']])
+            members = self.index.serial_members.get(
+                (serial, blockdev['DEVTYPE']), [])
             # [/dev/sda, /dev/sdb]
             # [/dev/sda1, /dev/sda2, /dev/sdb1, /dev/sdb2]
 
@@ -505,11 +749,7 @@ class ProbertParser(object):
                     return None
                 # remove leading 'mpath-'
                 multipath = match.group(0)[6:]
-            mpath_data = self.probe_data.get('multipath')
-            if not mpath_data:
-                return None
-            members = sorted([path['device'] for path in mpath_data['paths']
-                              if path['multipath'] == multipath])
+            members = self.index.mpath_paths.get(multipath, [])
 
             # append partition number if present
             if dm_part:
@@ -574,8 +814,8 @@ class BcacheParser(ProbertParser):
 
     probe_data_key = 'bcache'
 
-    def __init__(self, probe_data):
-        super(BcacheParser, self).__init__(probe_data)
+    def __init__(self, probe_data, index=None):
+        super(BcacheParser, self).__init__(probe_data, index=index)
         self.backing = self.class_data.get('backing', {})
         self.caching = self.class_data.get('caching', {})
 
@@ -623,14 +863,9 @@ class BcacheParser(ProbertParser):
         def _find_bcache_devname(uuid, backing_data, blockdev_data):
             by_uuid = '/dev/bcache/by-uuid/' + uuid
             label = _sb_get(backing_data, 'dev.label')
-            for devname, data in blockdev_data.items():
-                if not devname:
-                    continue
-                if devname.startswith('/dev/bcache'):
-                    # DEVLINKS is a space separated list
-                    devlinks = data.get('DEVLINKS', '').split()
-                    if by_uuid in devlinks:
-                        return devname
+            devname = self.index.devlinks.get(by_uuid)
+            if devname and devname.startswith('/dev/bcache'):
+                return devname
             if label:
                 return label
             LOG.warning('Failed to find bcache %s ' % (by_uuid))
@@ -722,19 +957,6 @@ class BlockdevParser(ProbertParser):
 
         return uniq
 
-    def partition_parent_devname(self, blockdev):
-        """ Return the devname of a partition's parent.
-        md0p1 -> /dev/md0
-        vda1 -> /dev/vda
-        nvme0n1p3 -> /dev/nvme0n1
-        """
-        if blockdev['DEVTYPE'] != "partition":
-            raise ValueError('Invalid blockdev, DEVTYPE is not partition')
-
-        pdevpath = blockdev.get('DEVPATH')
-        if pdevpath:
-            return '/dev/' + os.path.basename(os.path.dirname(pdevpath))
-
     def asdict(self, blockdev_data):
         """ process blockdev_data and return a curtin
             storage config dictionary.  This method
@@ -1296,8 +1518,9 @@ def extract_storage_config(probe_data, strict=False):
     configs = []
     errors = []
     LOG.debug('Extracting storage config from probe data')
+    index = ProbeDataIndex(probe_data)
     for ptype, pname in convert_map.items():
-        parser = pname(probe_data)
+        parser = pname(probe_data, index=index)
         found_cfgs, found_errs = parser.parse()
         configs.extend(found_cfgs)
         errors.extend(found_errs)
@@ -1338,24 +1561,23 @@ def extract_storage_config(probe_data, strict=False):
     # generating a config tree for each item in the probed data
     # and then merging the trees, which resolves dependencies
     # and produced a dependency ordered storage config
-    LOG.debug("Extracted (unmerged) storage config:\n%s",
-              yaml.dump({'storage': ordered},
-                        indent=4, default_flow_style=False))
-
-    LOG.debug("Generating storage config dependencies")
-    ctrees = []
-    for cfg in ordered:
-        tree = get_config_tree(cfg.get('id'), final_config)
-        ctrees.append(tree)
-
-    LOG.debug("Merging storage config dependencies")
+    # dumping thousands of items is slow, skip it unless it is logged
+    debug = LOG.isEnabledFor(logging.DEBUG)
+    if debug:
+        LOG.debug("Extracted (unmerged) storage config:\n%s",
+                  yaml.dump({'storage': ordered},
+                            indent=4, default_flow_style=False))
+
+    LOG.debug("Ordering storage config dependencies")
     merged_config = {
         'version': 1,
-        'config': merge_config_trees_to_list(ctrees)
+        'config': order_storage_config(
+            OrderedDict((cfg['id'], cfg) for cfg in ordered))
     }
-    LOG.debug("Merged storage config:\n%s",
-              yaml.dump({'storage': merged_config},
-                        indent=4, default_flow_style=False))
+    if debug:
+        LOG.debug("Merged storage config:\n%s",
+                  yaml.dump({'storage': merged_config},
+                            indent=4, default_flow_style=False))
     return {'storage': merged_config}
 
 
@@ -0,0 +1,158 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Ledger of the subprocesses run by util.subp.
+
+When the CURTIN_SUBP_LEDGER environment variable names a file, every
+command run by util.subp is appended to it as one json object per line:
+its argv, target, the report stack (phase) it ran under, start time,
+duration, exit code and the number of bytes captured from stdout and
+stderr.  The variable is inherited by the curtin commands an install runs,
+so all stages write to the same ledger.  'curtin subp-summary' aggregates
+a ledger by tool and phase.
+"""
+
+import json
+import os
+import threading
+import time
+
+from curtin.log import LOG
+from curtin.paths import string_types
+
+LEDGER_ENV = 'CURTIN_SUBP_LEDGER'
+
+_lock = threading.Lock()
+_totals = {'subp_seconds': 0.0}
+
+
+def ledger_path():
+    """Return the ledger path, None if tracing is disabled."""
+    return os.environ.get(LEDGER_ENV) or None
+
+
+def enable(path, truncate=True):
+    """Record subprocesses of this process and its children to path."""
+    os.environ[LEDGER_ENV] = path
+    if truncate:
+        with open(path, 'w'):
+            pass
+
+
+def _phase():
+    # imported here, curtin.reporter is not needed unless tracing
+    from curtin.reporter import events
+    return events.current_stack_name()
+
+
+def tool_name(argv):
+    """Return the name of the program argv runs, skipping wrappers."""
+    if isinstance(argv, string_types):
+        args = argv.split()
+    else:
+        args = list(argv)
+    while args:
+        name = os.path.basename(str(args[0]))
+        if name == 'unshare':
+            args = args[args.index('--') + 1:] if '--' in args else args[1:]
+        elif name == 'chroot':
+            args = args[2:]
+        elif name == 'sh' and args[1:2] == ['-c'] and len(args) > 2:
+            args = args[2].split()
+        elif name == 'env':
+            args = [a for a in args[1:] if '=' not in a and a[:1] != '-']
+        else:
+            return name
+    return None
+
+
+def record(argv, target, start, exit_code, stdout=None, stderr=None,
+           logstring=None):
+    """Append a subprocess to the ledger, if tracing is enabled.
+
+    argv is the command as run, start the time.time() it was started,
+    exit_code None if it could not be run.  stdout and stderr are the
+    captured bytes, None if not captured.  If logstring is given it is
+    recorded instead of argv, which may hold sensitive data."""
+    duration = time.time() - start
+    with _lock:
+        _totals['subp_seconds'] += duration
+    path = ledger_path()
+    if not path:
+        return
+    entry = {
+        'argv': ([logstring] if logstring else
+                 [argv] if isinstance(argv, string_types) else list(argv)),
+        'tool': tool_name(argv),
+        'target': target,
+        'phase': _phase(),
+        'pid': os.getpid(),
+        'start': start,
+        'duration': duration,
+        'exit_code': exit_code,
+        'stdout_bytes': None if stdout is None else len(stdout),
+        'stderr_bytes': None if stderr is None else len(stderr),
+    }
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    try:
+        with _lock:
+            with open(path, 'a') as fp:
+                fp.write(line)
+    except (IOError, OSError) as e:
+        LOG.debug('tracing: cannot write to ledger %s: %s', path, e)
+
+
+def subp_seconds():
+    """Return the wall time this process has spent running subprocesses,
+    whether or not the ledger is enabled."""
+    with _lock:
+        return _totals['subp_seconds']
+
+
+def load(path):
+    """Return the entries of the ledger at path."""
+    entries = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a command killed while writing leaves a partial line
+                LOG.debug('tracing: skipping invalid ledger line: %s', line)
+    return entries
+
+
+def _add(totals, key, entry):
+    cur = totals.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0,
+                                  'failed': 0, 'stdout_bytes': 0,
+                                  'stderr_bytes': 0})
+    cur['count'] += 1
+    cur['total'] += entry['duration']
+    cur['max'] = max(cur['max'], entry['duration'])
+    if entry.get('exit_code') != 0:
+        cur['failed'] += 1
+    for field in ('stdout_bytes', 'stderr_bytes'):
+        cur[field] += entry.get(field) or 0
+
+
+def summarize(entries):
+    """Aggregate ledger entries.
+
+    Returns a dictionary with 'tools', a dictionary of tool name to totals,
+    and 'phases', a dictionary of phase to its totals and to 'tools', the
+    totals of each tool in that phase.  Totals are the command count, total
+    and maximum duration, number of commands which exited non-zero or could
+    not be run ('failed') and bytes captured."""
+    tools = {}
+    phases = {}
+    for entry in entries:
+        tool = entry.get('tool') or '?'
+        phase = entry.get('phase') or '-'
+        _add(tools, tool, entry)
+        _add(phases, phase, entry)
+        _add(phases[phase].setdefault('tools', {}), tool, entry)
+    return {'tools': tools, 'phases': phases}
+
+# vi: ts=4 expandtab syntax=python
@@ -3,7 +3,7 @@
 import shlex
 import os
 
-from curtin import util
+from curtin import inventory, util
 from curtin.log import logged_call, LOG
 
 try:
@@ -56,12 +56,24 @@ def udevadm_settle(exists=None, timeout=None):
     if exists:
         # skip the settle if the requested path already exists
         if os.path.exists(exists):
+            _invalidate_snapshots()
             return
         settle_cmd.extend(['--exit-if-exists=%s' % exists])
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
 
-    util.subp(settle_cmd)
+    try:
+        util.subp(settle_cmd)
+    finally:
+        # device lookups after a settle must see the current devices
+        _invalidate_snapshots()
+
+
+def _invalidate_snapshots():
+    # curtin.block.multipath imports this module
+    from curtin.block import multipath
+    inventory.invalidate()
+    multipath.invalidate()
 
 
 def udevadm_trigger(devices):
@@ -82,6 +94,10 @@ def udevadm_info(path=None):
     if not path:
         raise ValueError('Invalid path: "%s"' % path)
 
+    cached = inventory.udevadm_info(path)
+    if cached is not None:
+        return cached
+
     info_cmd = ['udevadm', 'info', '--query=property', '--export', path]
     output, _ = util.subp(info_cmd, capture=True)
 
@@ -1,14 +1,18 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from collections import OrderedDict
 from email.utils import parsedate
+import hashlib
 import json
 import os
 import socket
 import sys
+import threading
 import time
 import uuid
 from functools import partial
 
+from curtin import parallel
 from curtin import version
 
 try:
@@ -28,6 +32,7 @@ from .log import LOG
 error = urllib_error
 
 DEFAULT_HEADERS = {'User-Agent': 'Curtin/' + version.version_string()}
+DOWNLOAD_BUFLEN = 1024 * 1024
 
 
 class _ReRaisedException(Exception):
@@ -56,6 +61,7 @@ class UrlReader(object):
 
         self.info = self.fp.info()
         self.size = self.info.get('content-length', -1)
+        self.code = self.fp.getcode()
 
     def read(self, buflen):
         try:
@@ -82,51 +88,284 @@ class UrlReader(object):
         self.close()
 
 
-def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3):
-    """Download url to path.
+class ResumingUrlReader(object):
+    """Read url as a stream, resuming with a range request after an error.
 
-    reporthook is compatible with py3 urllib.request.urlretrieve.
-    urlretrieve does not exist in py2."""
+    Up to 'retries' failed opens or reads are retried.  Reads continue from
+    the last byte returned, which requires the server to honor range
+    requests; otherwise the error is raised, or if restart is True the url
+    is read again from the start, discarding the bytes already returned.
+    cancel is an optional threading.Event; once it is set reads raise
+    UrlError."""
 
-    buflen = 8192
-    attempts = 0
-
-    while True:
-        wfp = open(path, "wb")
+    def __init__(self, url, retries=0, retry_delay=3, restart=False,
+                 cancel=None):
+        self.url = url
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.restart = restart
+        self.cancel = cancel if cancel is not None else threading.Event()
+        self.offset = 0
+        self.attempts = 0
+        self._reader = None
+        self._open()
+        self.info = self._reader.info
+        self.size = self._reader.size
         try:
-            buf = None
+            self._total = int(self.size)
+        except (TypeError, ValueError):
+            self._total = -1
+
+    def _retry(self, error):
+        if not _should_retry(error, self.attempts, self.retries, self.cancel):
+            raise error
+        LOG.debug("Reading %s failed at byte %d with error: %s. Resuming in"
+                  " %d seconds.", self.url, self.offset, error,
+                  self.retry_delay)
+        self.attempts += 1
+        self.close()
+        time.sleep(self.retry_delay)
+
+    def _open(self):
+        while self._reader is None:
+            try:
+                if not self.offset:
+                    self._reader = UrlReader(self.url)
+                    continue
+                reader = UrlReader(
+                    self.url, headers={'Range': 'bytes=%d-' % self.offset})
+                if reader.code != 206 and not self.restart:
+                    reader.close()
+                    raise UrlError("server does not support resuming",
+                                   code=reader.code, url=self.url)
+                self._reader = reader
+                if reader.code != 206:
+                    LOG.debug("Server ignored range request for %s, "
+                              "skipping %d bytes", self.url, self.offset)
+                    self._skip(self.offset)
+            except UrlError as e:
+                self._retry(e)
+
+    def _skip(self, length):
+        while length:
+            buf = self._reader.read(min(length, DOWNLOAD_BUFLEN))
+            if not buf:
+                raise UrlError("short read at byte %d" %
+                               (self.offset - length), url=self.url)
+            length -= len(buf)
+
+    def read(self, buflen):
+        while True:
+            _check_cancelled(self.url, self.cancel)
+            self._open()
+            try:
+                buf = self._reader.read(buflen)
+                if not buf and 0 <= self.offset < self._total:
+                    raise UrlError("short read at byte %d" % self.offset,
+                                   url=self.url)
+            except UrlError as e:
+                self._retry(e)
+                continue
+            self.offset += len(buf)
+            return buf
+
+    def close(self):
+        if self._reader:
+            try:
+                self._reader.close()
+            finally:
+                self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3,
+             buflen=DOWNLOAD_BUFLEN, segments=1, checksum=None, cancel=None):
+    """Download url to path.
+
+    reporthook is compatible with py3 urllib.request.urlretrieve.
+    urlretrieve does not exist in py2.
+
+    Each read requests up to buflen bytes.  Server errors and connection
+    failures are retried up to 'retries' times, resuming from the last
+    byte written if the server honors range requests.  If segments is
+    greater than 1 and the server supports range requests, the file is
+    preallocated and fetched as that many concurrent ranges (reporthook
+    is not called in that case).  checksum is an optional
+    '<algorithm>:<hexdigest>' string, e.g. 'sha256:d2a8...', which the
+    downloaded data must match.  cancel is an optional threading.Event;
+    once it is set the download stops and raises UrlError."""
+
+    hash_algo, expected_digest = _parse_checksum(checksum)
+    if cancel is None:
+        cancel = threading.Event()
+    start = time.time()
+    size = None
+    if segments > 1:
+        size = _get_range_size(url)
+        if size is None:
+            LOG.debug("Server for %s does not support range requests, "
+                      "downloading in a single stream", url)
+
+    if size is not None:
+        info = _download_segments(url, path, size, segments, buflen,
+                                  retries, retry_delay, cancel)
+        hasher = None
+        if hash_algo:
+            hasher = _hash_file(path, hash_algo, buflen)
+    else:
+        info, hasher = _download_stream(url, path, reporthook, buflen,
+                                        retries, retry_delay, hash_algo,
+                                        cancel)
+
+    if hasher and hasher.hexdigest() != expected_digest:
+        raise ValueError("Checksum mismatch for %s: expected %s:%s, got %s" %
+                         (url, hash_algo, expected_digest,
+                          hasher.hexdigest()))
+
+    fsize = os.path.getsize(path)
+    timedelta = max(time.time() - start, 0.001)
+    LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
+              fsize, url, path, timedelta, fsize / timedelta / 1024 / 1024)
+    return path, info
+
+
+def _parse_checksum(checksum):
+    """Split an '<algorithm>:<hexdigest>' checksum string."""
+    if not checksum:
+        return None, None
+    algo, _, digest = checksum.partition(':')
+    if not digest or algo not in hashlib.algorithms_available:
+        raise ValueError("Invalid checksum '%s', expected "
+                         "'<algorithm>:<hexdigest>'" % checksum)
+    return algo, digest.lower()
+
+
+def _hash_file(path, hash_algo, buflen):
+    hasher = hashlib.new(hash_algo)
+    with open(path, "rb") as fp:
+        while True:
+            buf = fp.read(buflen)
+            if not buf:
+                break
+            hasher.update(buf)
+    return hasher
+
+
+def _should_retry(error, attempts, retries, cancel=None):
+    """Retry server errors (http 5xx) and errors without an http status."""
+    if attempts >= retries or (cancel is not None and cancel.is_set()):
+        return False
+    return error.code is None or error.code >= 500
+
+
+def _check_cancelled(url, cancel):
+    if cancel.is_set():
+        raise UrlError("download cancelled", url=url, reason="cancelled")
+
+
+def _download_stream(url, path, reporthook, buflen, retries, retry_delay,
+                     hash_algo, cancel):
+    """Download url to path in a single stream, resuming after errors.
+
+    Returns a tuple of the response info and the hash object (or None)."""
+    hasher = hashlib.new(hash_algo) if hash_algo else None
+    with open(path, "wb") as wfp:
+        with ResumingUrlReader(url, retries=retries, retry_delay=retry_delay,
+                               restart=True, cancel=cancel) as rfp:
             blocknum = 0
-            fsize = 0
-            start = time.time()
-            with UrlReader(url) as rfp:
+            if reporthook:
+                reporthook(blocknum, buflen, rfp.size)
+            while True:
+                buf = rfp.read(buflen)
+                if not buf:
+                    break
+                wfp.write(buf)
+                if hasher:
+                    hasher.update(buf)
+                blocknum += 1
                 if reporthook:
                     reporthook(blocknum, buflen, rfp.size)
+            return rfp.info, hasher
 
-                while True:
-                    buf = rfp.read(buflen)
-                    if not buf:
-                        break
-                    blocknum += 1
-                    if reporthook:
-                        reporthook(blocknum, buflen, rfp.size)
-                    wfp.write(buf)
-                    fsize += len(buf)
-            timedelta = time.time() - start
-            LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
-                      fsize, url, path, timedelta,
-                      fsize / timedelta / 1024 / 1024)
-            return path, rfp.info
-        except UrlError as e:
-            # retry on internal server errors up to "retries #"
-            if (e.code < 500 or attempts >= retries):
-                raise e
-            LOG.debug("Current download failed with error: %s. Retrying in"
-                      " %d seconds.",
-                      e.code, retry_delay)
-            attempts += 1
-            time.sleep(retry_delay)
-        finally:
-            wfp.close()
+
+def _get_range_size(url):
+    """Return the size of url if the server honors range requests."""
+    try:
+        with UrlReader(url, headers={'Range': 'bytes=0-0'}) as rfp:
+            if rfp.code != 206:
+                return None
+            # Content-Range: bytes 0-0/12345
+            total = rfp.info.get('content-range', '').rpartition('/')[2]
+            return int(total)
+    except (UrlError, ValueError) as e:
+        LOG.debug("Range request to %s failed: %s", url, e)
+        return None
+
+
+def _download_segments(url, path, size, segments, buflen, retries,
+                       retry_delay, cancel):
+    """Download url to a preallocated path using concurrent range requests.
+
+    Returns the response info of the last segment fetched."""
+    with open(path, "wb") as wfp:
+        wfp.truncate(size)
+
+    seg_size = max(-(-size // segments), 1)
+    ranges = OrderedDict(
+        ((start, min(start + seg_size, size)), [])
+        for start in range(0, size, seg_size))
+    infos = []
+
+    def fetch(segment):
+        infos.append(_download_range(url, path, segment[0], segment[1],
+                                     buflen, retries, retry_delay, cancel))
+
+    LOG.debug("Downloading %s in %d segments of %d bytes",
+              url, len(ranges), seg_size)
+    parallel.run_graph(ranges, fetch, max_workers=segments, cancel=cancel)
+    _check_cancelled(url, cancel)
+    return infos[-1] if infos else None
+
+
+def _download_range(url, path, start, end, buflen, retries, retry_delay,
+                    cancel):
+    """Write bytes [start, end) of url into path at the same offset."""
+    attempts = 0
+    offset = start
+    info = None
+    with open(path, "r+b") as wfp:
+        while offset < end and not cancel.is_set():
+            try:
+                headers = {'Range': 'bytes=%d-%d' % (offset, end - 1)}
+                with UrlReader(url, headers=headers) as rfp:
+                    if rfp.code != 206:
+                        raise UrlError("range request was not honored",
+                                       code=rfp.code, url=url)
+                    info = rfp.info
+                    wfp.seek(offset)
+                    while offset < end and not cancel.is_set():
+                        buf = rfp.read(min(buflen, end - offset))
+                        if not buf:
+                            break
+                        wfp.write(buf)
+                        offset += len(buf)
+                if offset < end and not cancel.is_set():
+                    raise UrlError("short read at byte %d of range %d-%d" %
+                                   (offset, start, end - 1), url=url)
+            except UrlError as e:
+                if not _should_retry(e, attempts, retries, cancel):
+                    raise e
+                LOG.debug("Download of %s range %d-%d failed with error: %s."
+                          " Resuming at byte %d in %d seconds.",
+                          url, start, end - 1, e, offset, retry_delay)
+                attempts += 1
+                time.sleep(retry_delay)
+    return info
 
 
 def get_maas_version(endpoint):
@@ -202,7 +441,16 @@ def _geturl(url, headers=None, headers_cb=None, exception_cb=None, data=None):
     if headers_cb:
         headers.update(headers_cb(url))
 
-    if data and isinstance(data, dict):
+    if callable(data):
+        # a new body for every attempt, sent with its length if known and
+        # with chunked transfer encoding otherwise
+        length = getattr(data, 'length', None)
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        data = data()
+        if sys.version_info[0] == 2:
+            data = b''.join(data)
+    elif data and isinstance(data, dict):
         data = json.dumps(data).encode()
 
     try:
@@ -230,7 +478,11 @@ def _geturl(url, headers=None, headers_cb=None, exception_cb=None, data=None):
 
 def geturl(url, headers=None, headers_cb=None, exception_cb=None,
            data=None, retries=None, log=LOG.warn):
-    """return the content of the url in binary_type. (py3: bytes, py2: str)"""
+    """return the content of the url in binary_type. (py3: bytes, py2: str)
+
+    data may be bytes, a dictionary to post as json, or a function returning
+    an iterable of bytes which is called again for each retry.  The length
+    attribute of the function, if not None, is sent as Content-Length."""
     if retries is None:
         retries = []
 
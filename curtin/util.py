@@ -15,6 +15,7 @@ import subprocess
 import stat
 import sys
 import tempfile
+import threading
 import time
 
 # avoid the dependency to python3-six as used in cloud-init
@@ -42,7 +43,9 @@ try:
 except NameError:
     FileMissingError = IOError
 
+from . import devwait
 from . import paths
+from . import tracing
 from .log import LOG, log_call
 
 binary_type = bytes
@@ -90,6 +93,7 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
     else:
         LOG.debug(("Running hidden command to protect sensitive "
                    "input/output logstring: %s"), logstring)
+    start = time.time()
     try:
         stdin = None
         stdout = None
@@ -117,6 +121,7 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
                 out = b''
             if not err:
                 err = b''
+        captured = (out, err)
         if decode:
             def ldecode(data, m='utf-8'):
                 if not isinstance(data, bytes):
@@ -126,6 +131,7 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
             out = ldecode(out)
             err = ldecode(err)
     except OSError as e:
+        tracing.record(args, target, start, None, logstring=logstring)
         raise ProcessExecutionError(cmd=args, reason=e)
     finally:
         if devnull_fp:
@@ -135,6 +141,7 @@ def _subp(args, data=None, rcs=None, env=None, capture=False,
         LOG.debug("Command returned stdout=%s, stderr=%s", out, err)
 
     rc = sp.returncode  # pylint: disable=E1101
+    tracing.record(args, target, start, rc, *captured, logstring=logstring)
     if rc not in rcs:
         raise ProcessExecutionError(stdout=out, stderr=err,
                                     exit_code=rc,
@@ -276,24 +283,14 @@ def subp(*args, **kwargs):
 
 
 def wait_for_removal(path, retries=[1, 3, 5, 7]):
+    """Wait for path to be removed, for at most sum(retries) seconds."""
     if not path:
         raise ValueError('wait_for_removal: missing path parameter')
 
-    # Retry with waits between checking for existence
     LOG.debug('waiting for %s to be removed', path)
-    for num, wait in enumerate(retries):
-        if not os.path.exists(path):
-            LOG.debug('%s has been removed', path)
-            return
-        LOG.debug('sleeping %s', wait)
-        time.sleep(wait)
-
-    # final check
-    if not os.path.exists(path):
-        LOG.debug('%s has been removed', path)
-        return
-
-    raise OSError('Timeout exceeded for removal of %s', path)
+    if not devwait.wait_for_path(path, exists=False, timeout=sum(retries)):
+        raise OSError('Timeout exceeded for removal of %s' % path)
+    LOG.debug('%s has been removed', path)
 
 
 def load_command_environment(env=os.environ, strict=False):
@@ -650,11 +647,15 @@ class ChrootableTarget(object):
         self.sys_resolvconf = sys_resolvconf
         self.rconf_d = None
         self.rc_tmp = None
+        self.session = None
 
     def __enter__(self):
+        self.session = ChrootSession.current(self.target)
         for p in self.mounts:
             tpath = paths.target_path(self.target, p)
-            if do_mount(p, tpath, opts='--bind'):
+            if self.session is not None:
+                self.session.bind_mount(p, tpath)
+            elif do_mount(p, tpath, opts='--bind'):
                 self.umounts.append(tpath)
 
         if not self.allow_daemons:
@@ -711,6 +712,80 @@ class ChrootableTarget(object):
         return paths.target_path(self.target, path)
 
 
+class ChrootSession(object):
+    """Share the bind mounts of ChrootableTarget between its uses.
+
+    While a session for target is open, ChrootableTarget contexts for that
+    target mount /dev, /proc, /run, /sys (and any extra mounts) through the
+    session and leave them in place on exit.  Nested ChrootSession contexts
+    for the same target share one reference counted session; the mounts are
+    removed once, when the outermost context exits.  Daemon disabling and
+    resolv.conf handling are still done by each ChrootableTarget.
+
+        with util.ChrootSession(target) as session:
+            with util.ChrootableTarget(target) as in_chroot:
+                ...
+    """
+    _sessions = {}
+    _lock = threading.Lock()
+
+    def __init__(self, target):
+        if target is None:
+            target = "/"
+        self.target = paths.target_path(target)
+        self.refcount = 0
+        self.umounts = []
+        self.saved = {'mount': 0, 'umount': 0}
+
+    @classmethod
+    def current(cls, target):
+        """Return the open session for target, or None."""
+        with cls._lock:
+            return cls._sessions.get(paths.target_path(target))
+
+    def bind_mount(self, src, tpath):
+        if tpath in self.umounts:
+            self.saved['mount'] += 1
+            self.saved['umount'] += 1
+        elif do_mount(src, tpath, opts='--bind'):
+            self.umounts.append(tpath)
+
+    def release(self):
+        with self._lock:
+            self.refcount -= 1
+            if self.refcount > 0:
+                return
+            if self._sessions.get(self.target) is self:
+                del self._sessions[self.target]
+        self._teardown()
+
+    def summary(self):
+        """Return a description of the mount operations saved."""
+        return ('chroot session for %s: saved %d mounts and %d umounts' %
+                (self.target, self.saved['mount'], self.saved['umount']))
+
+    def _teardown(self):
+        LOG.info(self.summary())
+        # if /dev is to be unmounted, udevadm settle (LP: #1462139)
+        if paths.target_path(self.target, "/dev") in self.umounts:
+            log_call(subp, ['udevadm', 'settle'])
+
+        umounts, self.umounts = self.umounts, []
+        for p in reversed(umounts):
+            do_umount(p)
+
+    def __enter__(self):
+        with self._lock:
+            session = self._sessions.setdefault(self.target, self)
+            session.refcount += 1
+        return session
+
+    def __exit__(self, etype, value, trace):
+        with self._lock:
+            session = self._sessions.get(self.target, self)
+        session.release()
+
+
 def is_exe(fpath):
     # Return path of program for execution if found in path
     return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
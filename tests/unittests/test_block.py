@@ -1,9 +1,11 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import errno
 import functools
 import json
 import os
 import mock
+import struct
 import sys
 import textwrap
 
@@ -399,6 +401,225 @@ class TestWipeFile(CiTestCase):
             self.assertEqual([], mock_os_close.call_args_list)
 
 
+class TestBlockRangeIoctl(CiTestCase):
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_zero_range(self, m_ioctl):
+        self.assertTrue(block.zero_range(3, 4096, 8192))
+        m_ioctl.assert_called_with(3, block.BLKZEROOUT,
+                                   struct.pack('QQ', 4096, 8192))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_unsupported_returns_false(self, m_ioctl):
+        for err in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            m_ioctl.side_effect = IOError(err, os.strerror(err))
+            self.assertFalse(block.block_range_ioctl(3, block.BLKDISCARD,
+                                                     0, 4096))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    def test_other_errors_raise(self, m_ioctl):
+        m_ioctl.side_effect = IOError(errno.EIO, 'I/O error')
+        with self.assertRaises(IOError):
+            block.zero_range(3, 0, 4096)
+
+
+class TestZeroVolume(CiTestCase):
+
+    def setUp(self):
+        super(TestZeroVolume, self).setUp()
+        self.path = self.tmp_path('disk.img')
+        with open(self.path, 'wb') as fp:
+            fp.truncate(1024 * 1024)
+        self.add_patch('curtin.block.is_block_device', 'm_is_block',
+                       return_value=True)
+        self.add_patch('curtin.block.discard_zeroes_data', 'm_dzd',
+                       return_value=False)
+        self.add_patch('curtin.block.block_range_ioctl', 'm_ioctl',
+                       return_value=True)
+        self.add_patch('curtin.block.wipe_file', 'm_wipe_file')
+
+    def _requests(self):
+        return [c[0][1] for c in self.m_ioctl.call_args_list]
+
+    def test_zero_volume_uses_zeroout(self):
+        self.assertEqual('BLKZEROOUT', block.zero_volume(self.path))
+        self.m_ioctl.assert_called_with(mock.ANY, block.BLKZEROOUT,
+                                        0, 1024 * 1024)
+        self.assertEqual(0, self.m_wipe_file.call_count)
+
+    def test_zero_volume_discards_if_discard_zeroes_data(self):
+        self.m_dzd.return_value = True
+        self.assertEqual('BLKDISCARD', block.zero_volume(self.path))
+        self.assertEqual([block.BLKDISCARD], self._requests())
+
+    def test_zero_volume_writes_zeros_without_offload(self):
+        self.m_ioctl.return_value = False
+        self.assertEqual('write', block.zero_volume(self.path))
+        self.m_wipe_file.assert_called_with(self.path, exclusive=True)
+
+    def test_zero_volume_writes_zeros_to_files(self):
+        self.m_is_block.return_value = False
+        self.assertEqual('write', block.zero_volume(self.path))
+        self.assertEqual(0, self.m_ioctl.call_count)
+
+    def test_discard_volume_prefers_secure_discard(self):
+        self.assertEqual('BLKSECDISCARD', block.discard_volume(self.path))
+        self.m_ioctl.side_effect = [False, True]
+        self.assertEqual('BLKDISCARD', block.discard_volume(self.path))
+
+    def test_discard_volume_zeroes_without_discard(self):
+        self.m_ioctl.side_effect = [False, False, True]
+        self.assertEqual('BLKZEROOUT', block.discard_volume(self.path))
+        self.assertEqual([block.BLKSECDISCARD, block.BLKDISCARD,
+                          block.BLKZEROOUT], self._requests())
+
+
+class TestDiscardZeroesData(CiTestCase):
+
+    @mock.patch('curtin.block.util.load_file')
+    @mock.patch('curtin.block.sys_block_path')
+    @mock.patch('curtin.block.get_blockdev_for_partition')
+    def test_reads_parent_queue(self, m_parent, m_sys_block_path,
+                                m_load_file):
+        m_parent.return_value = ('/dev/sda', '1')
+        m_load_file.return_value = '1\n'
+        self.assertTrue(block.discard_zeroes_data('/dev/sda1'))
+        m_sys_block_path.assert_called_with('/dev/sda',
+                                            'queue/discard_zeroes_data')
+        m_load_file.return_value = '0\n'
+        self.assertFalse(block.discard_zeroes_data('/dev/sda1'))
+        m_load_file.side_effect = IOError('missing')
+        self.assertFalse(block.discard_zeroes_data('/dev/sda1'))
+
+
+class TestZeroFileAtOffsets(CiTestCase):
+
+    def setUp(self):
+        super(TestZeroFileAtOffsets, self).setUp()
+        self.path = self.tmp_path('disk.img')
+        self.size = 8 * 1024 * 1024
+        util.write_file(self.path, self.size * b'\1', omode="wb")
+
+    def _zeroed(self):
+        data = util.load_file(self.path, decode=False)
+        ranges = []
+        pos = 0
+        while pos < len(data):
+            start = data.find(b'\0', pos)
+            if start == -1:
+                break
+            end = data.find(b'\1', start)
+            if end == -1:
+                end = len(data)
+            ranges.append((start, end - start))
+            pos = end
+        return ranges
+
+    def test_zero_at_offsets(self):
+        ranges = block.zero_file_at_offsets(self.path, [0, -4096],
+                                            buflen=1024, count=2)
+        expected = [(0, 2048), (self.size - 4096, 2048)]
+        self.assertEqual(expected, ranges)
+        self.assertEqual(expected, self._zeroed())
+
+    def test_dry_run_does_not_write(self):
+        ranges = block.zero_file_at_offsets(self.path, [1024 * 1024],
+                                            dry_run=True)
+        self.assertEqual([(1024 * 1024, 1024 * 1024)], ranges)
+        self.assertEqual([], self._zeroed())
+
+    def test_short_range_is_shortened(self):
+        ranges = block.zero_file_at_offsets(self.path, [self.size - 100],
+                                            dry_run=True)
+        self.assertEqual([(self.size - 100, 100)], ranges)
+
+    def test_short_range_strict_raises(self):
+        with self.assertRaises(ValueError):
+            block.zero_file_at_offsets(self.path, [self.size - 100],
+                                       strict=True, dry_run=True)
+
+    def test_bad_offset_skipped(self):
+        ranges = block.zero_file_at_offsets(
+            self.path, [self.size + 1, -(self.size + 1)], dry_run=True)
+        self.assertEqual([], ranges)
+        with self.assertRaises(ValueError):
+            block.zero_file_at_offsets(self.path, [self.size + 1],
+                                       strict=True, dry_run=True)
+
+    def test_overlapping_ranges_merged(self):
+        ranges = block.zero_file_at_offsets(self.path, [4096, 0, 1024, 3072],
+                                            buflen=1024, count=2)
+        self.assertEqual([(0, 6144)], ranges)
+        self.assertEqual([(0, 6144)], self._zeroed())
+
+    @mock.patch('curtin.block.os.fsync')
+    @mock.patch('curtin.block._pwrite')
+    def test_single_fsync_large_writes(self, m_pwrite, m_fsync):
+        m_pwrite.side_effect = lambda fd, data, offset: len(data)
+        block.zero_file_at_offsets(self.path, [0, -1024 * 1024])
+        self.assertEqual(2, m_pwrite.call_count)
+        self.assertEqual(1, m_fsync.call_count)
+
+    @mock.patch('curtin.block.sysfs_partition_data')
+    @mock.patch('curtin.block.is_block_device')
+    def test_quick_zero_partitions(self, m_is_block, m_ptdata):
+        mib = 1024 * 1024
+        m_is_block.return_value = True
+        m_ptdata.return_value = [('sda1', 1, 1 * mib, 3 * mib),
+                                 ('sda2', 2, 4 * mib, 2 * mib)]
+        expected = [(0, 2 * mib), (3 * mib, 3 * mib), (7 * mib, mib)]
+        self.assertEqual(expected, block.quick_zero(self.path, dry_run=True))
+        self.assertEqual([], self._zeroed())
+        self.assertEqual(expected, block.quick_zero(self.path))
+        self.assertEqual(expected, self._zeroed())
+
+    @mock.patch('curtin.block.sysfs_partition_data')
+    def test_quick_zero_file(self, m_ptdata):
+        mib = 1024 * 1024
+        expected = [(0, mib), (self.size - mib, mib)]
+        self.assertEqual(expected, block.quick_zero(self.path))
+        self.assertEqual(expected, self._zeroed())
+        self.assertEqual(0, m_ptdata.call_count)
+
+
+class TestSysfsPartitionData(CiTestCase):
+
+    def setUp(self):
+        super(TestSysfsPartitionData, self).setUp()
+        self.sysfs = self.tmp_dir()
+        self.paths = {'sda': os.path.join(self.sysfs, 'sda')}
+        util.write_file(
+            os.path.join(self.paths['sda'], 'queue', 'logical_block_size'),
+            '4096\n')
+        for (kname, number, start, size) in (('sda1', 1, 2048, 8192),
+                                             ('sda2', 2, 10240, 4096)):
+            self.paths[kname] = os.path.join(self.paths['sda'], kname)
+            for (sfile, value) in (('partition', number), ('start', start),
+                                   ('size', size)):
+                util.write_file(os.path.join(self.paths[kname], sfile),
+                                '%s\n' % value)
+        self.add_patch('curtin.block.sys_block_path', 'm_sys_block_path',
+                       side_effect=self._sys_block_path)
+
+    def _sys_block_path(self, devname, add=None, strict=True):
+        return self.paths[block.path_to_kname(devname)]
+
+    @mock.patch('curtin.block.get_blockdev_for_partition')
+    def test_offsets_in_512_byte_sectors(self, m_get_blockdev):
+        """sysfs_partition_data scales by 512 on 4k logical block disks"""
+        m_get_blockdev.return_value = ('/dev/sda', None)
+        self.assertEqual(
+            [('sda1', 1, 2048 * 512, 8192 * 512),
+             ('sda2', 2, 10240 * 512, 4096 * 512)],
+            sorted(block.sysfs_partition_data('/dev/sda')))
+
+    @mock.patch('curtin.block.get_blockdev_for_partition')
+    def test_single_partition(self, m_get_blockdev):
+        m_get_blockdev.return_value = ('/dev/sda', '2')
+        self.assertEqual([('sda2', 2, 10240 * 512, 4096 * 512)],
+                         block.sysfs_partition_data('/dev/sda2'))
+
+
 class TestWipeVolume(CiTestCase):
     dev = '/dev/null'
 
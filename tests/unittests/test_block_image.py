@@ -0,0 +1,330 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import bz2
+import gzip
+import hashlib
+import io
+import mock
+import os
+import tarfile
+import threading
+from unittest import skipUnless
+
+try:
+    from http.server import HTTPServer
+except ImportError:
+    # python2
+    from BaseHTTPServer import HTTPServer
+
+from curtin.block import image
+from curtin import util
+
+from .helpers import CiTestCase
+from .test_url_helper import _RangeRequestHandler
+
+
+def _image_content(size=3 * 1024 * 1024 + 123):
+    # a data block, a run of zeros large enough for a whole write buffer
+    # and an unaligned tail
+    data = b''.join([('%08d' % i).encode() for i in range(64 * 1024)])
+    zeros = b'\0' * (2 * 1024 * 1024)
+    content = data + zeros + data
+    return content[:size]
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def _tar(data, mode='w'):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        info = tarfile.TarInfo('disk.img')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class TestWriteImage(CiTestCase):
+    """Write images to a loop file, as to a block device."""
+
+    def setUp(self):
+        super(TestWriteImage, self).setUp()
+        self.content = _image_content()
+        self.target = self.tmp_path('disk.img')
+        # like a block device, the target already exists
+        with open(self.target, 'wb') as fp:
+            fp.truncate(len(self.content))
+
+    def _source(self, stype, data, **kwargs):
+        path = self.tmp_path('source.' + stype)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        kwargs.update({'type': stype, 'uri': 'file://' + path})
+        return kwargs
+
+    def _read_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_write_raw(self):
+        source = self._source('dd-raw', self.content)
+        stats = image.write_image(source, self.target)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(len(self.content), stats['bytes_written'])
+        self.assertEqual(0, stats['bytes_skipped'])
+
+    def test_write_gz(self):
+        # concatenated gzip streams, as written by pigz
+        half = len(self.content) // 2
+        data = _gzip(self.content[:half]) + _gzip(self.content[half:])
+        image.write_image(self._source('dd-gz', data), self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_bz2(self):
+        data = bz2.compress(self.content)
+        image.write_image(self._source('dd-bz2', data), self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    @skipUnless(image.lzma, "lzma module not available")
+    def test_write_xz(self):
+        data = image.lzma.compress(self.content)
+        image.write_image(self._source('dd-xz', data), self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_tgz(self):
+        data = _tar(self.content, mode='w:gz')
+        image.write_image(self._source('dd-tgz', data), self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_tgz_without_file_closes_source(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo('disk')
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        source_fp = io.BytesIO(buf.getvalue())
+        with mock.patch('curtin.block.image.open_source') as m_open:
+            m_open.return_value = source_fp
+            with self.assertRaises(ValueError):
+                image.write_image({'type': 'dd-tgz', 'uri': 'bad.tgz'},
+                                  self.target)
+        self.assertTrue(source_fp.closed)
+
+    def test_write_tar_detects_compression(self):
+        data = _tar(self.content, mode='w:bz2')
+        image.write_image(self._source('dd-tar', data), self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_external_decompressor(self):
+        source = self._source('dd-gz', _gzip(self.content),
+                              decompressor=['gzip', '-dc'])
+        image.write_image(source, self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_external_decompressor_failure(self):
+        source = self._source('dd-gz', self.content,
+                              decompressor=['gzip', '-dc'])
+        with self.assertRaises(RuntimeError):
+            image.write_image(source, self.target)
+
+    def test_write_sparse_leaves_holes_in_new_file(self):
+        os.unlink(self.target)
+        open(self.target, 'wb').close()
+        source = self._source('dd-raw', self.content, sparse=True)
+        stats = image.write_image(source, self.target, bufsize=1024 * 1024)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(1024 * 1024, stats['bytes_skipped'])
+        self.assertEqual(len(self.content) - 1024 * 1024,
+                         stats['bytes_written'])
+
+    def test_write_sparse_zeros_existing_data(self):
+        with open(self.target, 'wb') as fp:
+            fp.write(b'\xff' * len(self.content))
+        source = self._source('dd-raw', self.content, sparse=True)
+        stats = image.write_image(source, self.target, bufsize=1024 * 1024)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(0, stats['bytes_skipped'])
+
+    def test_write_image_ending_with_hole(self):
+        os.unlink(self.target)
+        open(self.target, 'wb').close()
+        content = self.content[:1024 * 1024] + b'\0' * 8192
+        source = self._source('dd-raw', content, sparse=True)
+        image.write_image(source, self.target, bufsize=4096)
+        self.assertEqual(content, self._read_target())
+
+    def test_write_not_sparse_by_default(self):
+        source = self._source('dd-raw', self.content)
+        with mock.patch.object(image.ImageWriter, '_is_zero') as m_is_zero:
+            image.write_image(source, self.target)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(0, m_is_zero.call_count)
+
+    def test_is_zero(self):
+        writer = image.ImageWriter(self.target, bufsize=8192, direct=False,
+                                   sparse=True)
+        try:
+            self.assertTrue(writer._is_zero(8192))
+            self.assertTrue(writer._is_zero(4096))
+            writer._buf[8191:8192] = b'\x01'
+            self.assertFalse(writer._is_zero(8192))
+            self.assertTrue(writer._is_zero(4096))
+            writer._buf[0:1] = b'\x01'
+            self.assertFalse(writer._is_zero(4096))
+        finally:
+            writer.close()
+
+    @mock.patch('curtin.block.image.block.zero_range')
+    def test_write_block_device_zeroes_skipped_ranges(self, m_zero_range):
+        m_zero_range.return_value = True
+        with mock.patch('curtin.block.image.stat.S_ISBLK',
+                        return_value=True):
+            stats = image.write_image(
+                self._source('dd-raw', self.content, sparse=True),
+                self.target, bufsize=1024 * 1024)
+        self.assertEqual(1024 * 1024, stats['bytes_skipped'])
+        self.assertEqual([mock.call(mock.ANY, 1024 * 1024, 1024 * 1024)],
+                         m_zero_range.call_args_list)
+
+    @mock.patch('curtin.block.image.block.zero_range')
+    def test_write_block_device_without_zeroout(self, m_zero_range):
+        m_zero_range.return_value = False
+        with open(self.target, 'wb') as fp:
+            fp.write(b'\xff' * len(self.content))
+        with mock.patch('curtin.block.image.stat.S_ISBLK',
+                        return_value=True):
+            stats = image.write_image(
+                self._source('dd-raw', self.content, sparse=True),
+                self.target, bufsize=1024 * 1024)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(0, stats['bytes_skipped'])
+        self.assertEqual(1, m_zero_range.call_count)
+
+    def test_write_image_larger_than_device(self):
+        with open(self.target, 'wb') as fp:
+            fp.truncate(4096)
+        for source in (self._source('dd-raw', self.content),
+                       self._source('dd-gz', _gzip(self.content))):
+            with mock.patch('curtin.block.image.stat.S_ISBLK',
+                            return_value=True):
+                with self.assertRaisesRegexp(ValueError, 'does not fit'):
+                    image.write_image(source, self.target)
+
+    def test_write_image_size_checked_before_writing(self):
+        with open(self.target, 'wb') as fp:
+            fp.truncate(4096)
+        source = self._source('dd-tgz', _tar(self.content, mode='w:gz'))
+        with mock.patch('curtin.block.image.stat.S_ISBLK',
+                        return_value=True):
+            with mock.patch.object(image.ImageWriter, '_write') as m_write:
+                with self.assertRaisesRegexp(ValueError, 'does not fit'):
+                    image.write_image(source, self.target)
+        self.assertEqual(0, m_write.call_count)
+
+    def test_write_buffered(self):
+        source = self._source('dd-raw', self.content)
+        image.write_image(source, self.target, bufsize=64 * 1024,
+                          direct=False)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_checksum_of_compressed_source(self):
+        data = _tar(self.content, mode='w:gz')
+        checksum = 'sha256:' + hashlib.sha256(data).hexdigest()
+        source = self._source('dd-tgz', data, checksum=checksum)
+        image.write_image(source, self.target)
+        self.assertEqual(self.content, self._read_target())
+
+    def test_write_checksum_mismatch(self):
+        source = self._source('dd-raw', self.content,
+                              checksum='sha256:' + '0' * 64)
+        with self.assertRaisesRegexp(ValueError, 'Checksum mismatch'):
+            image.write_image(source, self.target)
+
+    def test_write_invalid_checksum(self):
+        source = self._source('dd-raw', self.content, checksum='abc')
+        with self.assertRaisesRegexp(ValueError, 'Invalid checksum'):
+            image.write_image(source, self.target)
+
+    def test_write_unsupported_type(self):
+        source = self._source('dd-zip', self.content)
+        with self.assertRaisesRegexp(ValueError, 'Unsupported image type'):
+            image.write_image(source, self.target)
+
+    def test_bufsize_must_be_aligned(self):
+        source = self._source('dd-raw', self.content)
+        with self.assertRaises(ValueError):
+            image.write_image(source, self.target, bufsize=1000)
+
+    @mock.patch('curtin.block.image.events.ReportEventStack')
+    def test_write_reports_throughput(self, m_stack):
+        source = self._source('dd-raw', self.content)
+        image.write_image(source, self.target, report_prefix='cmd')
+        self.assertEqual('cmd/write-image', m_stack.call_args[1]['name'])
+        reportstack = m_stack.return_value.__enter__.return_value
+        self.assertIn('MiB/s', reportstack.message)
+
+
+class TestWriteImageHTTP(CiTestCase):
+    """Stream images from a local http server."""
+
+    def setUp(self):
+        super(TestWriteImageHTTP, self).setUp()
+        self.content = _image_content()
+        self.server = HTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+        self.server.content = _gzip(self.content)
+        self.server.ranges = True
+        self.server.drop_after = None
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/disk.img.gz' % self.server.server_port
+        self.target = self.tmp_path('disk.img')
+        with open(self.target, 'wb') as fp:
+            fp.truncate(len(self.content))
+
+    def test_write_http_gz(self):
+        image.write_image({'type': 'dd-gz', 'uri': self.url}, self.target)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.content, fp.read())
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_write_http_resumes_after_dropped_connection(self, m_sleep):
+        self.server.drop_after = 1000
+        image.write_image({'type': 'dd-gz', 'uri': self.url}, self.target)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.content, fp.read())
+        self.assertEqual([None, 'bytes=1000-'], self.server.requests)
+
+    def test_stream_to_command(self):
+        out = self.tmp_path('out')
+        image.stream_to_command(
+            self.url, ['sh', '-c', 'gzip -dc > "$1"', '--', out])
+        with open(out, 'rb') as fp:
+            self.assertEqual(self.content, fp.read())
+
+    def test_stream_to_command_failure(self):
+        with self.assertRaises(util.ProcessExecutionError):
+            image.stream_to_command(self.url, ['sh', '-c', 'exit 2'])
+
+
+class TestOpenOutput(CiTestCase):
+
+    @skipUnless(hasattr(os, 'O_DIRECT'), "O_DIRECT not available")
+    @mock.patch('curtin.block.image.os.open')
+    def test_direct_falls_back_on_einval(self, m_open):
+        m_open.side_effect = [OSError(22, 'Invalid argument'), 3]
+        self.assertEqual((3, False), image._open_output('/dev/x'))
+        m_open.assert_has_calls([mock.call('/dev/x',
+                                           os.O_WRONLY | os.O_DIRECT),
+                                 mock.call('/dev/x', os.O_WRONLY)])
+
+# vi: ts=4 expandtab syntax=python
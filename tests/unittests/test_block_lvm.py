@@ -1,8 +1,10 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from curtin import util
 from curtin.block import lvm
 
 from .helpers import CiTestCase
+import json
 import mock
 
 
@@ -126,4 +128,86 @@ class TestBlockLvmMultipathFilter(CiTestCase):
         self.assertEqual(expected, lvm.generate_multipath_dm_uuid_filter())
 
 
+PVS_JSON = json.dumps({'report': [{'pv': [
+    {'pv_name': '/dev/sda1', 'vg_name': 'ubuntu-vg'},
+    {'pv_name': '/dev/sdb1', 'vg_name': 'ubuntu-vg'},
+    {'pv_name': '/dev/sdc1', 'vg_name': 'data'},
+    {'pv_name': '/dev/sdd1', 'vg_name': ''}]}]})
+LVS_JSON = json.dumps({'report': [{'lv': [
+    {'lv_name': 'root', 'vg_name': 'ubuntu-vg', 'lv_size': '8589934592B'},
+    {'lv_name': 'swap-1', 'vg_name': 'ubuntu-vg', 'lv_size': '1073741824B'},
+    {'lv_name': 'srv', 'vg_name': 'data', 'lv_size': '4194304B'}]}]})
+
+
+class TestLvmSnapshot(CiTestCase):
+
+    def setUp(self):
+        super(TestLvmSnapshot, self).setUp()
+        self.add_patch('curtin.block.lvm.util.subp', 'm_subp')
+        self.m_subp.side_effect = self._subp
+        patcher = mock.patch.dict('curtin.block.lvm._report_state',
+                                  {'json': True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _subp(self, cmd, capture=False):
+        if cmd[0] == 'pvs':
+            return (PVS_JSON, '')
+        if cmd[0] == 'lvs':
+            return (LVS_JSON, '')
+        return ('', '')
+
+    def test_inactive_by_default(self):
+        self.assertIsNone(lvm.current())
+
+    def test_queries_answered_from_one_snapshot(self):
+        with lvm.active():
+            self.assertEqual(['/dev/sda1', '/dev/sdb1'],
+                             lvm.get_pvols_in_volgroup('ubuntu-vg'))
+            self.assertEqual(['root', 'swap-1'],
+                             lvm.get_lvols_in_volgroup('ubuntu-vg'))
+            self.assertEqual(4194304, lvm.get_lv_size_bytes('srv'))
+            self.assertEqual(['ubuntu-vg', 'swap-1'],
+                             lvm.split_lvm_name('ubuntu--vg-swap--1'))
+        self.assertIsNone(lvm.current())
+        self.assertEqual(
+            [mock.call(['pvs', '--units=B', '-o', 'pv_name,vg_name',
+                        '--reportformat', 'json'], capture=True),
+             mock.call(['lvs', '--units=B', '-o', 'lv_name,vg_name,lv_size',
+                        '--reportformat', 'json'], capture=True)],
+            self.m_subp.call_args_list)
+
+    def test_unknown_name_uses_dmsetup(self):
+        with lvm.active():
+            lvm.split_lvm_name('crypt-root')
+        self.assertEqual('dmsetup', self.m_subp.call_args[0][0][0])
+
+    def test_invalidated_by_changes(self):
+        with lvm.active():
+            first = lvm.current()
+            self.assertIs(first, lvm.current())
+            lvm.activate_volgroups()
+            self.assertIsNot(first, lvm.current())
+
+    def test_column_fallback_without_json(self):
+        def subp(cmd, capture=False):
+            if '--reportformat' in cmd:
+                raise util.ProcessExecutionError(
+                    cmd=cmd, exit_code=3,
+                    stderr='Unrecognised option --reportformat')
+            return ('  /dev/sda1{0}vg0\n  /dev/sdb1{0}\n'.format(lvm._SEP),
+                    '')
+        self.m_subp.side_effect = subp
+        self.assertEqual([{'pv_name': '/dev/sda1', 'vg_name': 'vg0'},
+                          {'pv_name': '/dev/sdb1', 'vg_name': ''}],
+                         lvm._lvm_report('pvs', lvm.PV_FIELDS))
+        self.assertFalse(lvm._report_state['json'])
+        self.m_subp.reset_mock()
+        lvm._lvm_report('pvs', lvm.PV_FIELDS)
+        self.assertEqual(1, self.m_subp.call_count)
+
+    def test_dm_name(self):
+        self.assertEqual('ubuntu--vg-swap--1',
+                         lvm.dm_name('ubuntu-vg', 'swap-1'))
+
 # vi: ts=4 expandtab syntax=python
@@ -7,6 +7,8 @@ from curtin import util
 from .helpers import CiTestCase, raise_pexec_error
 import os
 import textwrap
+import threading
+import time
 
 
 class TestBlockMdadmAssemble(CiTestCase):
@@ -228,6 +230,17 @@ class TestBlockMdadmCreate(CiTestCase):
                            devices=devices, spares=spares)
         self.mock_util.subp.assert_has_calls(expected_calls)
 
+    def test_mdadm_create_assume_clean(self):
+        md_devname = "/dev/md0"
+        raidlevel = 1
+        devices = ['/dev/vdc1', '/dev/vdd1']
+        self.mock_util.subp.return_value = ('ubuntu', '')
+        mdadm.mdadm_create(md_devname=md_devname, raidlevel=raidlevel,
+                           devices=devices, assume_clean=True)
+        cmd = self.mock_util.subp.call_args_list[2][0][0]
+        self.assertEqual(['--raid-devices=2', '--assume-clean', '/dev/vdc1',
+                          '/dev/vdd1'], cmd[-4:])
+
 
 class TestBlockMdadmExamine(CiTestCase):
     def setUp(self):
@@ -1245,4 +1258,141 @@ class TestBlockMdadmZeroDevice(CiTestCase):
                                        buflen=1024, count=1024, strict=True)
 
 
+class TestBlockMdadmSyncControl(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockMdadmSyncControl, self).setUp()
+        self.md_devname = '/dev/md0'
+        self.sysmd = self.tmp_dir()
+        self.add_patch('curtin.block.mdadm.sys_block_path', 'm_sys_block')
+        self.add_patch('curtin.block.mdadm.is_valid_device', 'm_valid')
+        self.add_patch('curtin.block.mdadm.select', 'm_select')
+        self.add_patch('curtin.block.mdadm.LOG', 'm_log')
+        self.m_sys_block.return_value = self.sysmd
+        self.m_valid.return_value = True
+        self.m_poll = self.m_select.poll.return_value
+        self.state_file = self.tmp_path('md-sync-control.json')
+
+    def write_attrs(self, **attrs):
+        for name, value in attrs.items():
+            util.write_file(os.path.join(self.sysmd, name), value)
+
+    def read_attr(self, name):
+        return util.load_file(os.path.join(self.sysmd, name))
+
+    def test_md_sync_completed(self):
+        """ md_sync_completed parses idle, delayed and running syncs. """
+        self.assertIsNone(mdadm.md_sync_completed('none\n'))
+        self.assertEqual((None, None), mdadm.md_sync_completed('delayed\n'))
+        self.assertEqual((512, 2048), mdadm.md_sync_completed('512 / 2048\n'))
+
+    def test_block_until_in_sync_no_sync_completed(self):
+        """ md_block_until_in_sync returns for arrays without sync. """
+        self.assertTrue(mdadm.md_block_until_in_sync(self.md_devname))
+        self.assertEqual(0, self.m_poll.poll.call_count)
+
+    def test_block_until_in_sync_idle(self):
+        """ md_block_until_in_sync returns at once for an idle array. """
+        self.write_attrs(sync_completed='none\n', sync_action='idle\n')
+        self.assertTrue(mdadm.md_block_until_in_sync(self.md_devname))
+        self.assertEqual(0, self.m_poll.poll.call_count)
+
+    def test_block_until_in_sync_polls_until_done(self):
+        """ md_block_until_in_sync polls sync_completed and logs progress.
+        """
+        self.write_attrs(sync_completed='512 / 2048\n',
+                         sync_action='resync\n')
+
+        def finish(_timeout):
+            self.write_attrs(sync_completed='none\n', sync_action='idle\n')
+            return []
+
+        self.m_poll.poll.side_effect = finish
+        self.assertTrue(mdadm.md_block_until_in_sync(self.md_devname,
+                                                     interval=5))
+        self.assertEqual([call(5000)], self.m_poll.poll.call_args_list)
+        self.assertEqual(self.m_select.POLLPRI | self.m_select.POLLERR,
+                         self.m_poll.register.call_args[0][1])
+        self.assertIn(call('mdadm: %s %s %.1f%% (%d/%d sectors)',
+                           self.md_devname, 'resync', 25.0, 512, 2048),
+                      self.m_log.info.call_args_list)
+
+    def test_block_until_in_sync_timeout(self):
+        """ md_block_until_in_sync returns False on timeout. """
+        self.write_attrs(sync_completed='delayed\n',
+                         sync_action='resync\n')
+        self.assertFalse(mdadm.md_block_until_in_sync(self.md_devname,
+                                                      timeout=0))
+        self.assertIn(call('mdadm: %s %s pending', self.md_devname, 'resync'),
+                      self.m_log.info.call_args_list)
+
+    def test_block_until_in_sync_frozen(self):
+        """ md_block_until_in_sync does not wait on a frozen sync. """
+        self.write_attrs(sync_completed='512 / 2048\n',
+                         sync_action='frozen\n')
+        self.assertFalse(mdadm.md_block_until_in_sync(self.md_devname))
+        self.assertEqual(0, self.m_poll.poll.call_count)
+
+    @patch('curtin.block.mdadm.set_sync_action')
+    def test_set_and_restore_sync_control(self, m_set_action):
+        """ restore_sync_control restores what set_sync_control changed.
+        """
+        self.write_attrs(sync_speed_min='1000 (system)\n',
+                         sync_speed_max='50000 (local)\n',
+                         sync_action='resync\n')
+        mdadm.set_sync_control(self.md_devname, self.state_file,
+                               speed_max=200, freeze=True)
+        self.assertEqual('1000 (system)\n', self.read_attr('sync_speed_min'))
+        self.assertEqual('200', self.read_attr('sync_speed_max'))
+        m_set_action.assert_called_with(self.md_devname, action='frozen')
+
+        # a later change keeps the values recorded first
+        mdadm.set_sync_control(self.md_devname, self.state_file,
+                               speed_min=100, speed_max=300)
+        self.assertEqual(
+            {self.md_devname: {'sync_speed_min': 'system',
+                               'sync_speed_max': '50000', 'frozen': True}},
+            util.load_json(util.load_file(self.state_file)))
+
+        mdadm.restore_sync_control(self.state_file)
+        self.assertEqual('system', self.read_attr('sync_speed_min'))
+        self.assertEqual('50000', self.read_attr('sync_speed_max'))
+        self.assertEqual('idle', self.read_attr('sync_action'))
+        self.assertFalse(os.path.exists(self.state_file))
+
+    @patch('curtin.block.mdadm._write_md_attr')
+    @patch('curtin.block.mdadm.md_sync_speed')
+    @patch('curtin.block.mdadm.assert_valid_devpath')
+    def test_set_sync_control_concurrent(self, m_valid, m_speed, m_write):
+        """ set_sync_control from several threads records every array. """
+        m_speed.return_value = 'system'
+        load_sync_control = mdadm._load_sync_control
+
+        def slow_load(state_file):
+            # widen the window between reading and writing the state file
+            controls = load_sync_control(state_file)
+            time.sleep(0.01)
+            return controls
+
+        md_devnames = ['/dev/md%d' % index for index in range(8)]
+        with patch('curtin.block.mdadm._load_sync_control',
+                   side_effect=slow_load):
+            threads = [threading.Thread(target=mdadm.set_sync_control,
+                                        args=(md_devname, self.state_file),
+                                        kwargs={'speed_max': 200})
+                       for md_devname in md_devnames]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(
+            sorted(md_devnames),
+            sorted(util.load_json(util.load_file(self.state_file))))
+
+    def test_restore_sync_control_no_state(self):
+        """ restore_sync_control does nothing without a state file. """
+        mdadm.restore_sync_control(self.state_file)
+        self.assertEqual([], os.listdir(self.sysmd))
+
+
 # vi: ts=4 expandtab syntax=python
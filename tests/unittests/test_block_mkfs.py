@@ -72,6 +72,23 @@ class TestBlockMkfs(CiTestCase):
                           ["-U", self.test_uuid]] + extra_options
         self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags)
 
+    def test_mkfs_ext_lazy_init_nodiscard(self):
+        """ ext lazy_itable_init and nodiscard share one -E option """
+        conf = self._get_config("ext4")
+        conf.update({'lazy_itable_init': True, 'nodiscard': True,
+                     'extra_options': ['-E', 'stride=16']})
+        expected_flags = [["-L", "format1"], "-F", ["-U", self.test_uuid],
+                          ["-E", "lazy_itable_init=1,nodiscard,stride=16"]]
+        self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags)
+
+    def test_mkfs_xfs_nodiscard_ignores_lazy_init(self):
+        """ xfs maps nodiscard to -K and has no lazy_itable_init """
+        conf = self._get_config("xfs")
+        conf.update({'lazy_itable_init': False, 'nodiscard': True})
+        expected_flags = ['-f', ['-L', 'format1'],
+                          ['-m', 'uuid=%s' % self.test_uuid], '-K']
+        self._run_mkfs_with_config(conf, "mkfs.xfs", expected_flags)
+
     def test_mkfs_btrfs(self):
         conf = self._get_config("btrfs")
         expected_flags = [["--label", "format1"], "--force",
@@ -154,6 +171,45 @@ class TestBlockMkfs(CiTestCase):
         self.assertEquals(call[0], "mkfs.ext4")
         self._assert_same_flags(call, expected_flags)
 
+    @mock.patch("curtin.block.mkfs.block")
+    @mock.patch("curtin.block.mkfs.util")
+    @mock.patch("curtin.block.mkfs.os")
+    def test_mkfs_ext_journal_device(self, mock_os, mock_util, mock_block):
+        """ext journal_device is made an external journal of the same
+           block size as the filesystem"""
+        mock_block.get_blockdev_sector_size.return_value = (512, 512)
+        mkfs.mkfs("/dev/sda1", "ext4", uuid=self.test_uuid,
+                  journal_device="/dev/nvme0n1p1")
+        calls = mock_util.subp.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual(["mke2fs", "-F", "-q", "-O", "journal_dev", "-b",
+                          "4096", "/dev/nvme0n1p1"], calls[0][0][0])
+        call = calls[1][0][0]
+        self.assertEqual("mkfs.ext4", call[0])
+        self._assert_same_flags(call, [["-U", self.test_uuid],
+                                       ["-b", "4096"],
+                                       ["-J", "device=/dev/nvme0n1p1"]])
+
+    @mock.patch("curtin.block.mkfs.block")
+    @mock.patch("curtin.block.mkfs.util")
+    @mock.patch("curtin.block.mkfs.os")
+    def test_mkfs_xfs_journal_device(self, mock_os, mock_util, mock_block):
+        """xfs journal_device is used as external log device"""
+        mock_block.get_blockdev_sector_size.return_value = (512, 512)
+        mkfs.mkfs("/dev/sda1", "xfs", uuid=self.test_uuid,
+                  journal_device="/dev/nvme0n1p1")
+        calls = mock_util.subp.call_args_list
+        self.assertEqual(1, len(calls))
+        self._assert_same_flags(calls[0][0][0],
+                                [["-m", "uuid=%s" % self.test_uuid],
+                                 ["-l", "logdev=/dev/nvme0n1p1"]])
+
+    def test_merge_extended_options(self):
+        self.assertEqual(
+            ["mkfs.ext4", "-E", "a=1,b", "-F", "/dev/sda"],
+            mkfs.merge_extended_options(
+                ["mkfs.ext4", "-E", "a=1", "-F", "-E", "b", "/dev/sda"]))
+
     @mock.patch("curtin.block.mkfs.os")
     def test_mkfs_invalid_block_device(self, mock_os):
         """Do not proceed if block device is none or is not valid block dev"""
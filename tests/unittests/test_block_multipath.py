@@ -1,6 +1,7 @@
 import mock
 
 from curtin.block import multipath
+from curtin import udev, util
 from .helpers import CiTestCase, raise_pexec_error
 
 
@@ -286,4 +287,100 @@ class TestMultipath(CiTestCase):
                          sorted(m_del_file.call_args_list))
 
 
+SHOW_PATHS_OUTPUT = '\n'.join([
+    "device='sda' serial='s1' multipath='mpatha'",
+    "device='sdb' serial='s1' multipath='mpatha'",
+    "device='sdc' serial='s2' multipath='[orphan]'",
+])
+SHOW_MAPS_OUTPUT = '\n'.join([
+    "name='mpatha' multipath='3600a' sysfs='dm-0' paths='2'",
+    "name='nvme' multipath='eui.3352' sysfs='nvme0n1' paths='1'",
+])
+
+
+class TestMultipathTopology(CiTestCase):
+
+    def setUp(self):
+        super(TestMultipathTopology, self).setUp()
+        self.add_patch('curtin.block.multipath.util.subp', 'm_subp')
+        self.add_patch('curtin.block.multipath.udev', 'm_udev')
+        self.add_patch('curtin.block.multipath.os.path.exists', 'm_exists')
+        self.m_subp.side_effect = self._subp
+        self.m_exists.return_value = False
+
+    def _subp(self, cmd, *args, **kwargs):
+        if cmd[:3] == ['multipathd', 'show', 'paths']:
+            return (SHOW_PATHS_OUTPUT, '')
+        if cmd[:3] == ['multipathd', 'show', 'maps']:
+            return (SHOW_MAPS_OUTPUT, '')
+        if cmd[:2] == ['dmsetup', 'ls']:
+            return (DMSETUP_LS_BLKDEV_OUTPUT, '')
+        return ('', '')
+
+    def _queries(self):
+        return [cmd for ((cmd,), _kw) in self.m_subp.call_args_list
+                if cmd[:2] in (['multipathd', 'show'], ['dmsetup', 'ls'])]
+
+    def test_no_topology_outside_active(self):
+        """current returns None outside of active."""
+        self.assertIsNone(multipath.current())
+        with multipath.active():
+            self.assertIsNotNone(multipath.current())
+        self.assertIsNone(multipath.current())
+
+    def test_queries_answered_from_one_snapshot(self):
+        """membership, map and partition queries share one snapshot."""
+        with multipath.active():
+            self.assertTrue(multipath.is_mpath_member('/dev/sda'))
+            self.assertFalse(multipath.is_mpath_member('/dev/sdc'))
+            self.assertFalse(multipath.is_mpath_member('/dev/vda'))
+            self.assertTrue(multipath.is_mpath_device('/dev/dm-0'))
+            self.assertTrue(multipath.is_mpath_device('/dev/mapper/mpatha'))
+            self.assertFalse(multipath.is_mpath_device('/dev/nvme0n1'))
+            self.assertEqual('mpatha', multipath.find_mpath_id('/dev/dm-0'))
+            self.assertEqual('mpatha',
+                             multipath.find_mpath_id_by_path('/dev/sdb'))
+            self.assertEqual(['/dev/sda', '/dev/sdb'],
+                             multipath.find_mpath_members('mpatha'))
+            self.assertEqual(['mpatha-part1'],
+                             list(multipath.find_mpath_partitions('mpatha')))
+            self.assertEqual(('mpatha-part1', '/dev/dm-1'),
+                             multipath.find_mpath_id_by_parent('mpatha', 1))
+        self.assertEqual(3, len(self._queries()))
+        self.assertEqual(0, self.m_udev.udevadm_info.call_count)
+        self.assertNotIn(['multipath', '-c', '/dev/sda'],
+                         [call[0][0] for call in self.m_subp.call_args_list])
+
+    def test_reload_and_remove_retake_snapshot(self):
+        """reload, remove_map and remove_partition drop the snapshot."""
+        with multipath.active():
+            multipath.is_mpath_member('/dev/sda')
+            multipath.reload()
+            multipath.is_mpath_member('/dev/sda')
+            multipath.remove_map('mpatha')
+            multipath.is_mpath_member('/dev/sda')
+            multipath.remove_partition('/dev/mapper/mpatha-part1')
+            multipath.is_mpath_member('/dev/sda')
+        self.assertEqual(12, len(self._queries()))
+
+    def test_settle_retakes_snapshot(self):
+        """a udev settle drops the snapshot, dm names can change."""
+        with multipath.active():
+            first = multipath.current()
+            self.assertIs(first, multipath.current())
+            udev.udevadm_settle()
+            self.assertIsNot(first, multipath.current())
+        self.assertEqual(6, len(self._queries()))
+
+    def test_falls_back_without_multipathd(self):
+        """queries run their own commands if multipathd is unavailable."""
+        self.m_subp.side_effect = util.ProcessExecutionError()
+        with multipath.active():
+            self.assertIsNone(multipath.current())
+            self.assertFalse(multipath.is_mpath_member('/dev/sda'))
+        self.assertIn(mock.call(['multipath', '-c', '/dev/sda'],
+                                capture=True),
+                      self.m_subp.call_args_list)
+
+
 # vi: ts=4 expandtab syntax=python
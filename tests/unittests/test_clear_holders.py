@@ -210,6 +210,36 @@ class TestClearHolders(CiTestCase):
             mock_zero.assert_any_call(pv, partitions=False)
         self.assertTrue(mock_lvm.lvm_scan.called)
 
+    @mock.patch('curtin.block.quick_zero')
+    @mock.patch('curtin.block.clear_holders.block.sys_block_path')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_shutdown_lvm_checks_volgroup_after_lvremove(
+            self, mock_util, mock_lvm, mock_syspath, mock_zero):
+        """shutdown_lvm removes the volgroup if no lvol is left after
+           lvremove, even if another lvol was present before"""
+        vg_name = 'ubuntu-vg'
+        pvols = ['/dev/wda1', '/dev/wdb1']
+        mock_syspath.return_value = self.test_blockdev
+        mock_util.load_file.return_value = 'ubuntu--vg-swap\n'
+        mock_lvm.split_lvm_name.return_value = (vg_name, 'swap')
+        mock_lvm.get_pvols_in_volgroup.return_value = pvols
+        lvols = [['swap', 'root']]
+
+        def subp(cmd, **kwargs):
+            # another shutdown_lvm removed 'root' meanwhile
+            if cmd[0] == 'lvremove':
+                lvols[0] = []
+            return ('', '')
+
+        mock_util.subp.side_effect = subp
+        mock_lvm.get_lvols_in_volgroup.side_effect = lambda vg: lvols[0]
+        clear_holders.shutdown_lvm(self.test_blockdev)
+        mock_util.subp.assert_any_call(
+            ['vgremove', '--force', '--force', vg_name], rcs=[0, 5])
+        for pv in pvols:
+            mock_zero.assert_any_call(pv, partitions=False)
+
     @mock.patch('curtin.block.clear_holders.block')
     @mock.patch('curtin.block.clear_holders.util')
     def test_shutdown_crypt(self, mock_util, mock_block):
@@ -746,6 +776,287 @@ class TestClearHolders(CiTestCase):
         self.assertNotIn(mock.call('zfs'),
                          mock_util.load_kernel_module.call_args_list)
 
+    def _record_shutdowns(self, calls):
+        """replace shutdown handlers with ones appending to calls"""
+        def wipe(device):
+            calls.append(('wipe', device))
+
+        handlers = {}
+        for dev_type, funcs in clear_holders.DEV_TYPES.items():
+            handlers[dev_type] = dict(funcs)
+            if funcs.get('shutdown') in clear_holders.DATA_DESTROYING_HANDLERS:
+                handlers[dev_type]['shutdown'] = wipe
+            else:
+                handlers[dev_type]['shutdown'] = (
+                    lambda device, dev_type=dev_type:
+                    calls.append((dev_type, device)))
+        for patcher in (mock.patch.dict(clear_holders.DEV_TYPES, handlers),
+                        mock.patch.object(clear_holders,
+                                          'DATA_DESTROYING_HANDLERS', [wipe])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _record_deps_steps(self, calls, mock_util, mock_mdadm, mock_mp,
+                           mock_lvm, mock_udev):
+        """make start_clear_holders_deps steps append to calls"""
+        mock_util.ProcessExecutionError = ProcessExecutionError
+        mock_mp.multipath_supported.return_value = True
+
+        def record(name):
+            return lambda *args, **kwargs: calls.append(name)
+
+        for mocked, name in ((mock_mdadm, 'mdadm_assemble'),
+                             (mock_mp, 'reload'),
+                             (mock_lvm, 'lvm_scan'),
+                             (mock_lvm, 'activate_volgroups'),
+                             (mock_util, 'load_kernel_module'),
+                             (mock_udev, 'udevadm_settle')):
+            getattr(mocked, name).side_effect = record(name)
+
+        def mdadm_run(md):
+            calls.append('run ' + md)
+            if md == '/dev/md0':
+                raise ProcessExecutionError()
+            return ('', '')
+
+        mock_mdadm.mdadm_run.side_effect = mdadm_run
+        mock_mdadm.mdadm_query_detail.return_value = ('', '')
+
+    @mock.patch('curtin.block.clear_holders.identify_partition')
+    @mock.patch('curtin.block.clear_holders.glob.glob')
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_start_clear_holders_deps_order(self, mock_util, mock_mdadm,
+                                            mock_zfs, mock_lvm, mock_mp,
+                                            mock_udev, m_exists, m_glob,
+                                            m_ident):
+        """start_clear_holders_deps runs steps in order with one worker"""
+        m_exists.return_value = False
+        m_glob.return_value = ['/dev/md0', '/dev/md1']
+        m_ident.return_value = False
+        calls = []
+        self._record_deps_steps(calls, mock_util, mock_mdadm, mock_mp,
+                                mock_lvm, mock_udev)
+        timings = clear_holders.start_clear_holders_deps()
+        self.assertEqual(['mdadm_assemble', 'run /dev/md0', 'run /dev/md1',
+                          'reload', 'lvm_scan', 'activate_volgroups',
+                          'load_kernel_module', 'udevadm_settle'], calls)
+        self.assertEqual(['mdadm-assemble', 'mdadm-run', 'multipath', 'lvm',
+                          'bcache', 'udev-settle'], list(timings))
+        self.assertEqual(2, mock_mdadm.mdadm_query_detail.call_count)
+
+    @mock.patch('curtin.block.clear_holders.identify_partition')
+    @mock.patch('curtin.block.clear_holders.glob.glob')
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_start_clear_holders_deps_concurrent(self, mock_util, mock_mdadm,
+                                                 mock_zfs, mock_lvm, mock_mp,
+                                                 mock_udev, m_exists, m_glob,
+                                                 m_ident):
+        """start_clear_holders_deps starts lvm after md arrays and multipath"""
+        m_exists.return_value = False
+        m_glob.return_value = ['/dev/md%d' % num for num in range(8)]
+        m_ident.return_value = False
+        calls = []
+        self._record_deps_steps(calls, mock_util, mock_mdadm, mock_mp,
+                                mock_lvm, mock_udev)
+        clear_holders.start_clear_holders_deps(max_workers=4)
+        self.assertEqual('mdadm_assemble', calls[0])
+        lvm_scan = calls.index('lvm_scan')
+        self.assertEqual(9, len([call for call in calls[:lvm_scan]
+                                 if call.startswith('run ') or
+                                 call == 'reload']))
+        self.assertEqual('udevadm_settle', calls[-1])
+        self.assertIn('load_kernel_module', calls)
+
+    @mock.patch('curtin.block.clear_holders.glob.glob')
+    @mock.patch('curtin.block.clear_holders.udev')
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.lvm')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.mdadm')
+    @mock.patch('curtin.block.clear_holders.util')
+    def test_start_clear_holders_deps_raises(self, mock_util, mock_mdadm,
+                                             mock_zfs, mock_lvm, mock_mp,
+                                             mock_udev, m_glob):
+        """start_clear_holders_deps raises multipath errors, skipping lvm"""
+        m_glob.return_value = []
+        mock_mp.multipath_supported.return_value = True
+        mock_mp.reload.side_effect = ProcessExecutionError()
+        with self.assertRaises(ProcessExecutionError):
+            clear_holders.start_clear_holders_deps()
+        self.assertEqual(0, mock_lvm.lvm_scan.call_count)
+        self.assertEqual(0, mock_udev.udevadm_settle.call_count)
+
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.gen_holders_forest')
+    def test_clear_holders_runs_plan_in_order(self, mock_gen_holders_forest,
+                                              m_exists):
+        """clear_holders with one worker shuts down in shutdown plan order"""
+        trees = [self.example_holders_trees[0][0],
+                 self.example_holders_trees[1][0]]
+        mock_gen_holders_forest.return_value = trees
+        m_exists.return_value = True
+        calls = []
+        self._record_shutdowns(calls)
+        clear_holders.clear_holders(['/dev/sda', '/dev/vdb'])
+
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        self.assertEqual([dev_info['device'] for dev_info in plan],
+                         [device for _, device in calls])
+
+    @mock.patch('curtin.block.clear_holders.parallel.run_graph')
+    @mock.patch('curtin.block.clear_holders.os.path.exists')
+    @mock.patch('curtin.block.clear_holders.gen_holders_forest')
+    def test_clear_holders_preserve_skips_wipes(self,
+                                                mock_gen_holders_forest,
+                                                m_exists, m_run_graph):
+        """clear_holders with try_preserve keeps wiped devices as no-ops"""
+        trees = [self.example_holders_trees[0][0],
+                 self.example_holders_trees[1][0]]
+        mock_gen_holders_forest.return_value = trees
+        m_exists.return_value = True
+        calls = []
+
+        def run_graph(graph, func, max_workers=1):
+            for node in graph:
+                func(node)
+
+        m_run_graph.side_effect = run_graph
+        self._record_shutdowns(calls)
+        clear_holders.clear_holders(['/dev/sda', '/dev/vdb'],
+                                    try_preserve=True, max_workers=3)
+
+        self.assertEqual(['bcache', 'raid', 'bcache', 'crypt', 'lvm', 'lvm',
+                          'crypt'], [dev_type for dev_type, _ in calls])
+        graph = m_run_graph.call_args[0][0]
+        self.assertIn('/sys/class/block/sda', graph)
+        self.assertEqual(3, m_run_graph.call_args[1]['max_workers'])
+
+    @mock.patch('curtin.block.clear_holders.util.subp')
+    @mock.patch('curtin.block.clear_holders.inventory.walk_sysfs')
+    @mock.patch('curtin.block.clear_holders.block.sys_block_path')
+    def test_gen_holders_forest(self, m_syspath, m_walk, m_subp):
+        """gen_holders_forest identifies devices from one sysfs walk"""
+        def dev(holders=(), partition=None, parent=None, dm_uuid=None):
+            return {'size': 512, 'partition': partition, 'parent': parent,
+                    'holders': list(holders), 'slaves': [],
+                    'dm_uuid': dm_uuid}
+
+        m_syspath.side_effect = (
+            lambda path, strict=True: ('/sys/class/block/' +
+                                       os.path.basename(path)))
+        m_walk.return_value = {
+            'sda': dev(),
+            'sda1': dev(['md0'], partition=1, parent='sda'),
+            'sda2': dev(['dm-0'], partition=2, parent='sda'),
+            'md0': dev(['bcache0']),
+            'md0p1': dev(partition=1, parent='md0'),
+            'bcache0': dev(),
+            'dm-0': dev(['dm-1'], dm_uuid='CRYPT-LUKS2-1234-sda2_crypt'),
+            'dm-1': dev(dm_uuid='LVM-abcd'),
+            'dm-2': dev(dm_uuid='part1-mpath-3600a'),
+            'vdb': dev(),
+        }
+
+        def types(tree):
+            return [(tree['name'], tree['dev_type'], tree['device'])] + [
+                item for holder in tree['holders'] for item in types(holder)]
+
+        sda, vdb, dm2 = clear_holders.gen_holders_forest(
+            ['/dev/sda', '/dev/vdb', '/dev/dm-2'])
+        self.assertEqual([
+            ('sda', 'disk', '/sys/class/block/sda'),
+            ('sda1', 'partition', '/sys/class/block/sda/sda1'),
+            ('md0', 'raid', '/sys/class/block/md0'),
+            ('bcache0', 'bcache', '/sys/class/block/bcache0'),
+            ('md0p1', 'partition', '/sys/class/block/md0/md0p1'),
+            ('sda2', 'partition', '/sys/class/block/sda/sda2'),
+            ('dm-0', 'crypt', '/sys/class/block/dm-0'),
+            ('dm-1', 'lvm', '/sys/class/block/dm-1')], types(sda))
+        self.assertEqual({'device': '/sys/class/block/vdb', 'name': 'vdb',
+                          'dev_type': 'disk', 'holders': []}, vdb)
+        self.assertEqual('disk', dm2['dev_type'])
+        self.assertEqual(1, m_walk.call_count)
+        self.assertEqual(0, m_subp.call_count)
+
+    @mock.patch('curtin.block.clear_holders.util.load_file')
+    def test_plan_shutdown_graph(self, mock_load_file):
+        """plan_shutdown_graph orders holders and devices sharing slaves"""
+        mock_load_file.side_effect = IOError('no dm name')
+        trees = [self.example_holders_trees[0][0],
+                 self.example_holders_trees[1][0]]
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        graph = clear_holders.plan_shutdown_graph(plan, trees)
+
+        def deps(name):
+            return [os.path.basename(dep)
+                    for dep in graph['/sys/class/block/' + name]]
+
+        self.assertEqual([dev_info['device'] for dev_info in plan],
+                         list(graph))
+        # independent stacks do not wait for each other
+        self.assertEqual([], deps('bcache1'))
+        self.assertEqual([], deps('dm-3'))
+        # holders first
+        self.assertEqual(['bcache1'], deps('md0'))
+        self.assertEqual(['dm-1', 'dm-2'], deps('dm-0'))
+        # logical volumes of one volume group one after another, as well as
+        # bcache devices sharing vdb6
+        self.assertEqual(['dm-1', 'dm-3'], deps('dm-2'))
+        self.assertEqual(['bcache1'], deps('bcache2'))
+        # disks wait for their own partitions only
+        self.assertEqual(['sda1', 'sda2', 'sda5'], deps('sda'))
+
+    @mock.patch('curtin.block.clear_holders.lvm.split_lvm_name')
+    @mock.patch('curtin.block.clear_holders.util.load_file')
+    def test_plan_shutdown_graph_orders_volgroup(self, mock_load_file,
+                                                 mock_split):
+        """plan_shutdown_graph orders logical volumes of one volume group"""
+        def lvm_tree(disk, lv_names):
+            lvs = [{'device': '/sys/class/block/' + lv_name,
+                    'name': lv_name, 'holders': [], 'dev_type': 'lvm'}
+                   for lv_name in lv_names]
+            return {'device': '/sys/class/block/' + disk, 'name': disk,
+                    'holders': lvs, 'dev_type': 'disk'}
+
+        # vg0 spans vdb and vdc, with one logical volume on each
+        trees = [lvm_tree('vdb', ['dm-0']), lvm_tree('vdc', ['dm-1']),
+                 lvm_tree('vdd', ['dm-2'])]
+        lvm_names = {'dm-0': 'vg0-lv0', 'dm-1': 'vg0-lv1', 'dm-2': 'vg1-lv0'}
+        mock_load_file.side_effect = (
+            lambda path: lvm_names[path.split('/')[-3]] + '\n')
+        mock_split.side_effect = lambda full: full.split('-')
+        plan = clear_holders.plan_shutdown_holder_trees(trees)
+        graph = clear_holders.plan_shutdown_graph(plan, trees)
+
+        def deps(name):
+            return [os.path.basename(dep)
+                    for dep in graph['/sys/class/block/' + name]]
+
+        lv_order = [os.path.basename(dev_info['device']) for dev_info in plan
+                    if dev_info['dev_type'] == 'lvm']
+        first, second = [name for name in lv_order if name != 'dm-2']
+        self.assertEqual([], deps(first))
+        self.assertEqual([first], deps(second))
+        self.assertEqual([], deps('dm-2'))
+
+        # logical volumes with unknown volume groups run one after another
+        mock_split.side_effect = ValueError('bad name')
+        graph = clear_holders.plan_shutdown_graph(plan, trees)
+        for (index, name) in enumerate(lv_order):
+            self.assertEqual(sorted(lv_order[:index]), deps(name))
+
     @mock.patch('curtin.block.clear_holders.util')
     def test_shutdown_swap_calls_swapoff(self, mock_util):
         """clear_holders.shutdown_swap() calls swapoff on active swap device"""
@@ -6,6 +6,7 @@ import copy
 from mock import patch, call
 import os
 
+from curtin.block import mdadm
 from curtin.commands import block_meta
 from curtin import paths, util
 from .helpers import CiTestCase
@@ -105,6 +106,30 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.m_exists.assert_has_calls([call(path)])
 
 
+class TestDevsync(CiTestCase):
+
+    def setUp(self):
+        super(TestDevsync, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.add_patch(basepath + 'devwait.wait_for_path', 'm_wait')
+
+    def test_devsync_waits_for_device(self):
+        self.m_wait.return_value = True
+        block_meta.devsync('/dev/vda1')
+        self.m_subp.assert_called_with(['partprobe', '/dev/vda1'],
+                                       rcs=[0, 1])
+        self.assertEqual(1, self.m_settle.call_count)
+        self.m_wait.assert_called_with(
+            '/dev/vda1', timeout=block_meta.DEVSYNC_TIMEOUT)
+
+    def test_devsync_raises_if_device_missing(self):
+        self.m_wait.return_value = False
+        with self.assertRaisesRegexp(OSError, '/dev/vda1'):
+            block_meta.devsync('/dev/vda1')
+
+
 class TestBlockMetaSimple(CiTestCase):
     def setUp(self):
         super(TestBlockMetaSimple, self).setUp()
@@ -133,6 +158,7 @@ class TestBlockMetaSimple(CiTestCase):
         self.add_patch('curtin.util.subp', 'mock_subp')
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
+        self.add_patch('curtin.block.image.write_image', 'mock_write_image')
 
     def test_write_image_to_disk(self):
         source = {
@@ -145,12 +171,10 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |xzcat| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
+        self.mock_write_image.assert_called_with(source, devnode,
+                                                 report_prefix='')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'settle'])])
         paths = ["curtin", "system-data/var/lib/snapd", "snaps"]
         self.mock_block_get_root_device.assert_called_with([devname],
@@ -165,15 +189,12 @@ class TestBlockMetaSimple(CiTestCase):
         devnode = "/dev/" + devname
         self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
 
-        block_meta.write_image_to_disk(source, devname)
+        block_meta.write_image_to_disk(source, devname, report_prefix='x')
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |'
-                'tar -xOzf -| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
+        self.mock_write_image.assert_called_with(source, devnode,
+                                                 report_prefix='x')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'settle'])])
         paths = ["curtin", "system-data/var/lib/snapd", "snaps"]
         self.mock_block_get_root_device.assert_called_with([devname],
@@ -203,7 +224,8 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.block_meta(args)
 
-        mock_write_image.assert_called_with(sources.get('unittest'), devname)
+        mock_write_image.assert_called_with(sources.get('unittest'), devname,
+                                            report_prefix='')
         self.mock_subp.assert_has_calls(
             [call(['mount', devname, self.target])])
 
@@ -659,6 +681,23 @@ class TestFstabData(CiTestCase):
                 device="/dev/xda1"),
             block_meta.mount_data(scfg['m1'], scfg))
 
+    @patch('curtin.block.iscsi.volpath_is_iscsi', return_value=False)
+    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
+    def test_device_mount_xfs_external_log(self, m_gptsv, m_is_iscsi):
+        """mount_data adds logdev= for xfs with a journal_device."""
+        bcfg = copy.deepcopy(self.base_cfg) + [
+            {'id': 'xda2', 'type': 'partition', 'size': '1GB',
+             'device': 'xda'}]
+        bcfg[2].update({'fstype': 'xfs', 'journal_device': 'xda2'})
+        m_gptsv.side_effect = lambda d_id, _scfg: "/dev/" + d_id
+
+        scfg = OrderedDict([(i['id'], i) for i in bcfg + [self.mnt]])
+        fdata = block_meta.mount_data(scfg['m1'], scfg)
+        self.assertEqual("noatime,logdev=/dev/xda2", fdata.options)
+        self.assertIn("noatime,logdev=/dev/xda2",
+                      block_meta.fstab_line_for_data(
+                          fdata._replace(spec='/dev/xda1')))
+
     @patch('curtin.block.iscsi.volpath_is_iscsi')
     @patch('curtin.commands.block_meta.get_path_to_storage_volume')
     def test_spec_fstype_override_inline(self, m_gptsv, m_is_iscsi):
@@ -1222,6 +1261,56 @@ class TestDasdHandler(CiTestCase):
         self.assertEqual(0, m_dasd_format.call_count)
 
 
+class TestFormatHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestFormatHandler, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + 'mkfs', 'm_mkfs')
+        self.m_getpath.side_effect = lambda vol, sconfig: '/dev/' + vol
+        self.storage_config = block_meta.extract_storage_ordered_dict({
+            'storage': {'version': 1, 'config': [
+                {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'nvme0', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                 'size': '1G'},
+                {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                 'size': '1G'},
+                {'id': 'nvme0p1', 'type': 'partition', 'device': 'nvme0',
+                 'size': '1G'},
+                {'id': 'md0', 'type': 'raid', 'name': 'md0', 'raidlevel': 1,
+                 'devices': ['sda1', 'sdb1']},
+                {'id': 'md0_fs', 'type': 'format', 'fstype': 'ext4',
+                 'volume': 'md0', 'journal_device': 'nvme0p1',
+                 'lazy_itable_init': True},
+            ]}})
+
+    def test_format_handler_journal_device_locks_all_disks(self):
+        """ format_handler formats with journal path under disk locks. """
+        locked = []
+
+        def mkfs_from_config(path, info, journal_path=None):
+            for disk in ('sda', 'sdb', 'nvme0'):
+                locked.append(block_meta._mkfs_locks[disk].locked())
+
+        self.m_mkfs.mkfs_from_config.side_effect = mkfs_from_config
+        info = self.storage_config['md0_fs']
+        block_meta.format_handler(info, self.storage_config)
+        self.assertEqual(
+            [call('/dev/md0', info, journal_path='/dev/nvme0p1')],
+            self.m_mkfs.mkfs_from_config.call_args_list)
+        self.assertEqual([True, True, True], locked)
+        self.assertFalse(block_meta._mkfs_locks['sda'].locked())
+
+    def test_format_handler_preserve_skips_mkfs(self):
+        """ format_handler does not mkfs preserved volumes. """
+        info = dict(self.storage_config['md0_fs'], preserve=True)
+        block_meta.format_handler(info, self.storage_config)
+        self.assertEqual(0, self.m_mkfs.mkfs_from_config.call_count)
+
+
 class TestDiskHandler(CiTestCase):
 
     with_logs = True
@@ -1791,6 +1880,8 @@ class TestRaidHandler(CiTestCase):
         # The behavior of this function is being directly tested in
         # these tests, so we can't mock it
         self.m_block.md_path = orig_md_path
+        self.m_mdadm.RESYNC_POLICIES = mdadm.RESYNC_POLICIES
+        self.m_mdadm.SYNC_CONTROL_FILE = mdadm.SYNC_CONTROL_FILE
 
         self.target = "my_target"
         self.config = {
@@ -1892,9 +1983,56 @@ class TestRaidHandler(CiTestCase):
         self.m_getpath.side_effect = iter(devices)
         block_meta.raid_handler(self.storage_config['mddevice'],
                                 self.storage_config)
-        self.assertEqual([call(md_devname, 5, devices, [], '')],
+        self.assertEqual([call(md_devname, 5, devices, [], '',
+                               assume_clean=False)],
+                         self.m_mdadm.mdadm_create.call_args_list)
+        self.assertEqual(0, self.m_mdadm.set_sync_control.call_count)
+        self.assertEqual(0, self.m_mdadm.md_block_until_in_sync.call_count)
+
+    def test_raid_handler_resync_assume_clean(self):
+        """ raid_handler creates array with assume_clean on policy. """
+        self.m_getpath.side_effect = iter(['a', 'b', 'c'])
+        self.storage_config['mddevice']['resync'] = 'assume-clean'
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.assertEqual([call('/dev/md0', 5, ['a', 'b', 'c'], [], '',
+                               assume_clean=True)],
                          self.m_mdadm.mdadm_create.call_args_list)
 
+    def test_raid_handler_resync_defer_records_in_state_dir(self):
+        """ raid_handler freezes and throttles sync with state file. """
+        self.m_util.load_command_environment.return_value = {
+            'fstab': '/tmp/state/fstab'}
+        self.m_getpath.side_effect = iter(['a', 'b', 'c'])
+        self.storage_config['mddevice'].update(
+            {'resync': 'defer', 'resync_speed_max': 1000})
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.assertEqual(
+            [call('/dev/md0', '/tmp/state/' + mdadm.SYNC_CONTROL_FILE,
+                  speed_min=None, speed_max=1000, freeze=True)],
+            self.m_mdadm.set_sync_control.call_args_list)
+
+    def test_raid_handler_resync_wait_blocks(self):
+        """ raid_handler waits for the array to sync on policy wait. """
+        self.m_getpath.side_effect = iter(['a', 'b', 'c'])
+        self.storage_config['mddevice'].update(
+            {'resync': 'wait', 'resync_timeout': 60})
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.assertEqual(0, self.m_mdadm.set_sync_control.call_count)
+        self.assertEqual([call('/dev/md0', timeout=60)],
+                         self.m_mdadm.md_block_until_in_sync.call_args_list)
+
+    def test_raid_handler_resync_invalid_policy(self):
+        """ raid_handler raises ValueError on unknown resync policy. """
+        self.m_getpath.side_effect = iter(['a', 'b', 'c'])
+        self.storage_config['mddevice']['resync'] = 'later'
+        with self.assertRaises(ValueError):
+            block_meta.raid_handler(self.storage_config['mddevice'],
+                                    self.storage_config)
+        self.assertEqual(0, self.m_mdadm.mdadm_create.call_count)
+
     @patch('curtin.commands.block_meta.raid_verify')
     def test_raid_handler_preserves_existing_device(self, m_verify):
         """ raid_handler preserves existing device. """
@@ -2697,4 +2835,74 @@ class TestGetDevicePathsFromStorageConfig(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestMetaCustom(CiTestCase):
+
+    def setUp(self):
+        super(TestMetaCustom, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'disk_handler', 'm_disk_handler')
+        self.add_patch(basepath + 'partition_handler', 'm_part_handler')
+        self.add_patch(basepath + 'format_handler', 'm_format_handler')
+        self.add_patch(basepath + 'parallel.run_graph', 'm_run_graph')
+        self.add_patch('curtin.util.load_command_environment',
+                       'm_load_env')
+        self.add_patch('curtin.config.load_command_config', 'm_load_cfg')
+        self.m_load_env.return_value = {'target': self.tmp_dir()}
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'number': 1, 'size': '1G'},
+                    {'id': 'sda1-fmt', 'type': 'format', 'volume': 'sda1',
+                     'fstype': 'ext4'},
+                ],
+            },
+        }
+        self.m_load_cfg.return_value = self.config
+        self.args = Namespace(umount=False)
+
+    def test_meta_custom_handles_items_serially_by_default(self):
+        """meta_custom calls each handler in config order by default."""
+        block_meta.meta_custom(self.args)
+        self.assertEqual(0, self.m_run_graph.call_count)
+        sconfig = block_meta.extract_storage_ordered_dict(self.config)
+        self.assertEqual([call(sconfig['sda'], sconfig),
+                          call(sconfig['sdb'], sconfig)],
+                         self.m_disk_handler.call_args_list)
+        self.assertEqual([call(sconfig['sda1'], sconfig)],
+                         self.m_part_handler.call_args_list)
+        self.assertEqual([call(sconfig['sda1-fmt'], sconfig)],
+                         self.m_format_handler.call_args_list)
+
+    def test_meta_custom_uses_dependency_graph_with_max_workers(self):
+        """meta_custom runs the dependency graph when max_workers > 1."""
+        self.config['block-meta'] = {'max_workers': 4}
+        block_meta.meta_custom(self.args)
+        self.assertEqual(1, self.m_run_graph.call_count)
+        (graph, _handle), kwargs = self.m_run_graph.call_args
+        self.assertEqual(['sda', 'sdb', 'sda1', 'sda1-fmt'], list(graph))
+        self.assertEqual({'sda1'}, graph['sda1-fmt'])
+        self.assertEqual({'max_workers': 4}, kwargs)
+
+    def test_meta_custom_rejects_unknown_type_before_running(self):
+        """meta_custom validates item types before running in parallel."""
+        self.config['block-meta'] = {'max_workers': 2}
+        self.config['storage']['config'].append({'id': 'x', 'type': 'bogus'})
+        with self.assertRaises(ValueError):
+            block_meta.meta_custom(self.args)
+        self.assertEqual(0, self.m_run_graph.call_count)
+
+    def test_get_max_workers(self):
+        self.assertEqual(1, block_meta.get_max_workers({}))
+        cfg = {'block-meta': {'max_workers': '3'}}
+        self.assertEqual(3, block_meta.get_max_workers(cfg))
+        for bad in (0, 'many', None):
+            with self.assertRaises(ValueError):
+                block_meta.get_max_workers(
+                    {'block-meta': {'max_workers': bad}})
+
+
 # vi: ts=4 expandtab syntax=python
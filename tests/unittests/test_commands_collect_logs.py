@@ -313,6 +313,21 @@ class TestCreateTar(CiTestCase):
         self.assertNotIn(
             mock.call(absent_log, self.tardir), self.m_copy.call_args_list)
 
+    def test_create_log_tarfile_copies_subp_ledger(self):
+        """create_log_tarfile copies the configured subp_ledger."""
+        self.add_patch('curtin.util.subp', 'mock_subp')
+        tarfile = self.tmp_path('my.tar', _dir=self.new_root)
+        ledger = self.tmp_path('subp.jsonl', _dir=self.new_root)
+        write_file(ledger, '{}\n')
+        config = {'install': {'subp_ledger': ledger}}
+        self.add_patch('shutil.copy', 'm_copy')
+        with mock.patch('sys.stderr'):
+            with mock.patch('curtin.commands.collect_logs.datetime') as m_dt:
+                m_dt.utcnow.return_value = self.utcnow
+                collect_logs.create_log_tarfile(tarfile, config=config)
+        self.assertIn(
+            mock.call(ledger, self.tardir), self.m_copy.call_args_list)
+
     def test_create_log_tarfile_redacts_maas_credentials(self):
         """create_log_tarfile redacts sensitive maas credentials configured."""
         self.add_patch('curtin.util.subp', 'mock_subp')
@@ -1,10 +1,12 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import os
+import threading
 
 from .helpers import CiTestCase
 
 from curtin import util
-from curtin.commands.extract import (extract_root_fsimage_url,
+from curtin.commands.extract import (download_options,
+                                     extract_root_fsimage_url,
                                      extract_root_layered_fsimage_url,
                                      _get_image_stack)
 from curtin.url_helper import UrlError
@@ -12,7 +14,7 @@ from curtin.url_helper import UrlError
 
 class TestExtractRootFsImageUrl(CiTestCase):
     """Test extract_root_fsimage_url."""
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, retries=0, **kwargs):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -62,6 +64,20 @@ class TestExtractRootFsImageUrl(CiTestCase):
         self.assertEqual(1, len(self.downloads))
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_http_url_download_options(self):
+        """extract_root_fsimage_url passes download options to download."""
+        tmpd = self.tmp_dir()
+        target = self.tmp_path("target_d", tmpd)
+        myurl = "http://bogus.example.com/my.img"
+        source = {'type': 'fsimage', 'uri': myurl, 'segments': 4,
+                  'read_size': 65536, 'checksum': 'sha256:abcd'}
+        extract_root_fsimage_url(myurl, target, **download_options(source))
+        self.assertEqual(1, self.m_download.call_count)
+        self.assertEqual(
+            {'retries': 3, 'segments': 4, 'buflen': 65536,
+             'checksum': 'sha256:abcd'},
+            self.m_download.call_args[1])
+
     def test_file_path_not_url(self):
         """extract_root_fsimage_url supports normal file path without file:."""
         tmpd = self.tmp_dir()
@@ -176,86 +192,146 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
         self.assertEqual(0, self.m_download.call_count)
 
+
+class TestExtractRootLayeredFsImageUrlRemote(CiTestCase):
+    """Test extract_root_layered_fsimage_url with remote layers."""
+    def _fake_download(self, url, path, retries=0, **kwargs):
+        with self.lock:
+            self.downloads.append(os.path.abspath(path))
+        with open(path, "w") as fp:
+            fp.write("fake content from " + url + "\n")
+
+    def setUp(self):
+        super(TestExtractRootLayeredFsImageUrlRemote, self).setUp()
+        self.downloads = []
+        self.lock = threading.Lock()
+        self.add_patch("curtin.commands.extract.url_helper.download",
+                       "m_download", side_effect=self._fake_download)
+        self.add_patch("curtin.commands.extract.util.subp", "m_subp")
+        self.add_patch("curtin.commands.extract.copy_to_target",
+                       "m_copy_to_target")
+        self.m_subp.side_effect = self._fake_subp
+        self.mounted = []
+
+    def _fake_subp(self, args, capture=False):
+        if args[0] == 'mount' and 'overlay' not in args:
+            # a layer is mounted only once it has been downloaded
+            self.assertTrue(os.path.exists(args[-2]))
+            self.mounted.append(args[-2])
+        return ('', '')
+
+    def _download_urls(self):
+        return sorted(c[0][0] for c in self.m_download.call_args_list)
+
     def test_remote_file_single(self):
         """extract_root_layered_fsimage_url supports http:// urls."""
-        tmpd = self.tmp_dir()
-        target = self.tmp_path("target_d", tmpd)
+        target = self.tmp_path("target_d", self.tmp_dir())
         myurl = "http://example.io/minimal.squashfs"
         extract_root_layered_fsimage_url(myurl, target)
-        self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(1, self.m_download.call_count)
-        self.assertEqual("http://example.io/minimal.squashfs",
-                         self.m_download.call_args_list[0][0][0])
+        self.assertEqual(1, self.m_copy_to_target.call_count)
+        self.assertEqual(["http://example.io/minimal.squashfs"],
+                         self._download_urls())
+        self.assertEqual(["minimal.squashfs"],
+                         [os.path.basename(m) for m in self.mounted])
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
     def test_remote_file_multiple(self):
-        """extract_root_layered_fsimage_url supports normal hierarchy from
-           http:// urls."""
-        tmpd = self.tmp_dir()
-        target = self.tmp_path("target_d", tmpd)
+        """extract_root_layered_fsimage_url downloads every layer of a
+           http:// hierarchy and mounts them lowest layer first."""
+        target = self.tmp_path("target_d", self.tmp_dir())
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         extract_root_layered_fsimage_url(myurl, target)
-        self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(3, self.m_download.call_count)
-        for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
-            self.assertEqual("http://example.io/" + image_url,
-                             self.m_download.call_args_list[i][0][0])
+        self.assertEqual(1, self.m_copy_to_target.call_count)
+        layers = ["minimal.squashfs", "minimal.standard.squashfs",
+                  "minimal.standard.debug.squashfs"]
+        self.assertEqual(sorted("http://example.io/" + image_url
+                                for image_url in layers),
+                         self._download_urls())
+        self.assertEqual(layers,
+                         [os.path.basename(m) for m in self.mounted])
+        # the layers are assembled with an overlay
+        overlay = [c[0][0] for c in self.m_subp.call_args_list
+                   if 'overlay' in c[0][0]]
+        self.assertEqual(1, len(overlay))
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_remote_file_download_options(self):
+        """extract_root_layered_fsimage_url passes download options."""
+        target = self.tmp_path("target_d", self.tmp_dir())
+        myurl = "http://example.io/minimal.standard.squashfs"
+        extract_root_layered_fsimage_url(myurl, target, segments=2)
+        for dl_call in self.m_download.call_args_list:
+            self.assertEqual(3, dl_call[1]['retries'])
+            self.assertEqual(2, dl_call[1]['segments'])
+            self.assertIn('cancel', dl_call[1])
+
     def test_remote_file_multiple_one_missing(self):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer missing."""
 
-        def fail_download_minimal_standard(url, path, retries=0):
+        def fail_download_minimal_standard(url, path, retries=0, **kwargs):
             if url == "http://example.io/minimal.standard.squashfs":
                 raise UrlError(url, 404, "Couldn't download",
                                None, None)
             return self._fake_download(url, path, retries)
         self.m_download.side_effect = fail_download_minimal_standard
 
-        tmpd = self.tmp_dir()
-        target = self.tmp_path("target_d", tmpd)
+        target = self.tmp_path("target_d", self.tmp_dir())
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(UrlError, extract_root_layered_fsimage_url,
                           myurl, target)
-        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(2, self.m_download.call_count)
-        for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs"]):
-            self.assertEqual("http://example.io/" + image_url,
-                             self.m_download.call_args_list[i][0][0])
+        self.assertEqual(0, self.m_copy_to_target.call_count)
+        self.assertIn("http://example.io/minimal.standard.squashfs",
+                      self._download_urls())
+        self.assertNotIn("minimal.standard.squashfs",
+                         [os.path.basename(m) for m in self.mounted])
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_remote_file_failure_cancels_other_downloads(self):
+        """extract_root_layered_fsimage_url cancels downloads on failure."""
+        cancels = []
+
+        def download(url, path, retries=0, cancel=None, **kwargs):
+            if url == "http://example.io/minimal.squashfs":
+                raise UrlError(url, 404, "Couldn't download", None, None)
+            cancels.append(cancel)
+            self.assertTrue(cancel.wait(5))
+            raise UrlError("download cancelled", url=url)
+        self.m_download.side_effect = download
+
+        target = self.tmp_path("target_d", self.tmp_dir())
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        with self.assertRaises(UrlError) as ctx:
+            extract_root_layered_fsimage_url(myurl, target)
+        self.assertEqual(404, ctx.exception.code)
+        self.assertEqual(3, self.m_download.call_count)
+        self.assertTrue(all(cancel.is_set() for cancel in cancels))
+        self.assertEqual([], self.mounted)
+
     def test_remote_file_multiple_one_empty(self):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer empty."""
 
-        def empty_download_minimal_standard(url, path, retries=0):
+        def empty_download_minimal_standard(url, path, retries=0, **kwargs):
             if url == "http://example.io/minimal.standard.squashfs":
-                self.downloads.append(os.path.abspath(path))
+                with self.lock:
+                    self.downloads.append(os.path.abspath(path))
                 with open(path, "w") as fp:
                     fp.write("")
                 return
             return self._fake_download(url, path, retries)
         self.m_download.side_effect = empty_download_minimal_standard
 
-        tmpd = self.tmp_dir()
-        target = self.tmp_path("target_d", tmpd)
+        target = self.tmp_path("target_d", self.tmp_dir())
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(ValueError, extract_root_layered_fsimage_url,
                           myurl, target)
-        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(3, self.m_download.call_count)
-        for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
-            self.assertEqual("http://example.io/" + image_url,
-                             self.m_download.call_args_list[i][0][0])
+        self.assertEqual(0, self.m_copy_to_target.call_count)
+        self.assertEqual(["minimal.squashfs"],
+                         [os.path.basename(m) for m in self.mounted])
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
@@ -5,7 +5,8 @@ import mock
 
 from curtin import config
 from curtin.commands import install
-from curtin.util import BadUsage, ensure_dir, write_file
+from curtin.util import (BadUsage, ProcessExecutionError, ensure_dir,
+                         load_file, write_file)
 from .helpers import CiTestCase
 from collections import namedtuple
 
@@ -229,3 +230,64 @@ class TestWorkingDir(CiTestCase):
             wd = install.WorkingDir({})
         self.assertEqual(1, m_mkdtemp.call_count)
         self.assertTrue(wd.target.startswith(work_d + "/"))
+
+
+class TestOutputTail(CiTestCase):
+
+    def test_output_tail_keeps_everything_below_size(self):
+        tail = install.OutputTail(size=10)
+        tail.append(b'abc')
+        tail.append(b'def')
+        self.assertEqual(b'abcdef', tail.getvalue())
+
+    def test_output_tail_keeps_only_last_size_bytes(self):
+        tail = install.OutputTail(size=4)
+        for chunk in (b'abc', b'def', b'gh', b'ijklm'):
+            tail.append(chunk)
+        self.assertEqual(b'jklm', tail.getvalue())
+
+
+class TestStage(CiTestCase):
+
+    def setUp(self):
+        super(TestStage, self).setUp()
+        self.logfile = self.tmp_path('install.log')
+        self.stdout = []
+
+    def _stage(self, commands):
+        stage = install.Stage('test', commands, env={},
+                              logfile=self.logfile)
+        stage.write_stdout = self.stdout.append
+        return stage
+
+    def test_stage_run_writes_output_to_stdout_and_log(self):
+        """Stage.run copies command output to stdout and install log."""
+        stage = self._stage({'00': ['sh', '-c', 'echo hello; echo world']})
+        stage.run()
+        stage.install_log.close()
+        self.assertEqual(b'hello\nworld\n', b''.join(self.stdout))
+        self.assertEqual('hello\nworld\n', load_file(self.logfile))
+
+    def test_stage_run_streams_large_output_in_chunks(self):
+        """Stage.run reads command output in chunks, not byte by byte."""
+        size = 4 * install.STAGE_READ_SIZE
+        stage = self._stage(
+            {'00': ['sh', '-c', 'head -c %d /dev/zero' % size]})
+        stage.run()
+        stage.install_log.close()
+        self.assertEqual(size, sum(len(data) for data in self.stdout))
+        self.assertLess(len(self.stdout), size // 1024)
+        self.assertEqual(size, len(load_file(self.logfile)))
+
+    def test_stage_run_raises_with_output_tail_on_failure(self):
+        """Stage.run raises ProcessExecutionError with the output tail."""
+        stage = self._stage(
+            {'00': ['sh', '-c', 'echo first; head -c %d /dev/zero; '
+                    'echo last; exit 3' % install.STAGE_OUTPUT_TAIL_SIZE]})
+        with self.assertRaises(ProcessExecutionError) as ctx:
+            stage.run()
+        self.assertEqual(3, ctx.exception.exit_code)
+        self.assertIn('last', ctx.exception.stdout)
+        self.assertNotIn('first', ctx.exception.stdout)
+
+# vi: ts=4 expandtab syntax=python
@@ -86,6 +86,121 @@ class TestCurthooksInstallKernel(CiTestCase):
             [kernel_package], target=self.target)
 
 
+class TestPackagePlan(CiTestCase):
+    def setUp(self):
+        super(TestPackagePlan, self).setUp()
+        self.add_patch('curtin.distro.install_packages', 'm_install')
+        self.add_patch('curtin.commands.curthooks.get_missing_packages',
+                       'm_missing', return_value=['mdadm', 'lvm2'])
+        self.add_patch('curtin.commands.curthooks.get_kernel_packages',
+                       'm_kernel', return_value=[['linux-generic']])
+        self.add_patch('curtin.commands.curthooks.get_flash_kernel_pkgs',
+                       'm_fk', return_value='u-boot-tools')
+        self.add_patch('curtin.commands.curthooks.get_multipath_packages',
+                       'm_multipath', return_value=(None, None))
+        self.add_patch('curtin.commands.curthooks.zkey_used', 'm_zkey',
+                       return_value=False)
+        self.target = self.tmp_dir()
+        self.state = {'fstab': '/tmp/fstab'}
+
+    def test_plan_collects_packages(self):
+        self.m_multipath.return_value = ('/dev/sda', ['multipath-tools-boot'])
+        self.m_zkey.return_value = True
+        plan = curthooks.plan_packages({}, self.target, self.state)
+        self.assertEqual(
+            ['missing', 'flash-kernel', 'kernel', 'multipath', 'zkey'],
+            list(plan.steps))
+        self.assertEqual(['mdadm', 'lvm2', 'u-boot-tools', 'linux-generic',
+                          'multipath-tools-boot', 's390-tools-zkey'],
+                         plan.packages())
+
+    def test_plan_skips_kernel_on_redhat(self):
+        plan = curthooks.plan_packages({}, self.target, self.state,
+                                       osfamily=distro.DISTROS.redhat)
+        self.assertEqual(['missing'], list(plan.steps))
+        self.assertEqual(0, self.m_kernel.call_count)
+        self.assertEqual(0, self.m_fk.call_count)
+
+    def test_install_single_transaction(self):
+        plan = curthooks.plan_packages({}, self.target, self.state)
+        plan.install(self.target)
+        self.assertEqual(
+            [call(['u-boot-tools'], target=self.target,
+                  osfamily=distro.DISTROS.debian),
+             call(['mdadm', 'lvm2', 'linux-generic'], target=self.target,
+                  osfamily=distro.DISTROS.debian)],
+            self.m_install.call_args_list)
+        self.assertTrue(plan.installed('flash-kernel'))
+        self.assertTrue(plan.installed('kernel'))
+        self.assertFalse(plan.installed('multipath'))
+
+        curthooks.install_kernel({}, self.target, plan=plan)
+        curthooks.install_missing_packages({}, self.target, plan=plan)
+        self.assertEqual(2, self.m_install.call_count)
+
+    def test_install_falls_back_per_step(self):
+        self.m_install.side_effect = [None, util.ProcessExecutionError()]
+        plan = curthooks.plan_packages({}, self.target, self.state)
+        plan.install(self.target)
+        self.assertTrue(plan.installed('flash-kernel'))
+        self.assertFalse(plan.installed('kernel'))
+
+        self.m_install.side_effect = None
+        self.m_install.reset_mock()
+        curthooks.install_kernel({}, self.target, plan=plan)
+        self.assertEqual([call(['linux-generic'], target=self.target)],
+                         self.m_install.call_args_list)
+
+    def test_multipath_reuses_planned_probe(self):
+        plan = curthooks.plan_packages({}, self.target, self.state)
+        self.assertEqual((None, None), plan.results['multipath'])
+        curthooks.detect_and_handle_multipath({}, self.target, plan=plan)
+        self.assertEqual(1, self.m_multipath.call_count)
+
+    def test_empty_plan_installs_nothing(self):
+        self.m_missing.return_value = []
+        self.m_kernel.return_value = []
+        self.m_fk.return_value = None
+        plan = curthooks.plan_packages({}, self.target, self.state)
+        plan.install(self.target)
+        self.assertEqual(0, self.m_install.call_count)
+        self.assertTrue(plan.installed('missing'))
+
+
+class TestCurthooksChrootSession(CiTestCase):
+
+    def setUp(self):
+        super(TestCurthooksChrootSession, self).setUp()
+        self.target = self.tmp_dir()
+        self.add_patch('curtin.util.load_command_environment', 'm_env',
+                       return_value={'target': self.target,
+                                     'report_stack_prefix': 'cmd-curthooks'})
+        self.add_patch('curtin.config.load_command_config', 'm_cfg',
+                       return_value={})
+        self.add_patch('curtin.distro.is_ubuntu_core', 'm_is_core',
+                       return_value=False)
+        self.add_patch('curtin.util.run_hook_if_exists', 'm_hook',
+                       return_value=False)
+        self.add_patch('curtin.commands.curthooks.builtin_curthooks',
+                       'm_builtin')
+        self.add_patch('curtin.reporter.events.report_finish_event',
+                       'm_finish')
+
+    def test_curthooks_reports_saved_mounts(self):
+        def builtin_curthooks(cfg, target, state):
+            util.ChrootSession.current(target).saved.update(
+                {'mount': 12, 'umount': 12})
+
+        self.m_builtin.side_effect = builtin_curthooks
+        args = type('Args', (), {'target': None})()
+        with self.assertRaises(SystemExit):
+            curthooks.curthooks(args)
+        name, message = self.m_finish.call_args[0][:2]
+        self.assertEqual('cmd-curthooks/chroot-session', name)
+        self.assertEqual('chroot session for %s: saved 12 mounts and 12 '
+                         'umounts' % self.target, message)
+
+
 class TestEnableDisableUpdateInitramfs(CiTestCase):
 
     def setUp(self):
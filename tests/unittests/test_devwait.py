@@ -0,0 +1,86 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import os
+import threading
+import time
+from unittest import skipUnless
+
+from curtin import devwait
+from .helpers import CiTestCase
+
+
+class TestWaitForPath(CiTestCase):
+
+    def setUp(self):
+        super(TestWaitForPath, self).setUp()
+        self.path = self.tmp_path('dev/disk/by-id/disk-a')
+
+    def _later(self, func, delay=0.2):
+        timer = threading.Timer(delay, func)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def _create(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, 'w').close()
+
+    def test_missing_path(self):
+        with self.assertRaises(ValueError):
+            devwait.wait_for_path(None)
+
+    def test_already_present(self):
+        self._create()
+        with mock.patch('curtin.devwait.Inotify.wait') as m_wait:
+            self.assertTrue(devwait.wait_for_path(self.path))
+        self.assertEqual(0, m_wait.call_count)
+
+    @skipUnless(devwait._libc, "inotify not available")
+    def test_returns_when_created(self):
+        # parent directories are created too, the watch follows them
+        self._later(self._create)
+        start = time.time()
+        with mock.patch('curtin.devwait.WATCH_RECHECK', 30):
+            self.assertTrue(devwait.wait_for_path(self.path, timeout=30))
+        self.assertLess(time.time() - start, 5)
+
+    @skipUnless(devwait._libc, "inotify not available")
+    def test_returns_when_removed(self):
+        self._create()
+        self._later(lambda: os.unlink(self.path))
+        start = time.time()
+        with mock.patch('curtin.devwait.WATCH_RECHECK', 30):
+            self.assertTrue(devwait.wait_for_path(self.path, exists=False,
+                                                  timeout=30))
+        self.assertLess(time.time() - start, 5)
+
+    @mock.patch('curtin.devwait._libc', None)
+    def test_polls_without_inotify(self):
+        self._later(self._create)
+        self.assertTrue(devwait.wait_for_path(self.path, timeout=30))
+
+    @mock.patch('curtin.devwait.time.sleep')
+    @mock.patch('curtin.devwait.os.path.exists')
+    def test_sysfs_is_polled(self, m_exists, m_sleep):
+        m_exists.side_effect = [True, True, True, False]
+        with mock.patch('curtin.devwait.Inotify') as m_inotify:
+            self.assertTrue(devwait.wait_for_path(
+                '/sys/fs/bcache/uuid/stop', exists=False))
+        self.assertEqual(0, m_inotify.call_count)
+        self.assertEqual([mock.call(0.05), mock.call(0.1), mock.call(0.2)],
+                         m_sleep.call_args_list)
+
+    def test_timeout(self):
+        self.assertFalse(devwait.wait_for_path(self.path, timeout=0.1))
+
+    def test_wait_times_recorded(self):
+        self._create()
+        devwait.wait_for_path(self.path)
+        devwait.wait_for_path(self.path, exists=False, timeout=0)
+        waits = devwait.wait_times()[-2:]
+        self.assertEqual([(self.path, True, True), (self.path, False, False)],
+                         [(w['path'], w['exists'], w['found'])
+                          for w in waits])
+        self.assertTrue(all(w['elapsed'] >= 0 for w in waits))
+
+# vi: ts=4 expandtab syntax=python
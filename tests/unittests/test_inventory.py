@@ -0,0 +1,226 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import os
+
+from curtin import block, inventory, udev, util
+from curtin.block import multipath
+from .helpers import CiTestCase
+
+
+EXPORT_DB = """\
+P: /devices/virtual/misc/loop-control
+N: loop-control
+E: DEVPATH=/devices/virtual/misc/loop-control
+E: DEVNAME=/dev/loop-control
+E: SUBSYSTEM=misc
+
+P: /devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:0:0/block/sda
+N: sda
+S: disk/by-id/scsi-0QEMU_QEMU_HARDDISK_disk-a
+S: disk/by-id/wwn-0x5000c500a0b1c2d3
+E: DEVPATH=/devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:0:0/\
+block/sda
+E: DEVNAME=/dev/sda
+E: DEVTYPE=disk
+E: SUBSYSTEM=block
+E: ID_SERIAL=0QEMU_QEMU_HARDDISK_disk-a
+E: ID_SERIAL_SHORT=disk-a
+E: ID_WWN=0x5000c500a0b1c2d3
+E: ID_MODEL=QEMU HARDDISK
+E: DEVLINKS=/dev/disk/by-id/scsi-0QEMU_QEMU_HARDDISK_disk-a \
+/dev/disk/by-id/wwn-0x5000c500a0b1c2d3
+
+P: /devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:0:0/block/sda/sda1
+N: sda1
+E: DEVPATH=/devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:0:0/\
+block/sda/sda1
+E: DEVNAME=/dev/sda1
+E: DEVTYPE=partition
+E: SUBSYSTEM=block
+E: ID_SERIAL=0QEMU_QEMU_HARDDISK_disk-a
+E: DEVLINKS=/dev/disk/by-id/scsi-0QEMU_QEMU_HARDDISK_disk-a-part1
+
+P: /devices/virtual/block/dm-0
+N: dm-0
+E: DEVPATH=/devices/virtual/block/dm-0
+E: DEVNAME=/dev/dm-0
+E: DEVTYPE=disk
+E: SUBSYSTEM=block
+E: DM_NAME=mpatha
+E: DM_UUID=mpath-0QEMU_QEMU_HARDDISK_disk-b
+E: DEVLINKS=/dev/mapper/mpatha /dev/disk/by-id/dm-name-mpatha
+
+P: /devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:1:0/block/sdb
+N: sdb
+E: DEVPATH=/devices/pci0000:00/0000:00:05.0/host0/target0:0:0/0:0:1:0/\
+block/sdb
+E: DEVNAME=/dev/sdb
+E: DEVTYPE=disk
+E: SUBSYSTEM=block
+E: ID_SERIAL=0QEMU_QEMU_HARDDISK_disk-b
+E: DEVLINKS=/dev/disk/by-id/scsi-0QEMU_QEMU_HARDDISK_disk-b
+
+""".replace('\\\n', '')
+
+SYSFS = {
+    'sda': {'size': 10 * 1024 ** 3, 'partition': None, 'parent': None,
+            'holders': [], 'slaves': []},
+    'sda1': {'size': 1024 ** 3, 'partition': 1, 'parent': 'sda',
+             'holders': [], 'slaves': []},
+    'sdb': {'size': 10 * 1024 ** 3, 'partition': None, 'parent': None,
+            'holders': ['dm-0'], 'slaves': []},
+    'dm-0': {'size': 10 * 1024 ** 3, 'partition': None, 'parent': None,
+             'holders': [], 'slaves': ['sdb']},
+}
+
+
+def _snapshot():
+    return inventory.DeviceInventory(inventory.parse_export_db(EXPORT_DB),
+                                     SYSFS)
+
+
+class TestParseExportDb(CiTestCase):
+
+    def test_block_devices_only(self):
+        devices = inventory.parse_export_db(EXPORT_DB)
+        self.assertEqual(['/dev/sda', '/dev/sda1', '/dev/dm-0', '/dev/sdb'],
+                         [d['DEVNAME'] for d in devices])
+        self.assertEqual(5, len(inventory.parse_export_db(EXPORT_DB,
+                                                          subsystem=None)))
+
+    def test_values_split_like_udevadm_info(self):
+        sda = inventory.parse_export_db(EXPORT_DB)[0]
+        self.assertEqual(['/dev/disk/by-id/scsi-0QEMU_QEMU_HARDDISK_disk-a',
+                          '/dev/disk/by-id/wwn-0x5000c500a0b1c2d3'],
+                         sda['DEVLINKS'])
+        self.assertEqual(['QEMU', 'HARDDISK'], sda['ID_MODEL'])
+        self.assertEqual('0QEMU_QEMU_HARDDISK_disk-a', sda['ID_SERIAL'])
+
+
+class TestWalkSysfs(CiTestCase):
+
+    def test_walk_sysfs(self):
+        root = self.tmp_dir()
+        devices = os.path.join(root, 'devices')
+        for path, files in (('sda', {'size': '8'}),
+                            ('sda/sda1', {'size': '4', 'partition': '1'}),
+                            ('md0', {'size': '2'}),
+                            ('dm-0', {'size': '2', 'dm/uuid': 'CRYPT-LUKS2'})):
+            os.makedirs(os.path.join(devices, path, 'holders'))
+            for name, content in files.items():
+                util.ensure_dir(os.path.dirname(
+                    os.path.join(devices, path, name)))
+                with open(os.path.join(devices, path, name), 'w') as fp:
+                    fp.write(content + '\n')
+        os.makedirs(os.path.join(devices, 'sda/sda1/holders/md0'))
+        os.makedirs(os.path.join(devices, 'md0', 'slaves', 'sda1'))
+        sysroot = os.path.join(root, 'class_block')
+        os.mkdir(sysroot)
+        for path in ('sda', 'sda/sda1', 'md0', 'dm-0'):
+            os.symlink(os.path.join(devices, path),
+                       os.path.join(sysroot, os.path.basename(path)))
+
+        found = inventory.walk_sysfs(sysroot)
+        self.assertEqual({'size': 2048, 'partition': 1, 'parent': 'sda',
+                          'holders': ['md0'], 'slaves': [],
+                          'dm_uuid': None}, found['sda1'])
+        self.assertEqual(['sda1'], found['md0']['slaves'])
+        self.assertEqual('CRYPT-LUKS2', found['dm-0']['dm_uuid'])
+        self.assertIsNone(found['sda']['partition'])
+
+
+class TestDeviceInventory(CiTestCase):
+
+    def test_kname_of_paths(self):
+        snapshot = _snapshot()
+        for path in ('/dev/sda', 'sda', '/sys/class/block/sda',
+                     '/dev/disk/by-id/wwn-0x5000c500a0b1c2d3',
+                     '/sys/devices/pci0000:00/0000:00:05.0/host0/'
+                     'target0:0:0/0:0:0:0/block/sda'):
+            self.assertEqual('sda', snapshot.kname(path))
+        self.assertIsNone(snapshot.kname('/dev/sdz'))
+        self.assertIsNone(snapshot.info('/dev/sdz'))
+
+    def test_info_is_a_copy(self):
+        snapshot = _snapshot()
+        info = snapshot.info('/dev/mapper/mpatha')
+        self.assertEqual('mpatha', info['DM_NAME'])
+        info['DEVLINKS'].append('x')
+        self.assertNotIn('x', snapshot.info('/dev/dm-0')['DEVLINKS'])
+
+    def test_serial_and_wwn_indexes(self):
+        snapshot = _snapshot()
+        self.assertEqual(['/dev/sda'], snapshot.devnames(serial='disk-a'))
+        self.assertEqual(['/dev/sda', '/dev/sda1'], snapshot.devnames(
+            serial='0QEMU_QEMU_HARDDISK_disk-a'))
+        self.assertEqual(['/dev/sda'],
+                         snapshot.devnames(wwn='0x5000c500a0b1c2d3'))
+
+    def test_dm_names_and_multipath(self):
+        snapshot = _snapshot()
+        self.assertEqual({'mpatha': '/dev/dm-0'}, snapshot.dm_name_mapping())
+        self.assertEqual('mpatha', snapshot.mpath_holder('/dev/sdb'))
+        self.assertIsNone(snapshot.mpath_holder('/dev/sda'))
+        self.assertEqual(['sdb'], snapshot.slaves('dm-0'))
+
+
+class TestActiveInventory(CiTestCase):
+
+    def setUp(self):
+        super(TestActiveInventory, self).setUp()
+        self.add_patch('curtin.inventory.DeviceInventory.from_system',
+                       'm_from_system', side_effect=_snapshot)
+        self.add_patch('curtin.util.subp', 'm_subp', return_value=('', ''))
+
+    def test_inactive_by_default(self):
+        self.assertIsNone(inventory.current())
+        self.assertIsNone(inventory.udevadm_info('/dev/sda'))
+        self.assertEqual(0, self.m_from_system.call_count)
+
+    def test_snapshot_taken_once(self):
+        with inventory.active():
+            with inventory.active():
+                self.assertEqual('disk', udev.udevadm_info('/dev/sda')[
+                    'DEVTYPE'])
+            udev.udevadm_info('/dev/sdb')
+        self.assertIsNone(inventory.current())
+        self.assertEqual(1, self.m_from_system.call_count)
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_unknown_device_queries_udevadm(self):
+        with inventory.active():
+            udev.udevadm_info('/dev/sdz')
+        self.m_subp.assert_called_with(
+            ['udevadm', 'info', '--query=property', '--export', '/dev/sdz'],
+            capture=True)
+
+    def test_settle_invalidates(self):
+        with inventory.active():
+            first = inventory.current()
+            self.assertIs(first, inventory.current())
+            udev.udevadm_settle()
+            self.assertIsNot(first, inventory.current())
+        self.assertEqual(2, self.m_from_system.call_count)
+
+    @mock.patch('curtin.block.multipath.multipath_supported')
+    @mock.patch('curtin.block.os.path.exists')
+    def test_lookup_disk(self, m_exists, m_mp_supported):
+        m_exists.return_value = True
+        with inventory.active():
+            self.assertEqual('/dev/sda', block.lookup_disk('disk-a'))
+            self.assertEqual('/dev/mapper/mpatha',
+                             block.lookup_disk('disk-b'))
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_multipath_helpers(self):
+        with inventory.active():
+            self.assertTrue(multipath.is_mpath_member('/dev/sdb'))
+            self.assertFalse(multipath.is_mpath_member('/dev/sda'))
+            self.assertEqual('mpatha',
+                             multipath.find_mpath_id_by_path('/dev/sdb'))
+            self.assertEqual({'mpatha': '/dev/dm-0'},
+                             multipath.dmname_to_blkdev_mapping())
+        self.assertEqual(0, self.m_subp.call_count)
+
+# vi: ts=4 expandtab syntax=python
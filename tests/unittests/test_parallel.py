@@ -0,0 +1,95 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+from collections import OrderedDict
+import threading
+
+from curtin import parallel
+from .helpers import CiTestCase
+
+
+class TestRunGraph(CiTestCase):
+
+    def test_serial_runs_in_graph_order(self):
+        """run_graph with one worker calls func in insertion order."""
+        graph = OrderedDict([('a', []), ('b', []), ('c', ['a']), ('d', [])])
+        called = []
+        parallel.run_graph(graph, called.append)
+        self.assertEqual(['a', 'b', 'c', 'd'], called)
+
+    def test_dependencies_complete_before_dependents(self):
+        """run_graph does not start a node until its deps finished."""
+        graph = OrderedDict([('disk1', []), ('disk2', []),
+                             ('part1', ['disk1']), ('part2', ['disk2']),
+                             ('md0', ['part1', 'part2'])])
+        lock = threading.Lock()
+        finished = []
+
+        def func(node):
+            with lock:
+                for dep in graph[node]:
+                    self.assertIn(dep, finished)
+            with lock:
+                finished.append(node)
+
+        parallel.run_graph(graph, func, max_workers=4)
+        self.assertEqual(sorted(graph.keys()), sorted(finished))
+        self.assertEqual('md0', finished[-1])
+
+    def test_independent_nodes_run_concurrently(self):
+        """run_graph runs independent nodes at the same time."""
+        graph = OrderedDict([('a', []), ('b', [])])
+        barrier = threading.Event()
+        started = []
+
+        def func(node):
+            started.append(node)
+            if len(started) == 2:
+                barrier.set()
+            # both nodes must be running for the event to be set
+            self.assertTrue(barrier.wait(5))
+
+        parallel.run_graph(graph, func, max_workers=2)
+        self.assertEqual(['a', 'b'], sorted(started))
+
+    def test_failure_stops_scheduling_and_raises(self):
+        """run_graph raises the first error and starts nothing after it."""
+        graph = OrderedDict([('a', []), ('b', ['a']), ('c', ['b'])])
+        called = []
+
+        def func(node):
+            called.append(node)
+            if node == 'b':
+                raise RuntimeError('b failed')
+
+        with self.assertRaisesRegexp(RuntimeError, 'b failed'):
+            parallel.run_graph(graph, func, max_workers=2)
+        self.assertEqual(['a', 'b'], called)
+
+    def test_base_exception_is_reraised(self):
+        """run_graph re-raises a SystemExit raised by a worker."""
+        graph = OrderedDict([('a', []), ('b', ['a'])])
+
+        def func(node):
+            if node == 'a':
+                raise SystemExit(3)
+
+        with self.assertRaises(SystemExit) as ctx:
+            parallel.run_graph(graph, func, max_workers=2)
+        self.assertEqual(3, ctx.exception.code)
+
+    def test_unknown_dependency_raises(self):
+        graph = OrderedDict([('a', ['missing'])])
+        with self.assertRaises(ValueError):
+            parallel.run_graph(graph, lambda node: None)
+
+    def test_cycle_raises(self):
+        graph = OrderedDict([('a', ['b']), ('b', ['a'])])
+        with self.assertRaises(ValueError):
+            parallel.run_graph(graph, lambda node: None, max_workers=2)
+
+    def test_invalid_max_workers_raises(self):
+        with self.assertRaises(ValueError):
+            parallel.run_graph(OrderedDict(), lambda node: None,
+                               max_workers=0)
+
+# vi: ts=4 expandtab syntax=python
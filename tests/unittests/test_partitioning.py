@@ -123,14 +123,14 @@ class TestBlock(CiTestCase):
         mock_parted.freshDisk.assert_called_with(
             mock_parted.getDevice(), "msdos")
 
-    @mock.patch("curtin.commands.block_meta.time")
+    @mock.patch("curtin.commands.block_meta.devwait")
     @mock.patch("curtin.commands.block_meta.os.path")
     @mock.patch("curtin.commands.block_meta.util")
     @mock.patch("curtin.commands.block_meta.parted")
     @mock.patch("curtin.commands.block_meta.get_path_to_storage_volume")
     def test_partition_handler(self, mock_get_path_to_storage_volume,
                                mock_parted, mock_util, mock_path,
-                               mock_time):
+                               mock_devwait):
         mock_path.exists.return_value = True
         mock_get_path_to_storage_volume.return_value = "/dev/fake"
         mock_parted.sizeToSectors.return_value = parted.sizeToSectors(8, "GB",
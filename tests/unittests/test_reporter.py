@@ -23,10 +23,16 @@ from curtin import reporter
 from curtin.reporter import handlers
 from curtin import url_helper
 from curtin.reporter import events
+from curtin.reporter import profile
+from curtin.reporter import upload
 from .helpers import CiTestCase
 
 import base64
+import gzip
+import io
+import json
 import os
+import threading
 
 
 class TestLegacyReporter(CiTestCase):
@@ -200,8 +206,274 @@ class TestReporter(CiTestCase):
         webhook_handler = handlers.WebHookHandler('127.0.0.1:8000',
                                                   level='INFO')
         webhook_handler.publish_event(event)
-        webhook_handler.oauth_helper.geturl.assert_called_with(
-            url='127.0.0.1:8000', data=event.as_dict(),
-            headers=webhook_handler.headers, retries=None)
+        geturl = webhook_handler.oauth_helper.geturl
+        self.assertEqual(1, geturl.call_count)
+        kwargs = geturl.call_args[1]
+        self.assertEqual(webhook_handler.headers, kwargs['headers'])
+        body = kwargs['data']
+        expected = event.as_dict()
+        expected['files'][0]['size'] = len(test_data)
+        expected['files'][0]['truncated'] = False
+        self.assertEqual(expected, json.loads(body.decode()))
+
+
+class TestAsyncWebHookHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestAsyncWebHookHandler, self).setUp()
+        self.add_patch('curtin.url_helper.OauthUrlHelper', 'm_oauth')
+        self.add_patch('curtin.reporter.handlers.atexit', 'm_atexit')
+        env = patch.dict('os.environ', {'CURTIN_REPORTSTACK': 'cmd-install'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _handler(self, **kwargs):
+        handler = handlers.WebHookHandler('127.0.0.1:8000', level='INFO',
+                                          mode='async', **kwargs)
+        self.geturl = handler.oauth_helper.geturl
+        return handler
+
+    def _event(self, name='cmd-install/stage-partitioning',
+               event_type=events.START_EVENT_TYPE):
+        return events.ReportingEvent(event_type, name, 'test event',
+                                     level='INFO')
+
+    def _posted(self):
+        return [c[1]['data'] for c in self.geturl.call_args_list]
+
+    def test_events_posted_by_worker(self):
+        handler = self._handler()
+        event = self._event()
+        handler.publish_event(event)
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual([event.as_dict()], self._posted())
+        self.m_atexit.register.assert_called_once_with(handler.flush)
+
+    def test_invalid_mode_is_sync(self):
+        handler = handlers.WebHookHandler('127.0.0.1:8000', mode='bogus')
+        self.assertEqual('sync', handler.mode)
+        handler.publish_event(self._event())
+        self.assertIsNone(handler._worker)
+        self.assertEqual(1, handler.oauth_helper.geturl.call_count)
+
+    def test_events_batched(self):
+        handler = self._handler(batch_size=2)
+        evs = [self._event('ev%d' % i) for i in range(3)]
+        # hold the worker off until all events are queued
+        with handler._cond:
+            for event in evs:
+                handler.publish_event(event)
+        self.assertTrue(handler.flush(timeout=5))
+        posted = self._posted()
+        self.assertEqual([evs[0].as_dict(), evs[1].as_dict()],
+                         json.loads(posted[0].decode()))
+        self.assertEqual([evs[2].as_dict()], posted[1:])
+
+    def test_rejected_batch_posted_singly(self):
+        handler = self._handler(batch_size=10)
+
+        def geturl(**kwargs):
+            if isinstance(kwargs['data'], bytes):
+                raise url_helper.UrlError('rejected', code=400)
+        self.geturl.side_effect = geturl
+        evs = [self._event('ev%d' % i) for i in range(3)]
+        with handler._cond:
+            for event in evs:
+                handler.publish_event(event)
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual(1, handler.batch_size)
+        self.assertEqual(4, self.geturl.call_count)
+        self.assertEqual([ev.as_dict() for ev in evs], self._posted()[1:])
+
+    def test_toplevel_finish_flushes(self):
+        handler = self._handler()
+        with patch.object(handler, 'flush') as m_flush:
+            handler.publish_event(self._event(
+                'cmd-install/stage-partitioning', events.FINISH_EVENT_TYPE))
+            self.assertEqual(0, m_flush.call_count)
+            handler.publish_event(self._event(
+                'cmd-install', events.FINISH_EVENT_TYPE))
+            self.assertEqual(1, m_flush.call_count)
+
+    def test_full_queue_drops_events(self):
+        handler = self._handler(queue_size=1, flush_timeout=0.1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.geturl.side_effect = lambda **kw: release.wait(5)
+        handler.publish_event(self._event('ev0'))
+        # wait for the worker to pick up the first event
+        for _ in range(50):
+            if handler._inflight:
+                break
+            release.wait(0.1)
+        handler.publish_event(self._event('ev1'))
+        handler.publish_event(self._event('ev2'))
+        self.assertEqual(1, handler.dropped)
+        self.assertFalse(handler.flush(timeout=0.1))
+        release.set()
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual(['ev0', 'ev1'], [d['name'] for d in self._posted()])
+
+
+class TestUpload(CiTestCase):
+
+    def setUp(self):
+        super(TestUpload, self).setUp()
+        self.content = b''.join(b'line %d\n' % i for i in range(20000))
+        self.path = self.tmp_path('install.log')
+        with open(self.path, 'wb') as fp:
+            fp.write(self.content)
+
+    def test_read_file_in_chunks(self):
+        chunks = list(upload.read_file(self.path, chunk_size=4096))
+        self.assertEqual(self.content, b''.join(chunks))
+        self.assertTrue(all(len(c) <= 4096 for c in chunks))
+
+    def test_read_file_keeps_tail(self):
+        data = b''.join(upload.read_file(self.path, max_size=100))
+        marker, _, tail = data.partition(b'\n')
+        self.assertEqual(self.content[-100:], tail)
+        self.assertIn(b'showing the last 100 of %d bytes' % len(self.content),
+                      marker)
+
+    def test_read_file_compressed(self):
+        data = b''.join(upload.read_file(self.path, compress=True))
+        self.assertLess(len(data), len(self.content))
+        self.assertEqual(self.content, gzip.GzipFile(
+            fileobj=io.BytesIO(data)).read())
+
+    def test_b64encode_chunks(self):
+        chunks = [self.content[i:i + 1000]
+                  for i in range(0, len(self.content), 1000)]
+        self.assertEqual(base64.b64encode(self.content),
+                         b''.join(upload.b64encode_chunks(chunks)))
+
+    def test_json_event(self):
+        missing = self.tmp_path('missing')
+        body = b''.join(upload.json_event({'name': 'cmd-install'},
+                                          [self.path, missing],
+                                          max_size=10)())
+        data = json.loads(body.decode())
+        self.assertEqual('cmd-install', data['name'])
+        info, absent = data['files']
+        self.assertTrue(info['truncated'])
+        self.assertEqual(len(self.content), info['size'])
+        self.assertTrue(base64.b64decode(info['content']).endswith(
+            self.content[-10:]))
+        self.assertEqual({'path': missing, 'encoding': 'base64',
+                          'content': None}, absent)
+
+    def test_json_event_length(self):
+        body = upload.json_event({'name': 'cmd-install'}, [self.path],
+                                 max_size=1000)
+        self.assertEqual(len(b''.join(body())), body.length)
+
+    def test_json_event_compressed_has_no_length(self):
+        body = upload.json_event({'name': 'cmd-install'}, [self.path],
+                                 compress=True)
+        self.assertIsNone(body.length)
+
+    def test_body_keeps_window_of_growing_file(self):
+        body = upload.multipart({}, {'install.log': self.path}, 'b')
+        with open(self.path, 'ab') as fp:
+            fp.write(b'more\n')
+        self.assertEqual(body.length, len(b''.join(body())))
+
+    @patch('curtin.url_helper.OauthUrlHelper')
+    def test_maas_reporter_sends_content_length(self, mock_url_helper):
+        reporter = MAASReporter({'url': 'http://maas/status'})
+        reporter.urlhelper.geturl.return_value = b'OK'
+        reporter.report('OK', 'done', files=[self.path])
+        kwargs = reporter.urlhelper.geturl.call_args[1]
+        self.assertIsInstance(kwargs['data'], bytes)
+        self.assertEqual(str(len(kwargs['data'])),
+                         kwargs['headers']['content-length'])
+
+    @patch('curtin.url_helper.OauthUrlHelper')
+    def test_maas_reporter_streams_files(self, mock_url_helper):
+        reporter = MAASReporter({'url': 'http://maas/status',
+                                 'post_files_max_size': 1000,
+                                 'post_files_stream': True})
+        reporter.urlhelper.geturl.return_value = b'OK'
+        reporter.report('OK', 'done', files=[self.path,
+                                             self.tmp_path('missing')])
+        kwargs = reporter.urlhelper.geturl.call_args[1]
+        boundary = kwargs['headers']['content-type'].split('boundary=')[1]
+        body = b''.join(kwargs['data']())
+        self.assertEqual(len(body), kwargs['data'].length)
+        parts = body.split(b'--' + boundary.encode())
+        self.assertEqual([b'', b'--\r\n'], [parts[0], parts[-1]])
+        self.assertEqual(3, len(parts[1:-1]))
+        self.assertIn(b'name="error"\r\n\r\ndone\r\n', parts[2])
+        self.assertIn(b'filename="install.log"', parts[3])
+        self.assertTrue(parts[3].endswith(self.content[-1000:] + b'\r\n'))
+
+
+class TestProfileHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestProfileHandler, self).setUp()
+        self.path = os.path.join(self.tmp_dir(), 'logs', 'profile')
+        self.add_patch('curtin.reporter.handlers.tracing.subp_seconds',
+                       'm_subp_seconds', return_value=0.0)
+        self.handler = handlers.ProfileHandler(path=self.path)
+
+    def _run(self, name, start, subp=(0.0, 0.0), children=()):
+        self.m_subp_seconds.return_value = subp[0]
+        self.handler.publish_event(events.ReportingEvent(
+            events.START_EVENT_TYPE, name, 'test', timestamp=start))
+        for child in children:
+            self._run(*child)
+        self.m_subp_seconds.return_value = subp[1]
+        self.handler.publish_event(events.FinishReportingEvent(
+            name, 'test'))
+
+    def _profile(self):
+        # finish events take their timestamp from the clock
+        with patch('curtin.reporter.events.time.time') as m_time:
+            m_time.side_effect = [3.0, 5.5, 6.0]
+            self._run('cmd-install', 0.0, children=[
+                ('cmd-install/stage-partitioning', 1.0, (0.0, 1.5)),
+                ('cmd-install/stage-curthooks', 4.0, (1.5, 2.0))])
+
+    def test_frames_recorded(self):
+        self._profile()
+        frames = profile.load_frames(self.path + profile.FRAMES_SUFFIX)
+        self.assertEqual(['cmd-install/stage-partitioning',
+                          'cmd-install/stage-curthooks', 'cmd-install'],
+                         [f['name'] for f in frames])
+        self.assertEqual([2.0, 1.5, 6.0], [f['wall'] for f in frames])
+        self.assertEqual([1.5, 0.5, 0.0], [f['subp'] for f in frames])
+        self.assertEqual('SUCCESS', frames[0]['result'])
+
+    def test_collapsed_stacks(self):
+        self._profile()
+        with open(self.path + profile.FOLDED_SUFFIX) as fp:
+            folded = fp.read().splitlines()
+        self.assertEqual([
+            'cmd-install 2500000',
+            'cmd-install;stage-curthooks 1000000',
+            'cmd-install;stage-curthooks;[subprocess] 500000',
+            'cmd-install;stage-partitioning 500000',
+            'cmd-install;stage-partitioning;[subprocess] 1500000'], folded)
+
+    def test_chrome_trace(self):
+        self._profile()
+        with open(self.path + profile.TRACE_SUFFIX) as fp:
+            trace = json.load(fp)
+        names = [(e['name'], e['ts'], e['dur'], e['ph'])
+                 for e in trace['traceEvents']]
+        self.assertEqual([('cmd-install', 0, 6000000, 'X'),
+                          ('stage-partitioning', 1000000, 2000000, 'X'),
+                          ('stage-curthooks', 4000000, 1500000, 'X')],
+                         names)
+
+    def test_registered(self):
+        reporter.update_configuration({'prof': {'type': 'profile',
+                                                'path': self.path}})
+        self.addCleanup(reporter.update_configuration, {'prof': None})
+        self.assertIsInstance(
+            reporter.instantiated_handler_registry.registered_items['prof'],
+            handlers.ProfileHandler)
 
 # vi: ts=4 expandtab syntax=python
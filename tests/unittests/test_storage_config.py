@@ -1,6 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import copy
 import json
+import mock
 from .helpers import CiTestCase, skipUnlessJsonSchema
 from curtin import storage_config
 from curtin.storage_config import ProbertParser as baseparser
@@ -54,6 +55,74 @@ class TestStorageConfigSchema(CiTestCase):
         config = {'config': [disk], 'version': 1}
         storage_config.validate_config(config)
 
+    @skipUnlessJsonSchema()
+    def test_validate_config_checks_item_against_its_type(self):
+        """ validate_config checks a single item with its type's schema. """
+        disk = {'id': 'disk-vdc', 'path': '/dev/vdc', 'type': 'disk'}
+        storage_config.validate_config(disk)
+        disk['ptable'] = 'not-a-ptable'
+        with self.assertRaises(ValueError) as ctx:
+            storage_config.validate_config(disk)
+        self.assertIn('not-a-ptable', str(ctx.exception))
+
+    @skipUnlessJsonSchema()
+    def test_validate_config_reuses_validators(self):
+        """ validate_config builds each schema's validator once. """
+        disk = {'id': 'disk-vdc', 'path': '/dev/vdc', 'type': 'disk'}
+        storage_config.validate_config(disk)
+        name = storage_config.STORAGE_CONFIG_TYPES['disk'].schema['name']
+        validator = storage_config._validators[name]
+        storage_config.validate_config(disk)
+        self.assertIs(validator, storage_config._validators[name])
+
+
+class TestProbeDataIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestProbeDataIndex, self).setUp()
+        self.probe_data = _get_data('probert_storage_multipath.json')
+        self.index = storage_config.ProbeDataIndex(self.probe_data)
+
+    def test_devlinks(self):
+        """ ProbeDataIndex maps device links to blockdev keys. """
+        self.assertEqual(
+            '/dev/sdb',
+            self.index.devlinks[
+                '/dev/disk/by-path/pci-0000:00:04.0-scsi-0:0:1:0'])
+
+    def test_serial_members(self):
+        """ ProbeDataIndex groups kernel names by serial and devtype. """
+        self.assertEqual(
+            ['sda', 'sdb'],
+            self.index.serial_members[('30000000000000064', 'disk')])
+        self.assertEqual(
+            ['sda1', 'sda2', 'sdb1', 'sdb2'],
+            self.index.serial_members[('30000000000000064', 'partition')])
+
+    def test_multipath_maps(self):
+        """ ProbeDataIndex maps multipaths to paths and back. """
+        self.assertEqual({'mpatha': ['sda', 'sdb']}, self.index.mpath_paths)
+        self.assertEqual({'sda': 'mpatha', 'sdb': 'mpatha'},
+                         self.index.path_mpath)
+
+    def test_partition_parent(self):
+        """ ProbeDataIndex maps partitions to their parent devname. """
+        self.assertEqual('/dev/sdb', self.index.partition_parent['/dev/sdb2'])
+        self.assertNotIn('/dev/sdb', self.index.partition_parent)
+
+    def test_handles_missing_data(self):
+        """ ProbeDataIndex is empty without blockdev or multipath data. """
+        index = storage_config.ProbeDataIndex({})
+        self.assertEqual({}, index.devlinks)
+        self.assertEqual({}, index.mpath_paths)
+
+    def test_parser_builds_index_on_demand(self):
+        """ ProbertParser builds an index if none was passed. """
+        bdevp = BlockdevParser(self.probe_data)
+        self.assertEqual(self.index.devlinks, bdevp.index.devlinks)
+        self.assertIs(self.index,
+                      BlockdevParser(self.probe_data, index=self.index).index)
+
 
 class TestProbertParser(CiTestCase):
 
@@ -947,6 +1016,189 @@ class TestZfsParser(CiTestCase):
         self.assertEqual(4, len(zfs))
 
 
+class TestGetDependencyGraph(CiTestCase):
+
+    def _sconfig(self, items):
+        return storage_config.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': items}})
+
+    def test_dependency_graph_links_referenced_items(self):
+        """ get_dependency_graph maps items to the ids they reference."""
+        sconfig = self._sconfig([
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+             'number': 1},
+            {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+             'number': 1},
+            {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+             'devices': ['sda1', 'sdb1']},
+            {'id': 'md0-fmt', 'type': 'format', 'volume': 'md0',
+             'fstype': 'ext4'},
+        ])
+        self.assertEqual(
+            [('sda', set()), ('sdb', set()),
+             ('sda1', {'sda'}), ('sdb1', {'sdb'}),
+             ('md0', {'sda1', 'sdb1'}), ('md0-fmt', {'md0'})],
+            list(storage_config.get_dependency_graph(sconfig).items()))
+
+    def test_dependency_graph_orders_items_sharing_a_device(self):
+        """ get_dependency_graph keeps users of one device in order."""
+        sconfig = self._sconfig([
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+             'number': 1},
+            {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+             'number': 2},
+            {'id': 'sda3', 'type': 'partition', 'device': 'sda',
+             'number': 3},
+        ])
+        graph = storage_config.get_dependency_graph(sconfig)
+        self.assertEqual({'sda'}, graph['sda1'])
+        self.assertEqual({'sda', 'sda1'}, graph['sda2'])
+        self.assertEqual({'sda', 'sda2'}, graph['sda3'])
+
+    def test_dependency_graph_partition_users_wait_for_ptable(self):
+        """ get_dependency_graph orders partition users after the last
+            partition on the same disk."""
+        sconfig = self._sconfig([
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+             'number': 1},
+            {'id': 'sda1-fmt', 'type': 'format', 'volume': 'sda1',
+             'fstype': 'ext4'},
+            {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+             'number': 2},
+        ])
+        graph = storage_config.get_dependency_graph(sconfig)
+        self.assertEqual({'sda', 'sda1'}, graph['sda2'])
+        self.assertEqual({'sda1', 'sda2'}, graph['sda1-fmt'])
+
+    def test_dependency_graph_serializes_mounts(self):
+        """ get_dependency_graph keeps mount items in declared order."""
+        sconfig = self._sconfig([
+            {'id': 'sda', 'type': 'disk'},
+            {'id': 'sdb', 'type': 'disk'},
+            {'id': 'sda-fmt', 'type': 'format', 'volume': 'sda',
+             'fstype': 'ext4'},
+            {'id': 'sdb-fmt', 'type': 'format', 'volume': 'sdb',
+             'fstype': 'ext4'},
+            {'id': 'root', 'type': 'mount', 'device': 'sda-fmt',
+             'path': '/'},
+            {'id': 'home', 'type': 'mount', 'device': 'sdb-fmt',
+             'path': '/home'},
+        ])
+        graph = storage_config.get_dependency_graph(sconfig)
+        self.assertEqual({'sda'}, graph['sda-fmt'])
+        self.assertEqual({'sdb'}, graph['sdb-fmt'])
+        self.assertEqual({'sdb-fmt', 'root'}, graph['home'])
+
+    def test_dependency_graph_disk_depends_on_dasd(self):
+        """ get_dependency_graph orders a disk after its dasd."""
+        sconfig = self._sconfig([
+            {'id': 'dasd0', 'type': 'dasd', 'device_id': '0.0.1544'},
+            {'id': 'disk0', 'type': 'disk', 'device_id': '0.0.1544'},
+        ])
+        graph = storage_config.get_dependency_graph(sconfig)
+        self.assertEqual({'dasd0'}, graph['disk0'])
+
+    def test_find_item_disks(self):
+        """ find_item_disks returns the disks an item is built on."""
+        sconfig = self._sconfig([
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'nvme0', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+            {'id': 'sdb1', 'type': 'partition', 'device': 'sdb'},
+            {'id': 'nvme0p1', 'type': 'partition', 'device': 'nvme0'},
+            {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+             'devices': ['sda1', 'sdb1']},
+            {'id': 'md0-fmt', 'type': 'format', 'volume': 'md0',
+             'fstype': 'ext4', 'journal_device': 'nvme0p1'},
+        ])
+        self.assertEqual(['sda'], storage_config.find_item_disks('sda',
+                                                                 sconfig))
+        self.assertEqual(['sda', 'sdb'],
+                         storage_config.find_item_disks('md0', sconfig))
+        self.assertEqual(['nvme0', 'sda', 'sdb'],
+                         storage_config.find_item_disks('md0-fmt', sconfig))
+
+
+class TestOrderStorageConfig(CiTestCase):
+
+    def _sconfig(self, items):
+        return storage_config.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': items}})
+
+    def _legacy_order(self, items):
+        config = {'storage': {'version': 1, 'config': items}}
+        return storage_config.merge_config_trees_to_list(
+            [storage_config.get_config_tree(item['id'], config)
+             for item in items])
+
+    def test_dependency_levels_count_tree_items(self):
+        """ get_dependency_levels matches the size of each config tree."""
+        items = [
+            {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+             'devices': ['sda1', 'sdb1']},
+            {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+             'number': 1},
+            {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+             'number': 2},
+            {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+             'number': 1},
+        ]
+        config = {'storage': {'version': 1, 'config': items}}
+        levels = storage_config.get_dependency_levels(self._sconfig(items))
+        self.assertEqual(
+            dict((item['id'],
+                  len(storage_config.get_config_tree(item['id'], config)))
+                 for item in items),
+            dict(levels))
+        self.assertEqual({'sda': 1, 'sda1': 3, 'md0': 6},
+                         dict((k, levels[k]) for k in ('sda', 'sda1', 'md0')))
+        self.assertEqual(
+            ['sda', 'sdb', 'sdb1', 'sda1', 'sda2', 'md0'],
+            [item['id']
+             for item in storage_config.order_storage_config(
+                 self._sconfig(items))])
+
+    @skipUnlessJsonSchema()
+    def test_order_matches_merged_config_trees(self):
+        """ order_storage_config orders probed configs like merged trees."""
+        for name in ('probert_storage_dmcrypt.json',
+                     'probert_storage_mdadm_bcache.json',
+                     'probert_storage_zlp6.json'):
+            probe_data = _get_data(name)
+            extracted = storage_config.extract_storage_config(probe_data)
+            items = list(reversed(extracted['storage']['config']))
+            self.assertEqual(
+                self._legacy_order(items),
+                storage_config.order_storage_config(self._sconfig(items)))
+
+    def test_order_validates_dependencies(self):
+        """ order_storage_config rejects invalid references."""
+        items = [
+            {'id': 'sda', 'type': 'disk'},
+            {'id': 'sda1', 'type': 'partition', 'device': 'sdz',
+             'number': 1},
+        ]
+        with self.assertRaisesRegexp(ValueError, 'Invalid dep_id'):
+            storage_config.order_storage_config(self._sconfig(items))
+
+    def test_order_detects_cycles(self):
+        """ order_storage_config raises on a dependency cycle."""
+        items = [
+            {'id': 'md0', 'type': 'raid', 'devices': ['md1']},
+            {'id': 'md1', 'type': 'raid', 'devices': ['md0']},
+        ]
+        with self.assertRaisesRegexp(ValueError, 'cycle'):
+            storage_config.order_storage_config(self._sconfig(items),
+                                                validate=False)
+
+
 class TestExtractStorageConfig(CiTestCase):
 
     def setUp(self):
@@ -982,6 +1234,15 @@ class TestExtractStorageConfig(CiTestCase):
                 self.assertEqual({'storage': {'config': [], 'version': 1}},
                                  extracted)
 
+    @skipUnlessJsonSchema()
+    def test_parsers_share_one_index(self):
+        """ extract_storage_config builds one index for all parsers. """
+        self.probe_data = _get_data('probert_storage_multipath.json')
+        with mock.patch('curtin.storage_config.ProbeDataIndex',
+                        wraps=storage_config.ProbeDataIndex) as m_index:
+            storage_config.extract_storage_config(self.probe_data)
+        self.assertEqual(1, m_index.call_count)
+
     @skipUnlessJsonSchema()
     def test_find_all_multipath(self):
         """ verify probed multipath paths are included in config. """
@@ -0,0 +1,115 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import json
+import mock
+import os
+
+from curtin import tracing, util
+from curtin.commands import subp_summary
+from curtin.reporter import events
+from .helpers import CiTestCase
+
+
+class TestToolName(CiTestCase):
+
+    def test_tool_name(self):
+        for argv, tool in (
+                (['/sbin/mkfs.ext4', '-F', '/dev/sda1'], 'mkfs.ext4'),
+                (['unshare', '--fork', '--pid', '--', 'chroot', '/tmp/t',
+                  'apt-get', 'install'], 'apt-get'),
+                (['sh', '-c', 'udevadm settle --timeout=10'], 'udevadm'),
+                (['env', 'DEBIAN_FRONTEND=noninteractive', 'apt-get'],
+                 'apt-get'),
+                ([], None)):
+            self.assertEqual(tool, tracing.tool_name(argv))
+
+
+class TestLedger(CiTestCase):
+    allowed_subp = True
+
+    def setUp(self):
+        super(TestLedger, self).setUp()
+        self.ledger = self.tmp_path('subp.jsonl')
+        env = mock.patch.dict('os.environ', {})
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('CURTIN_REPORTSTACK', None)
+
+    def test_disabled_by_default(self):
+        os.environ.pop(tracing.LEDGER_ENV, None)
+        util.subp(['true'])
+        self.assertFalse(os.path.exists(self.ledger))
+
+    def test_subp_recorded(self):
+        tracing.enable(self.ledger)
+        with events.ReportEventStack('cmd-test', 'test',
+                                     reporting_enabled=False):
+            util.subp(['echo', 'hello'], capture=True)
+            with self.assertRaises(util.ProcessExecutionError):
+                util.subp(['sh', '-c', 'exit 3'], capture=True)
+        util.subp(['true'])
+        with self.assertRaises(util.ProcessExecutionError):
+            util.subp(['/nonexistent/cmd', 'secret'], logstring='cmd ***')
+        echo, failed, plain, hidden = tracing.load(self.ledger)
+        self.assertEqual(['echo', 'hello'], echo['argv'])
+        self.assertEqual('echo', echo['tool'])
+        self.assertEqual('cmd-test', echo['phase'])
+        self.assertEqual((0, 6, 0), (echo['exit_code'],
+                                     echo['stdout_bytes'],
+                                     echo['stderr_bytes']))
+        self.assertGreaterEqual(echo['duration'], 0)
+        self.assertEqual(3, failed['exit_code'])
+        self.assertIsNone(plain['phase'])
+        self.assertIsNone(plain['stdout_bytes'])
+        self.assertEqual(['cmd ***'], hidden['argv'])
+        self.assertEqual('cmd', hidden['tool'])
+        self.assertIsNone(hidden['exit_code'])
+
+    def test_string_command_recorded(self):
+        tracing.enable(self.ledger)
+        tracing.record('echo hello', None, 0, 0)
+        [entry] = tracing.load(self.ledger)
+        self.assertEqual(['echo hello'], entry['argv'])
+        self.assertEqual('echo', entry['tool'])
+
+    def test_load_skips_partial_lines(self):
+        with open(self.ledger, 'w') as fp:
+            fp.write(json.dumps({'tool': 'sgdisk', 'duration': 1}) + '\n')
+            fp.write('{"tool": "mkfs\n')
+        self.assertEqual([{'tool': 'sgdisk', 'duration': 1}],
+                         tracing.load(self.ledger))
+
+
+class TestSummary(CiTestCase):
+
+    entries = [
+        {'tool': 'sgdisk', 'phase': 'cmd-install/stage-partitioning',
+         'duration': 1.5, 'exit_code': 0, 'stdout_bytes': 10,
+         'stderr_bytes': None},
+        {'tool': 'mkfs.ext4', 'phase': 'cmd-install/stage-partitioning',
+         'duration': 4.0, 'exit_code': 0, 'stdout_bytes': 100,
+         'stderr_bytes': 5},
+        {'tool': 'sgdisk', 'phase': 'cmd-install/stage-curthooks',
+         'duration': 0.5, 'exit_code': 2, 'stdout_bytes': None,
+         'stderr_bytes': None},
+    ]
+
+    def test_summarize(self):
+        summary = tracing.summarize(self.entries)
+        sgdisk = summary['tools']['sgdisk']
+        self.assertEqual((2, 2.0, 1.5, 1, 10),
+                         (sgdisk['count'], sgdisk['total'], sgdisk['max'],
+                          sgdisk['failed'], sgdisk['stdout_bytes']))
+        partitioning = summary['phases']['cmd-install/stage-partitioning']
+        self.assertEqual(5.5, partitioning['total'])
+        self.assertEqual(['mkfs.ext4', 'sgdisk'],
+                         sorted(partitioning['tools']))
+
+    def test_format_summary(self):
+        text = subp_summary.format_summary(tracing.summarize(self.entries),
+                                           top=1)
+        lines = text.splitlines()
+        self.assertTrue(lines[1].startswith('mkfs.ext4 '))
+        self.assertEqual(2, len([line for line in lines
+                                 if line.startswith('    ')]))
+        self.assertIn('cmd-install/stage-curthooks', text)
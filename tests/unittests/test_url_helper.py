@@ -1,8 +1,16 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import filecmp
+import hashlib
 import json
 import mock
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 from curtin import url_helper
 
@@ -172,3 +180,241 @@ class TestGetMaasVersion(CiTestCase):
             mock.call('http://%s/MAAS/api/%s/version/' % (host,
                                                           maas_api_version))
         ])
+
+
+class _RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serve server.content, honoring Range headers if server.ranges.
+
+    If server.drop_after is set, the next response is cut after that many
+    bytes of body."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.content
+        start, end = 0, len(content) - 1
+        rng = self.headers.get('Range')
+        self.server.requests.append(rng)
+        if rng and self.server.ranges:
+            first, _, last = rng.split('=', 1)[1].partition('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end, len(content)))
+        else:
+            self.send_response(200)
+        body = content[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.server.lock:
+            drop_after = self.server.drop_after
+            self.server.drop_after = None
+        if drop_after is not None:
+            self.wfile.write(body[:drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class TestDownloadHTTP(CiTestCase):
+    """Test url_helper.download against a local http server."""
+
+    def setUp(self):
+        super(TestDownloadHTTP, self).setUp()
+        self.content = b''.join(
+            [('%08d' % i).encode() for i in range(64 * 1024)])
+        self.server = HTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+        self.server.content = self.content
+        self.server.ranges = True
+        self.server.drop_after = None
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/image.img' % self.server.server_port
+        self.target = self.tmp_path('image.img')
+
+    def _read_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_download_http_single_stream(self):
+        """download fetches a url with configurable read size."""
+        url_helper.download(self.url, self.target, buflen=4096)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual([None], self.server.requests)
+
+    def test_download_http_resumes_after_dropped_connection(self):
+        """download resumes at the last byte written after an error."""
+        self.server.drop_after = 100000
+        url_helper.download(self.url, self.target, retries=1,
+                            retry_delay=0)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual([None, 'bytes=100000-'], self.server.requests)
+
+    def test_download_http_restarts_if_range_not_supported(self):
+        """download starts over if the server ignores range requests."""
+        self.server.ranges = False
+        self.server.drop_after = 100000
+        url_helper.download(self.url, self.target, retries=1,
+                            retry_delay=0)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual([None, 'bytes=100000-'], self.server.requests)
+
+    def test_download_http_segments(self):
+        """download fetches concurrent ranges into a preallocated file."""
+        url_helper.download(self.url, self.target, segments=4)
+        self.assertEqual(self.content, self._read_target())
+        seg = len(self.content) // 4
+        self.assertEqual(
+            sorted(['bytes=0-0'] +
+                   ['bytes=%d-%d' % (i * seg, (i + 1) * seg - 1)
+                    for i in range(4)]),
+            sorted(self.server.requests))
+
+    def test_download_http_segment_resumes_after_dropped_connection(self):
+        """download resumes a failed segment from its last good offset."""
+        self.server.drop_after = 1000
+        url_helper.download(self.url, self.target, segments=2, retries=1,
+                            retry_delay=0)
+        self.assertEqual(self.content, self._read_target())
+        # The range probe is cut short but still returns its single byte.
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_download_http_segments_fallback_without_ranges(self):
+        """download uses a single stream if ranges are unsupported."""
+        self.server.ranges = False
+        url_helper.download(self.url, self.target, segments=4)
+        self.assertEqual(self.content, self._read_target())
+        self.assertEqual(['bytes=0-0', None], self.server.requests)
+
+    def test_download_http_verifies_checksum(self):
+        """download verifies a streaming checksum."""
+        digest = hashlib.sha256(self.content).hexdigest()
+        for segments in (1, 4):
+            url_helper.download(self.url, self.target, segments=segments,
+                                checksum='sha256:' + digest)
+            self.assertEqual(self.content, self._read_target())
+
+    def test_download_http_checksum_mismatch_raises(self):
+        """download raises ValueError if the checksum does not match."""
+        digest = hashlib.sha256(b'other').hexdigest()
+        with self.assertRaisesRegexp(ValueError, 'Checksum mismatch'):
+            url_helper.download(self.url, self.target,
+                                checksum='sha256:' + digest)
+
+    def test_download_invalid_checksum_raises(self):
+        with self.assertRaises(ValueError):
+            url_helper.download(self.url, self.target, checksum='nohash')
+
+    def test_download_http_cancelled_raises(self):
+        """download stops and raises UrlError once cancel is set."""
+        cancel = threading.Event()
+        cancel.set()
+        for segments in (1, 4):
+            with self.assertRaisesRegexp(url_helper.UrlError, 'cancelled'):
+                url_helper.download(self.url, self.target, retries=3,
+                                    retry_delay=0, segments=segments,
+                                    cancel=cancel)
+
+    def test_resuming_reader_resumes_after_dropped_connection(self):
+        """ResumingUrlReader continues with a range request."""
+        self.server.drop_after = 1000
+        with url_helper.ResumingUrlReader(self.url, retries=1,
+                                          retry_delay=0) as reader:
+            data = b''.join(iter(lambda: reader.read(4096), b''))
+        self.assertEqual(self.content, data)
+        self.assertEqual([None, 'bytes=1000-'], self.server.requests)
+
+    def test_resuming_reader_raises_if_range_not_supported(self):
+        """ResumingUrlReader cannot restart a stream already consumed."""
+        self.server.ranges = False
+        self.server.drop_after = 1000
+        reader = url_helper.ResumingUrlReader(self.url, retries=1,
+                                              retry_delay=0)
+        with self.assertRaisesRegexp(url_helper.UrlError, 'resuming'):
+            while reader.read(4096):
+                pass
+        reader.close()
+
+    def test_resuming_reader_restart_skips_bytes_returned(self):
+        """ResumingUrlReader with restart skips what it already returned."""
+        self.server.ranges = False
+        self.server.drop_after = 1000
+        with url_helper.ResumingUrlReader(self.url, retries=1, retry_delay=0,
+                                          restart=True) as reader:
+            data = b''.join(iter(lambda: reader.read(4096), b''))
+        self.assertEqual(self.content, data)
+        self.assertEqual([None, 'bytes=1000-'], self.server.requests)
+
+
+class _ChunkedPostHandler(BaseHTTPRequestHandler):
+    """Record the body of each POST, failing the first one."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            body = self.rfile.read(int(length))
+        else:
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                body += chunk
+        self.server.posts.append((self.headers.get('Transfer-Encoding'),
+                                  length, body))
+        self.send_response(200 if len(self.server.posts) > 1 else 503)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+
+class TestGeturlStreaming(CiTestCase):
+
+    def setUp(self):
+        super(TestGeturlStreaming, self).setUp()
+        self.server = server = HTTPServer(('127.0.0.1', 0),
+                                          _ChunkedPostHandler)
+        server.posts = []
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d/post' % server.server_port
+
+    def test_geturl_streams_body_for_each_attempt(self):
+        bodies = []
+
+        def body():
+            bodies.append(True)
+            return iter([b'first ', b'second'])
+
+        self.assertEqual(b'OK', url_helper.geturl(self.url, data=body,
+                                                  retries=[0], log=None))
+        self.assertEqual(2, len(bodies))
+        self.assertEqual([('chunked', None, b'first second')] * 2,
+                         self.server.posts)
+
+    def test_geturl_streams_body_with_known_length(self):
+        def body():
+            return iter([b'first ', b'second'])
+
+        body.length = 12
+        self.assertEqual(b'OK', url_helper.geturl(self.url, data=body,
+                                                  retries=[0], log=None))
+        self.assertEqual([(None, '12', b'first second')] * 2,
+                         self.server.posts)
@@ -706,6 +706,79 @@ class TestChrootableTargetResolvConf(CiTestCase):
         self.assertEqual(content, target_conf)
 
 
+class TestChrootSession(CiTestCase):
+    """Test ChrootSession shares ChrootableTarget mounts"""
+
+    def setUp(self):
+        super(TestChrootSession, self).setUp()
+        self.target = self.tmp_dir()
+        self.add_patch('curtin.util.do_mount', 'm_do_mount',
+                       return_value=True)
+        self.add_patch('curtin.util.do_umount', 'm_do_umount')
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.mounts = ['/dev', '/proc']
+        self.tpaths = [os.path.join(self.target, 'dev'),
+                       os.path.join(self.target, 'proc')]
+
+    def _chroot(self):
+        return util.ChrootableTarget(self.target, allow_daemons=True,
+                                     mounts=self.mounts)
+
+    def test_without_session_mounts_each_time(self):
+        for _ in range(2):
+            with self._chroot():
+                pass
+        self.assertEqual(4, self.m_do_mount.call_count)
+        self.assertEqual(4, self.m_do_umount.call_count)
+        self.assertEqual(2, self.m_subp.call_count)
+
+    def test_session_mounts_once(self):
+        with util.ChrootSession(self.target) as session:
+            for _ in range(3):
+                with self._chroot():
+                    pass
+            with self._chroot():
+                with self._chroot():
+                    pass
+            self.assertEqual(0, self.m_do_umount.call_count)
+            self.assertEqual({'mount': 8, 'umount': 8}, session.saved)
+        self.assertEqual('chroot session for %s: saved 8 mounts and 8 '
+                         'umounts' % self.target, session.summary())
+        self.assertEqual(
+            [mock.call(p, t, opts='--bind')
+             for p, t in zip(self.mounts, self.tpaths)],
+            self.m_do_mount.call_args_list)
+        self.assertEqual([mock.call(t) for t in reversed(self.tpaths)],
+                         self.m_do_umount.call_args_list)
+        self.m_subp.assert_called_once_with(['udevadm', 'settle'])
+        self.assertIsNone(util.ChrootSession.current(self.target))
+
+    def test_nested_sessions_tear_down_once(self):
+        with util.ChrootSession(self.target) as outer:
+            with util.ChrootSession(self.target) as inner:
+                self.assertIs(outer, inner)
+                with self._chroot():
+                    pass
+            self.assertEqual(0, self.m_do_umount.call_count)
+            self.assertIs(outer, util.ChrootSession.current(self.target))
+        self.assertEqual(2, self.m_do_umount.call_count)
+
+    def test_session_tears_down_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with util.ChrootSession(self.target):
+                with self._chroot():
+                    raise RuntimeError('hook failed')
+        self.assertEqual(2, self.m_do_umount.call_count)
+        self.assertIsNone(util.ChrootSession.current(self.target))
+
+    def test_session_only_shares_its_target(self):
+        with util.ChrootSession(self.tmp_dir()):
+            with self._chroot():
+                pass
+        self.assertEqual(2, self.m_do_umount.call_count)
+        self.assertEqual(2, self.m_do_mount.call_count)
+
+
 class TestLoadFile(CiTestCase):
     """Test utility 'load_file'"""
 
@@ -810,71 +883,32 @@ class TestLoadCommandEnvironment(CiTestCase):
 
 
 class TestWaitForRemoval(CiTestCase):
+    def setUp(self):
+        super(TestWaitForRemoval, self).setUp()
+        self.add_patch('curtin.util.devwait.wait_for_path', 'm_wait')
+
     def test_wait_for_removal_missing_path(self):
         with self.assertRaises(ValueError):
             util.wait_for_removal(None)
+        self.assertEqual(0, self.m_wait.call_count)
 
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal(self, mock_os, mock_time):
+    def test_wait_for_removal(self):
         path = "/file/to/remove"
-        mock_os.path.exists.side_effect = iter([
-            True,    # File is not yet removed
-            False,   # File has  been removed
-        ])
-
+        self.m_wait.return_value = True
         util.wait_for_removal(path)
+        self.m_wait.assert_called_with(path, exists=False, timeout=16)
 
-        self.assertEqual(2, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(1, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls([
-            mock.call(path),
-            mock.call(path),
-        ])
-        mock_time.sleep.assert_has_calls([
-            mock.call(1),
-        ])
-
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal_timesout(self, mock_os, mock_time):
+    def test_wait_for_removal_timesout(self):
         path = "/file/to/remove"
-        mock_os.path.exists.return_value = True
-
+        self.m_wait.return_value = False
         with self.assertRaises(OSError):
             util.wait_for_removal(path)
 
-        self.assertEqual(5, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(4, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls(5 * [mock.call(path)])
-        mock_time.sleep.assert_has_calls([
-            mock.call(1),
-            mock.call(3),
-            mock.call(5),
-            mock.call(7),
-        ])
-
-    @mock.patch('curtin.util.time')
-    @mock.patch('curtin.util.os')
-    def test_wait_for_removal_custom_retry(self, mock_os, mock_time):
+    def test_wait_for_removal_custom_retry(self):
         path = "/file/to/remove"
-        timeout = 100
-        mock_os.path.exists.side_effect = iter([
-            True,    # File is not yet removed
-            False,   # File has  been removed
-        ])
-
-        util.wait_for_removal(path, retries=[timeout])
-
-        self.assertEqual(2, len(mock_os.path.exists.call_args_list))
-        self.assertEqual(1, len(mock_time.sleep.call_args_list))
-        mock_os.path.exists.assert_has_calls([
-            mock.call(path),
-            mock.call(path),
-        ])
-        mock_time.sleep.assert_has_calls([
-            mock.call(timeout),
-        ])
+        self.m_wait.return_value = True
+        util.wait_for_removal(path, retries=[100, 20])
+        self.m_wait.assert_called_with(path, exists=False, timeout=120)
 
 
 class TestGetEFIBootMGR(CiTestCase):
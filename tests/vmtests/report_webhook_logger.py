@@ -81,9 +81,21 @@ class ServerHandler(http_server.SimpleHTTPRequestHandler):
         else:
             self.wfile.write(("content of %s\n" % self.path).encode('utf-8'))
 
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        # post_files are streamed with chunked transfer encoding
+        body = b''
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
     def do_POST(self):
-        length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(length).decode('utf-8')
+        post_data = self._read_body().decode('utf-8')
         try:
             if self.result_log_file:
                 write_event_string(self.result_log_file, post_data)